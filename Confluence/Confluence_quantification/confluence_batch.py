@@ -0,0 +1,120 @@
+#################################################################################################
+#                           Confluence quantification - batch runner                            #
+#################################################################################################
+
+# This module runs a per-subject function (e.g. quantify_subject in the quantification scripts) for
+# many subjects in parallel, distributing subjects across a pool of worker processes.
+# Results are returned per subject as soon as that subject is finished, so they come back in
+# completion order; collect them in a dict and loop through the subjects in their original order
+# to get exactly the same output as a serial run, e.g.:
+#   results = dict(run_batch(quantify_subject, subjects, n_workers=16, memory_per_worker=4))
+#   for sub in subjects:
+#       ... results[sub] ...
+# A subject that fails (e.g. a corrupt scan, or a MemoryError from the memory limit per worker) doesn't stop
+# the batch: its result is a SubjectFailed with the error, and all other subjects are still processed.
+
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from confluence_profile import profiled
+
+try:
+    import resource
+except ImportError: # Not available on Windows, memory limit per worker is then not enforced
+    resource = None
+
+GB = 1024**3
+
+
+# Function available_memory returns the memory (in bytes) that is currently free on this machine,
+# or None if it can't be determined
+def available_memory():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+# Function choose_n_workers decides how many worker processes to start: at most n_workers (default:
+# number of CPUs), not more than there are subjects, and only as many as fit into the free memory
+# if a memory budget per worker (in GB) is given
+def choose_n_workers(n_subjects, n_workers=None, memory_per_worker=None):
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if memory_per_worker is not None:
+        free = available_memory()
+        if free is not None:
+            n_workers = min(n_workers, int(free // (memory_per_worker * GB)))
+    return max(1, min(n_workers, n_subjects))
+
+
+# Function limit_memory runs once in every worker process when it starts: caps the memory of that
+# process so that a subject that needs too much memory fails with a MemoryError instead of
+# taking down the whole node
+def limit_memory(memory_per_worker):
+    if memory_per_worker is not None and resource is not None:
+        limit = int(memory_per_worker * GB)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+class SubjectFailed:
+    # Result of a subject whose function raised an exception: error = one line (type and message),
+    # details = full traceback (for a worker process, the traceback in the worker)
+    def __init__(self, error):
+        self.error = f'{type(error).__name__}: {error}'
+        self.details = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+
+    def __repr__(self):
+        return f'SubjectFailed({self.error!r})'
+
+
+# Function run_batch calls func(sub, **kwargs) for every subject in subjects and yields
+# (sub, result) pairs in the order in which subjects finish.
+# func has to be a module-level function so it can be sent to the worker processes (in a script,
+# put the code that loops through subjects under if __name__ == '__main__':).
+# n_workers = number of processes (default: number of CPUs); memory_per_worker = memory budget per
+# process in GB (default: no limit). With one worker everything runs in this process, no pool.
+# If func raises an exception for a subject, the result of that subject is a SubjectFailed and the batch goes on;
+# only stopping the batch (KeyboardInterrupt, or the caller not reading further results) cancels the remaining subjects.
+# profile = CohortProfile (see confluence_profile.py) that collects the stage times of every subject (None = no profiling)
+def run_batch(func, subjects, n_workers=None, memory_per_worker=None, profile=None, **kwargs):
+    subjects = list(subjects)
+    n_workers = choose_n_workers(len(subjects), n_workers, memory_per_worker)
+    if profile is not None and profile.enabled:
+        func = profiled(func, profile.trace_memory)
+    else:
+        profile = None
+
+    # Function unpack takes the profiling record off the result and stores it
+    def unpack(result):
+        if profile is None:
+            return result
+        result, record = result
+        profile.add(record)
+        return result
+
+    if n_workers == 1:
+        for sub in subjects:
+            try:
+                result = func(sub, **kwargs)
+            except Exception as error:
+                yield sub, SubjectFailed(error)
+                continue
+            yield sub, unpack(result)
+        return
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=limit_memory,
+                             initargs=(memory_per_worker,)) as pool:
+        futures = {pool.submit(func, sub, **kwargs): sub for sub in subjects}
+        try:
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as error:
+                    yield futures[future], SubjectFailed(error)
+                    continue
+                yield futures[future], unpack(result)
+        except (KeyboardInterrupt, GeneratorExit):
+            # The batch was stopped (or the caller stopped early): don't start the remaining subjects
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
@@ -0,0 +1,260 @@
+#################################################################################################
+#                           Confluence quantification - benchmarks                              #
+#################################################################################################
+
+# This module measures how fast the confluence calculations are and how much memory they need, on
+# synthetic WMH maps (phantoms) instead of patient data, so results can be shared and compared:
+# - make_phantom creates a WMH map with a given matrix size, number of WMH voxels, number of lesions,
+#   clustering (how many voxels are in compact lesions vs scattered) and binary or probabilistic values
+# - run_benchmarks times every engine (what calculate_confluence/calculate_slices and calculate_volume in
+#   the scripts call) in 3D and 2D on a grid of phantoms and writes a JSON report
+# - check_engines compares every engine with confluence_pairwise (all pairs, like the original scripts)
+#   on small phantoms, check_lesions does the same for the per-lesion metrics (also for an image without WMH);
+#   the results are part of the report
+# - compare_reports lists cases that got slower (or need more memory) between two reports, e.g.
+#   before and after a change:
+#   report = run_benchmarks('benchmark_new.json')
+#   print(compare_reports('benchmark_old.json', 'benchmark_new.json'))
+
+import os
+import sys
+import json
+import time
+import platform
+import tracemalloc
+
+import numpy as np
+import scipy
+
+from confluence_engine import (SLAB_COPIES, confluence_2d, confluence_auto, confluence_many, confluence_pairwise,
+                               confluence_slabs, confluence_sweep, crop_to_lesions, kernel_radius, relative_deviation)
+from confluence_lesions import quantify_lesions
+
+
+# Function make_phantom creates a synthetic WMH map.
+# shape = matrix size (2D or 3D), n_voxels = number of WMH voxels, n_lesions = number of lesions (blobs),
+# clustering = fraction of WMH voxels that belong to lesions (1 = only compact lesions, 0 = only voxels
+# scattered at random), probabilistic = values between 0 and 1 (like non-binarized BIANCA output) instead of 1.
+# Returns a float32 array (same seed = same phantom)
+def make_phantom(shape, n_voxels, n_lesions=10, clustering=0.9, probabilistic=False, seed=0):
+    rng = np.random.default_rng(seed)
+    shape = tuple(int(n) for n in shape)
+    n_voxels = min(int(n_voxels), int(np.prod(shape)))
+    n_clustered = int(round(clustering * n_voxels)) if n_lesions > 0 else 0
+    centres = rng.uniform(0, shape, size=(max(n_lesions, 1), len(shape)))
+    # Lesion sizes vary a lot in real images: share of voxels per lesion from a skewed distribution
+    share = rng.pareto(1.5, size=len(centres)) + 1
+    share /= share.sum()
+    flat = np.zeros(0, dtype=np.int64)
+    # First the voxels in lesions, then the scattered ones; draw positions until there are enough different ones
+    # (positions inside a lesion often repeat)
+    for n_target, clustered in ((n_clustered, True), (n_voxels, False)):
+        while len(flat) < n_target:
+            n_new = n_target - len(flat)
+            if clustered:
+                lesion = rng.choice(len(centres), size=n_new, p=share)
+                # Spread of a lesion so that its voxels roughly fill a ball
+                spread = 0.5 * (share[lesion] * n_clustered)**(1 / len(shape))
+                position = centres[lesion] + rng.normal(size=(n_new, len(shape))) * spread[:, None]
+            else:
+                position = rng.uniform(0, shape, size=(n_new, len(shape)))
+            position = np.clip(np.round(position), 0, np.array(shape) - 1).astype(np.int64)
+            new = np.setdiff1d(np.ravel_multi_index(tuple(position.T), shape), flat)
+            flat = np.concatenate([flat, rng.permutation(new)[:n_new]])
+    image = np.zeros(shape, dtype=np.float32)
+    values = rng.uniform(0.05, 1.0, size=len(flat)) if probabilistic else 1.0
+    image.ravel()[flat] = values
+    return image
+
+
+# Function slab_budget returns a memory budget (bytes) for confluence_slabs on image (slabs along axis 2) that fits
+# the halos on both sides plus a quarter of the slices of the bounding box of the WMH voxels, so that the volume is
+# split into several slabs and the halos are still as thick as the kernel (same result as the filter)
+def slab_budget(image, s):
+    box = crop_to_lesions(image).shape
+    n = max(box[2], 1)
+    slices = 2 * kernel_radius(s, n) + max(1, n // 4)
+    # Half a slice more, so that rounding in confluence_slabs doesn't leave out one slice
+    return SLAB_COPIES * np.dtype(np.float64).itemsize * float(np.prod(box)) / n * (slices + 0.5)
+
+
+# Function engine_functions returns the calculations that are benchmarked, as dict name -> function(image, s)
+# mode = '3d': one value per volume, like calculate_confluence in confluence_quant_3d.py;
+# mode = '2d': one value per slice along axis 2, like calculate_slices in confluence_quant_2d.py
+# ('pairs' = small_load path of the scripts, 'compact' = filter in float32 like compact = True, 'slabs' = filter in
+# slabs like memory_budget in confluence_quant_3d.py, with a budget for several slabs (see slab_budget),
+# 'volume' = calculate_volume)
+def engine_functions(mode):
+    if mode == '3d':
+        return {'filter': lambda image, s: confluence_auto(image, s, engine='filter'),
+                'neighbours': lambda image, s: confluence_auto(image, s, engine='neighbours'),
+                'auto': lambda image, s: confluence_auto(image, s, engine='auto'),
+                'compact': lambda image, s: confluence_auto(image, s, engine='filter', dtype=np.float32),
+                'fft': lambda image, s: float(confluence_sweep(image, [s])[0]),
+                'pairs': lambda image, s: float(confluence_many([np.argwhere(image)], [image[image != 0]], s)[0][0]),
+                'slabs': lambda image, s: confluence_slabs(np.argwhere(image), image[image != 0], s, slab_budget(image, s))[0],
+                'volume': lambda image, s: float(image.sum(dtype=np.float64))}
+    if mode == '2d':
+        return {'filter': lambda image, s: confluence_2d(image, s, engine='filter')['confluence'],
+                'neighbours': lambda image, s: confluence_2d(image, s, engine='neighbours')['confluence'],
+                'auto': lambda image, s: confluence_2d(image, s, engine='auto')['confluence'],
+                'compact': lambda image, s: confluence_2d(image, s, engine='filter', dtype=np.float32)['confluence'],
+                'fft': lambda image, s: confluence_sweep(image, [s], axes=(0, 1))[0],
+                'pairs': lambda image, s: confluence_many([np.argwhere(image)], [image[image != 0]], s, slice_axis=2,
+                                                          n_slices=image.shape[2])[1][0],
+                'volume': lambda image, s: image.sum(axis=(0, 1), dtype=np.float64)}
+    raise ValueError(f"mode has to be '2d' or '3d', not {mode!r}")
+
+
+# Function total returns the sum over slices (NaN = slice without WMH voxels) or the single 3D value
+def total(value):
+    return float(np.nansum(value))
+
+
+# Function measure runs func(*args) repeats times, returns (result, fastest wall time in s, peak memory in MB).
+# Memory is measured in a separate run with tracemalloc (Python and numpy allocations), so it doesn't slow down the timing
+def measure(func, *args, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, min(times), peak / 1024**2
+
+
+# Function check_engines compares every engine with confluence_pairwise on small phantoms.
+# cases = list of dicts with the arguments of make_phantom, compact_rtol = tolerance of the float32 'compact' engine
+# (rtol for all others). Returns one dict per case, mode and engine, with the relative deviation of the sum
+CHECK_CASES = [{'shape': (24, 28, 10), 'n_voxels': 300, 'n_lesions': 4, 'clustering': 0.9, 'probabilistic': False},
+               {'shape': (24, 28, 10), 'n_voxels': 600, 'n_lesions': 10, 'clustering': 0.5, 'probabilistic': True},
+               {'shape': (40, 36, 12), 'n_voxels': 1500, 'n_lesions': 2, 'clustering': 1.0, 'probabilistic': True},
+               {'shape': (40, 36, 12), 'n_voxels': 80, 'n_lesions': 0, 'clustering': 0.0, 'probabilistic': False}]
+def check_engines(s=0.05, cases=CHECK_CASES, rtol=1e-9, compact_rtol=1e-5):
+    checks = []
+    for seed, case in enumerate(cases):
+        image = make_phantom(seed=seed, **case)
+        reference = {'3d': confluence_pairwise(image, s),
+                     '2d': np.array([confluence_pairwise(image[:, :, k], s) for k in range(image.shape[2])])}
+        for mode in ('3d', '2d'):
+            for engine, func in engine_functions(mode).items():
+                if engine == 'volume':
+                    continue
+                value = np.nan_to_num(np.asarray(func(image, s), dtype=np.float64)) # Slices without WMH voxels: 0
+                error = float(np.max(np.abs(value - reference[mode])))
+                scale = float(np.max(np.abs(reference[mode]))) or 1.0
+                tolerance = compact_rtol if engine == 'compact' else rtol
+                checks.append({'mode': mode, 'engine': engine, **case, 'shape': list(case['shape']),
+                               'value': total(value), 'reference': total(reference[mode]),
+                               'max_error': error, 'relative_deviation': relative_deviation(value, reference[mode]),
+                               'ok': error <= tolerance * scale})
+    return checks
+
+
+# Function check_lesions checks the per-lesion metrics of quantify_lesions (confluence_lesions.py) on small phantoms:
+# self-confluence of all lesions plus confluence of all pairs of lesions has to be the confluence_pairwise value of the
+# whole image (3D) or of every slice (2D). Images are cropped to the WMH voxels like in the scripts, so an image without
+# WMH voxels (like a healthy subject) becomes an array of size 0, which has to give empty tables with the same columns.
+# Returns one dict per case and mode
+def check_lesions(s=0.05, cases=CHECK_CASES, rtol=1e-9):
+    checks = []
+    for seed, case in enumerate(list(cases) + [{**cases[0], 'n_voxels': 0}]):
+        image = make_phantom(seed=seed, **case)
+        for mode, slice_axis in (('3d', None), ('2d', 2)):
+            image = crop_to_lesions(image, axes=(0, 1) if slice_axis is not None else None)
+            lesions, pairs = quantify_lesions(image, s, slice_axis=slice_axis)
+            value = lesions['Self_confluence'].sum() + pairs['Confluence'].sum()
+            reference = confluence_pairwise(image, s) if slice_axis is None else \
+                sum(confluence_pairwise(image[:, :, k], s) for k in range(image.shape[2]))
+            ok = abs(value - reference) <= rtol * max(abs(reference), 1.0)
+            if case['n_voxels'] == 0:
+                # Same columns as for an image with WMH voxels
+                columns = [list(table.columns) for table in quantify_lesions(make_phantom(**cases[0]), s, slice_axis=slice_axis)]
+                ok = ok and len(lesions) == 0 and len(pairs) == 0 and [list(lesions.columns), list(pairs.columns)] == columns
+            checks.append({'mode': mode, 'engine': 'lesions', **case, 'shape': list(case['shape']), 'value': float(value),
+                           'reference': float(reference), 'ok': bool(ok)})
+    return checks
+
+
+# Function run_benchmarks times all engines in 2D and 3D on a grid of phantoms and writes a JSON report.
+# shapes, n_voxels_values, n_lesions_values, clustering_values, probabilistic_values = grid of phantoms (all combinations);
+# engines = names from engine_functions to time (None = all); phantoms with more WMH voxels than max_pairs_voxels
+# are not run with the 'pairs' engine (it evaluates every pair in a slice/volume); check = also run check_engines.
+# Returns the report (dict)
+def run_benchmarks(report_path=None, s=0.05, modes=('3d', '2d'), shapes=((96, 128, 128), (192, 256, 256)),
+                   n_voxels_values=(1000, 10000, 100000), n_lesions_values=(20,), clustering_values=(0.9,),
+                   probabilistic_values=(False, True), engines=None, repeats=3, max_pairs_voxels=20000, check=True):
+    report = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 's': s, 'repeats': repeats,
+              'system': {'python': sys.version.split()[0], 'numpy': np.__version__, 'scipy': scipy.__version__,
+                         'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count()},
+              'results': []}
+    for shape in shapes:
+        for n_voxels in n_voxels_values:
+            for n_lesions in n_lesions_values:
+                for clustering in clustering_values:
+                    for probabilistic in probabilistic_values:
+                        case = {'shape': list(shape), 'n_voxels': n_voxels, 'n_lesions': n_lesions,
+                                'clustering': clustering, 'probabilistic': probabilistic}
+                        image = make_phantom(shape, n_voxels, n_lesions, clustering, probabilistic)
+                        for mode in modes:
+                            for engine, func in engine_functions(mode).items():
+                                if engines is not None and engine not in engines:
+                                    continue
+                                if engine == 'pairs' and n_voxels > max_pairs_voxels:
+                                    continue
+                                value, wall_time, peak = measure(func, image, s, repeats=repeats)
+                                report['results'].append({'mode': mode, 'engine': engine, **case, 'time': wall_time,
+                                                          'peak_memory_mb': peak, 'value': total(value)})
+                                print(f"{mode} {engine:10s} {shape} {n_voxels:8d} voxels: {wall_time:8.4f} s, {peak:8.1f} MB")
+    if check:
+        report['checks'] = check_engines(s) + check_lesions(s)
+        failed = [c for c in report['checks'] if not c['ok']]
+        print(f"Check against pairwise calculation: {len(report['checks']) - len(failed)} of {len(report['checks'])} ok")
+    if report_path is not None:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=1)
+    return report
+
+
+# Function case_key identifies a benchmark case (the same in different reports)
+def case_key(result):
+    return (result['mode'], result['engine'], tuple(result['shape']), result['n_voxels'], result['n_lesions'],
+            result['clustering'], result['probabilistic'])
+
+
+# Function compare_reports compares two reports (paths or dicts from run_benchmarks) and returns the cases
+# where time or peak memory grew by more than a factor of threshold (also very short times, below min_time s, are ignored),
+# as a list of dicts with old and new values
+def compare_reports(old, new, threshold=1.25, min_time=0.001):
+    reports = []
+    for report in (old, new):
+        if isinstance(report, (str, os.PathLike)):
+            with open(report) as f:
+                report = json.load(f)
+        reports.append({case_key(r): r for r in report['results']})
+    old, new = reports
+    regressions = []
+    for key in sorted(set(old) & set(new), key=str):
+        time_ratio = new[key]['time'] / max(old[key]['time'], 1e-12)
+        memory_ratio = new[key]['peak_memory_mb'] / max(old[key]['peak_memory_mb'], 1e-6)
+        slower = time_ratio > threshold and new[key]['time'] > min_time
+        if slower or memory_ratio > threshold:
+            regressions.append({'mode': key[0], 'engine': key[1], 'shape': list(key[2]), 'n_voxels': key[3],
+                                'old_time': old[key]['time'], 'new_time': new[key]['time'], 'time_ratio': time_ratio,
+                                'old_peak_memory_mb': old[key]['peak_memory_mb'], 'new_peak_memory_mb': new[key]['peak_memory_mb'],
+                                'memory_ratio': memory_ratio})
+    return regressions
+
+
+if __name__ == '__main__':
+    report_path = 'confluence_benchmark.json' # Change to where the report is written
+    previous_report = None # Path of an earlier report to compare with (None = no comparison)
+    run_benchmarks(report_path)
+    if previous_report is not None:
+        for regression in compare_reports(previous_report, report_path):
+            print(regression)
@@ -0,0 +1,150 @@
+#################################################################################################
+#                           Confluence quantification - result cache                            #
+#################################################################################################
+
+# This module keeps per-subject results on disk, so that a rerun only recomputes subjects whose
+# image (or parameters) changed, e.g. after adding one new scan to a folder of 3000 subjects.
+# Results are stored under a key made from the content of the input files (SHA-256) and the
+# parameters (s, 2D/3D mode, region, slice axis, ...):
+# - a changed image gets a new key, the old result of that subject is deleted (stale)
+# - files whose size and modification time haven't changed are not read again to hash them
+# - when the cache gets bigger than max_size (GB), the least recently used results are deleted
+# Usage in the scripts (same output as run_batch, cached subjects don't go to the worker pool):
+#   results = dict(run_cached_batch(quantify_subject, subjects, cache_dir, {'s': s, 'mode': '2d'}))
+
+import os
+import json
+import pickle
+import hashlib
+
+from confluence_batch import SubjectFailed, run_batch, GB
+
+CACHE_VERSION = 2 # Increase when the way results are calculated changes, invalidates all cached results
+
+
+# Function write_atomic writes a file in one go (write to temporary file, then rename), so an
+# interrupted run never leaves half-written files in the cache
+def write_atomic(path, data):
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class ResultCache:
+    # cache_dir = directory for cached results (created if it doesn't exist), max_size = size limit in GB
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(os.path.join(cache_dir, 'entries'), exist_ok=True)
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        # index: 'files' = path -> size, modification time and hash of that file,
+        # 'entries' = path + parameters -> key of the result currently stored for them
+        self.index = {'files': {}, 'entries': {}}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    # Function file_hash returns the SHA-256 of a file, reusing the stored hash if the file is unchanged
+    def file_hash(self, path):
+        stat = os.stat(path)
+        known = self.index['files'].get(path)
+        if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['hash']
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        self.index['files'][path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': sha.hexdigest()}
+        return sha.hexdigest()
+
+    # Function key returns the cache key for one subject: hash of function name, parameters and the
+    # content of all input files. Also deletes the previous result of this subject with these
+    # parameters if its input files have changed since
+    def key(self, sub, func_name, params, inputs):
+        params_id = json.dumps({'func': func_name, 'version': CACHE_VERSION, 'params': params},
+                               sort_keys=True, default=str)
+        content = json.dumps([params_id, [self.file_hash(path) for path in inputs]])
+        key = hashlib.sha256(content.encode()).hexdigest()
+        entry_id = f'{sub}|{params_id}'
+        old_key = self.index['entries'].get(entry_id)
+        if old_key is not None and old_key != key:
+            self.remove(old_key)
+        self.index['entries'][entry_id] = key
+        return key
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, 'entries', f'{key}.pkl')
+
+    # Function get returns (True, result) if a result is cached under key, else (False, None)
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+        os.utime(path) # Mark as recently used, for eviction
+        return True, result
+
+    def put(self, key, result):
+        write_atomic(self.entry_path(key), pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def remove(self, key):
+        try:
+            os.remove(self.entry_path(key))
+        except FileNotFoundError:
+            pass
+
+    # Function evict deletes the least recently used results until the cache is below max_size
+    def evict(self):
+        if self.max_size is None:
+            return
+        entries_dir = os.path.join(self.cache_dir, 'entries')
+        entries = []
+        for entry in os.scandir(entries_dir):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size * GB:
+                break
+            os.remove(path)
+            total -= size
+
+    def save_index(self):
+        write_atomic(self.index_path, json.dumps(self.index).encode())
+
+
+# Function run_cached_batch works like run_batch (see confluence_batch.py), but takes results from the
+# cache in cache_dir where possible and stores new ones. Yields (sub, result) pairs, cached subjects first.
+# params = dict of everything the result depends on apart from the image (s, mode, region, slice axis, ...);
+# extra_inputs = function sub -> list of other files the result depends on (e.g. region masks);
+# cache_dir = None: no caching, same as run_batch; profile: see run_batch (only subjects that are not cached are profiled).
+# Failed subjects (SubjectFailed, see run_batch) are not cached, so they are tried again in the next run
+def run_cached_batch(func, subjects, cache_dir, params, max_cache_size=None, extra_inputs=None,
+                     n_workers=None, memory_per_worker=None, profile=None, **kwargs):
+    if cache_dir is None:
+        yield from run_batch(func, subjects, n_workers=n_workers, memory_per_worker=memory_per_worker,
+                             profile=profile, **kwargs)
+        return
+    cache = ResultCache(cache_dir, max_cache_size)
+    keys = {}
+    missing = []
+    for sub in subjects:
+        inputs = [sub] + (list(extra_inputs(sub)) if extra_inputs is not None else [])
+        keys[sub] = cache.key(sub, func.__name__, {**params, **kwargs}, inputs)
+        found, result = cache.get(keys[sub])
+        if found:
+            yield sub, result
+        else:
+            missing.append(sub)
+    cache.save_index()
+    try:
+        for sub, result in run_batch(func, missing, n_workers=n_workers, memory_per_worker=memory_per_worker,
+                                     profile=profile, **kwargs):
+            if not isinstance(result, SubjectFailed):
+                cache.put(keys[sub], result)
+            yield sub, result
+    finally:
+        cache.evict()
@@ -0,0 +1,581 @@
+#################################################################################################
+#                             Confluence quantification - engines                               #
+#################################################################################################
+
+# This module contains the functions that compute the confluence metric itself, so that the
+# quantification scripts (2D, 3D, deep/periventricular) can share one implementation
+
+# The confluence metric of an image with voxel values v is the sum over all pairs of nonzero
+# voxels a < b of v_a * v_b * exp(-s * d_ab^2), where d_ab is the distance between the voxels.
+# The Gaussian kernel exp(-s * d^2) is separable (exp(-s*(dx^2+dy^2+dz^2)) = exp(-s*dx^2) *
+# exp(-s*dy^2) * exp(-s*dz^2)), so instead of looping over all pairs we can filter the image
+# with the kernel one axis at a time and take a dot product with the original image:
+#   sum_a v_a * (K*v)_a = sum over all ordered pairs (a, b) incl. a == b of v_a * v_b * K(d_ab)
+# Removing the diagonal (a == b, where K = 1) and halving gives the sum over a < b.
+# Memory grows with the size of the image, not with the square of the number of WMH voxels.
+# Distances are in voxels by default; with spacing (voxel size per axis, e.g. zooms from the NIfTI
+# header) they are in mm, so anisotropic voxels (e.g. 1x1x3 mm) get an anisotropic kernel on the
+# native grid, without resampling. The kernel stays separable: exp(-s*((hx*dx)^2+(hy*dy)^2+(hz*dz)^2)).
+
+from functools import lru_cache
+
+import numpy as np
+from scipy import fft, ndimage
+from scipy.spatial import cKDTree
+
+# Kernel values below this are dropped (exp(-s*d^2) relative to the kernel peak of 1). With the
+# default, every pair left out is below double precision relative to a pair of touching voxels (radius about 28 voxels at
+# s = 0.05); a slice whose WMH voxels are all further apart than that gives exactly 0 instead of a tiny positive value, so
+# slices are counted as nonzero from their number of WMH voxels, not from confluence > 0 (see summarise_slices)
+KERNEL_TOL = 1e-17
+
+
+# Function kernel_radius calculates how many voxels the kernel needs to reach along one axis
+# (spacing = voxel size along this axis)
+def kernel_radius(s, length, tol=KERNEL_TOL, spacing=1.0):
+    # Smallest r with exp(-s*(spacing*r)^2) < tol; pairs can never be further apart than the axis is long
+    radius = int(np.ceil(np.sqrt(-np.log(tol) / s) / spacing))
+    return min(radius, length - 1)
+
+
+# Function gaussian_kernel_1d creates the 1D kernel exp(-s*(spacing*d)^2) for d = -radius ... radius
+def gaussian_kernel_1d(s, radius, spacing=1.0):
+    d = np.arange(-radius, radius + 1)
+    return np.exp(-s * (spacing * d)**2)
+
+
+# Function axis_spacing returns the voxel size of each of the ndim axes of an array
+# (spacing = None: distances in voxels, i.e. 1 for every axis)
+def axis_spacing(spacing, ndim):
+    if spacing is None:
+        return (1.0,) * ndim
+    spacing = tuple(float(h) for h in spacing)
+    if len(spacing) != ndim:
+        raise ValueError(f'Got {len(spacing)} voxel sizes for an array with {ndim} axes')
+    return spacing
+
+
+# Function lesion_box returns the bounding box of the nonzero voxels of an image along the given axes (default: all
+# axes) as a tuple of slices (whole axis for the other axes), e.g. to cut masks of the same shape down to it
+def lesion_box(image, axes=None):
+    if axes is None:
+        axes = range(image.ndim)
+    box = [slice(None)] * image.ndim
+    for axis in axes:
+        # Positions along this axis that contain at least one nonzero voxel
+        other_axes = tuple(a for a in range(image.ndim) if a != axis)
+        idx = np.flatnonzero(np.any(image, axis=other_axes))
+        box[axis] = slice(idx[0], idx[-1] + 1) if len(idx) else slice(0, 0)
+    return tuple(box)
+
+
+# Function crop_to_lesions cuts an image down to the bounding box of its nonzero voxels along the given
+# axes (default: all axes); voxels outside the box are 0 and do not contribute to the confluence
+# metric, so this does not change it
+def crop_to_lesions(image, axes=None):
+    return image[lesion_box(image, axes)]
+
+
+# Function gaussian_filter filters an image with the kernel exp(-s*d^2) along the given axes
+# (zero padding, kernel not normalised, so the value at the centre of the kernel is 1).
+# spacing = voxel size of every axis of image (None = distances in voxels); dtype = data type of the filtered image
+# (np.float32 halves the memory, the sums along each line are still calculated in float64 by scipy)
+def gaussian_filter(image, s, axes=None, tol=KERNEL_TOL, spacing=None, dtype=np.float64):
+    filtered = np.asarray(image, dtype=dtype)
+    if axes is None:
+        axes = range(filtered.ndim)
+    spacing = axis_spacing(spacing, filtered.ndim)
+    for axis in axes:
+        radius = kernel_radius(s, filtered.shape[axis], tol, spacing[axis])
+        if radius > 0:
+            filtered = ndimage.correlate1d(filtered, gaussian_kernel_1d(s, radius, spacing[axis]), axis=axis,
+                                           mode='constant', cval=0.0)
+    # Always a new array, callers change it in place
+    return filtered.copy() if filtered is image else filtered
+
+
+# Function confluence_conv calculates the confluence metric of a 2D slice or a 3D volume
+# (all axes of the array that is passed in) with the filtering approach described above
+def confluence_conv(image, s, tol=KERNEL_TOL, spacing=None, dtype=np.float64):
+    image = np.asarray(image, dtype=dtype)
+    return float(confluence_sums(image, s, axes=range(image.ndim), tol=tol, spacing=spacing, dtype=dtype))
+
+
+# Function confluence_sums calculates the confluence metric separately for every position along the
+# axes that are not filtered, e.g. for a 3D image with axes=(0, 1) one value per slice along axis 2,
+# or for a stack of images (image, x, y, z) with axes=(1, 2, 3) one value per image.
+# dtype = np.float32: compact mode, image and filtered image in float32 and the sum with compensated_sum
+def confluence_sums(image, s, axes, tol=KERNEL_TOL, spacing=None, dtype=np.float64):
+    axes = tuple(axes)
+    image = crop_to_lesions(np.asarray(image, dtype=dtype), axes)
+    filtered = gaussian_filter(image, s, axes, tol=tol, spacing=spacing, dtype=dtype)
+    # Filtered image minus the image itself = contribution of all other voxels to each voxel
+    if image.dtype == np.float64:
+        return 0.5 * np.sum(image * (filtered - image), axis=axes)
+    filtered -= image
+    filtered *= image
+    return 0.5 * compensated_sum(filtered, axes)
+
+
+# Function confluence_map calculates the local confluence of every voxel: 0.5*v_a*(sum over all other voxels b of
+# v_b*exp(-s*d^2)), i.e. its share of the confluence metric (half of every pair goes to each of its two voxels), 0 outside
+# the WMH. It comes from the filtered image like confluence_sums, so the metric is not calculated a second time.
+# axes, spacing and dtype as in confluence_sums (e.g. axes=(0, 1) for slices along axis 2).
+# Returns (local confluence, same shape as image; confluence = sum of it along axes)
+def confluence_map(image, s, axes=None, tol=KERNEL_TOL, spacing=None, dtype=np.float64):
+    image = np.asarray(image, dtype=dtype)
+    if axes is None:
+        axes = range(image.ndim)
+    axes = tuple(axes)
+    local = gaussian_filter(image, s, axes, tol=tol, spacing=spacing, dtype=dtype)
+    local -= image
+    local *= image
+    local *= 0.5
+    confluence = np.sum(local, axis=axes) if local.dtype == np.float64 else compensated_sum(local, axes)
+    return local, confluence
+
+
+# Function compensated_sum sums x along axes in the data type of x (e.g. float32) without the error growing with the
+# number of values: x is summed in blocks of about SUM_BLOCK values along the first of the axes, and the block sums
+# are added up with Neumaier's compensated summation (running sum plus a second sum of what got rounded off).
+# Returns float64 (one value per position along the other axes)
+SUM_BLOCK = 4096 # Number of values summed directly in the data type of x
+def compensated_sum(x, axes):
+    axes = tuple(axes)
+    first = axes[0]
+    values_per_index = int(np.prod([x.shape[a] for a in axes if a != first]))
+    step = max(1, SUM_BLOCK // max(values_per_index, 1))
+    total = compensation = 0
+    for start in range(0, x.shape[first], step):
+        block = [slice(None)] * x.ndim
+        block[first] = slice(start, start + step)
+        partial = x[tuple(block)].sum(axis=axes)
+        new_total = total + partial
+        compensation = compensation + np.where(np.abs(total) >= np.abs(partial), (total - new_total) + partial,
+                                               (partial - new_total) + total)
+        total = new_total
+    return np.asarray(total, dtype=np.float64) + compensation
+
+
+# Function confluence_sweep calculates the confluence metric for several kernel widths s at once.
+# Same result as confluence_sums for each s, but the image is cropped and transformed to the frequency
+# domain only once; each s then only needs one multiplication with the (separable) kernel spectrum
+# and one inverse transform. axes = axes to filter (default: all, i.e. 2D slice or 3D volume).
+# The FFT leaves round-off of about eps * (largest filtered value) on every voxel, e.g. +-4e-17 for a slice with a
+# single WMH voxel instead of 0; values within FFT_ROUNDOFF times that of 0 are set to exactly 0.
+# Returns an array with one row per s (and one column per position along the other axes, if any)
+FFT_ROUNDOFF = 64 # Values below FFT_ROUNDOFF * eps * max(filtered) * sum(image) (per position) are round-off
+def confluence_sweep(image, s_values, axes=None, tol=KERNEL_TOL, spacing=None):
+    image = np.asarray(image, dtype=np.float64)
+    if axes is None:
+        axes = range(image.ndim)
+    axes = tuple(axes)
+    spacing = axis_spacing(spacing, image.ndim)
+    s_values = [float(s) for s in s_values]
+    image = crop_to_lesions(image, axes)
+    kept_shape = tuple(n for a, n in enumerate(image.shape) if a not in axes)
+    if image.size == 0:
+        return np.zeros((len(s_values),) + kept_shape)
+    # Zero-pad each axis to at least n + r (r = largest kernel radius), so the circular convolution of
+    # the FFT equals the zero-padded convolution on the image (no wrap-around onto WMH voxels)
+    fft_shape = []
+    for axis in axes:
+        n = image.shape[axis]
+        radius = max(kernel_radius(s, n, tol, spacing[axis]) for s in s_values)
+        fft_shape.append(fft.next_fast_len(max(n + radius, 2 * radius + 1), real=True))
+    spectrum = fft.rfftn(image, s=fft_shape, axes=axes)
+    crop = tuple(slice(0, n) for n in image.shape)
+    result = []
+    for s in s_values:
+        kernel_spectrum = np.ones(1)
+        for i, (axis, length) in enumerate(zip(axes, fft_shape)):
+            radius = kernel_radius(s, image.shape[axis], tol, spacing[axis])
+            # 1D kernel in circular layout: d = 0 ... radius at the start, d = -radius ... -1 at the end
+            kernel_values = gaussian_kernel_1d(s, radius, spacing[axis])
+            kernel = np.zeros(length)
+            kernel[:radius + 1] = kernel_values[radius:]
+            if radius > 0:
+                kernel[-radius:] = kernel_values[:radius]
+            # Kernel is symmetric, so its spectrum is real; rfftn uses the half spectrum on the last axis
+            kernel_1d = (fft.rfft(kernel) if i == len(axes) - 1 else fft.fft(kernel)).real
+            shape = [1] * image.ndim
+            shape[axis] = len(kernel_1d)
+            kernel_spectrum = kernel_spectrum * kernel_1d.reshape(shape)
+        filtered = fft.irfftn(spectrum * kernel_spectrum, s=fft_shape, axes=axes)[crop]
+        confluence = 0.5 * np.sum(image * (filtered - image), axis=axes)
+        roundoff = FFT_ROUNDOFF * np.finfo(np.float64).eps * np.abs(filtered).max() * np.sum(np.abs(image), axis=axes)
+        result.append(np.where(np.abs(confluence) <= roundoff, 0.0, confluence))
+    return np.array(result)
+
+
+# Function confluence_neighbours calculates the confluence metric only from pairs of WMH voxels that are
+# at most a cutoff distance apart, found with a KD-tree. For very sparse maps this is much less work than
+# filtering the whole bounding box. coords = (N, ndim) voxel coordinates, values = N voxel values.
+# The cutoff is the distance at which the kernel drops below tol (or cutoff, if given); all pairs that
+# are left out have kernel < exp(-s*cutoff^2), so the error is at most exp(-s*cutoff^2) * sum over all
+# pairs a < b of v_a*v_b. slice_axis = None: one value for all voxels (2D slice or 3D volume);
+# slice_axis = axis of coords: one value per slice along that axis (n_slices values), pairs only within slices.
+# spacing = voxel size of every axis of coords (None = distances in voxels).
+# Returns (confluence, error_bound), per slice if slice_axis is given
+MAX_PAIRS = 5_000_000 # Maximum number of voxel pairs kept in memory at once
+def confluence_neighbours(coords, values, s, slice_axis=None, n_slices=None, cutoff=None, tol=KERNEL_TOL, spacing=None):
+    coords = np.asarray(coords, dtype=np.float64).reshape(len(values), -1)
+    values = np.asarray(values, dtype=np.float64)
+    if cutoff is None:
+        cutoff = np.sqrt(-np.log(tol) / s)
+    slice_index = coords[:, slice_axis].astype(np.int64) if slice_axis is not None else None
+    coords = coords * np.array(axis_spacing(spacing, coords.shape[1]))
+    if slice_axis is None:
+        slice_index = np.zeros(len(values), dtype=np.int64)
+        n_slices = 1
+    else:
+        if n_slices is None:
+            n_slices = int(slice_index.max()) + 1 if len(values) else 0
+        # Move slices so far apart that no pair across slices is within the cutoff
+        coords[:, slice_axis] = slice_index * (2 * cutoff + 1)
+    confluence = np.zeros(n_slices)
+    if len(values) > 1:
+        tree = cKDTree(coords)
+        # Go through the voxels in chunks, so that only about MAX_PAIRS pairs are in memory at once
+        neighbours = max(1.0, count_neighbours(tree, coords, cutoff))
+        chunk_size = max(1, int(MAX_PAIRS / neighbours))
+        for start in range(0, len(values), chunk_size):
+            chunk = cKDTree(coords[start:start + chunk_size])
+            pairs = chunk.sparse_distance_matrix(tree, cutoff, output_type='ndarray')
+            first = pairs['i'] + start
+            second = pairs['j']
+            keep = first < second # Every pair once, no voxel with itself
+            first, second = first[keep], second[keep]
+            dist_sq = ((coords[first] - coords[second])**2).sum(axis=1)
+            contribution = values[first] * values[second] * np.exp(-s * dist_sq)
+            confluence += np.bincount(slice_index[first], weights=contribution, minlength=n_slices)
+    # Sum over all pairs a < b of v_a*v_b = ((sum v)^2 - sum v^2)/2, per slice
+    value_sum = np.bincount(slice_index, weights=values, minlength=n_slices)
+    value_sq_sum = np.bincount(slice_index, weights=values**2, minlength=n_slices)
+    error_bound = np.exp(-s * cutoff**2) * 0.5 * (value_sum**2 - value_sq_sum)
+    if slice_axis is None:
+        return float(confluence[0]), float(error_bound[0])
+    return confluence, error_bound
+
+
+# Function count_neighbours estimates the average number of voxels within the cutoff of a voxel (incl. itself),
+# from a sample of sample_size voxels
+def count_neighbours(tree, coords, cutoff, sample_size=200):
+    sample = coords[np.linspace(0, len(coords) - 1, min(sample_size, len(coords))).astype(np.int64)]
+    return float(tree.query_ball_point(sample, cutoff, return_length=True).mean())
+
+
+# Function choose_engine decides whether filtering ('filter') or the neighbour search ('neighbours') is
+# less work for an image (already cropped to the WMH voxels along axes): filtering costs one multiplication
+# per kernel value per voxel of the bounding box, the neighbour search costs a few operations per pair of
+# WMH voxels within the cutoff (in the same slice for axes that are not in axes; estimated by counting the neighbours
+# of a sample of voxels) plus one scan
+# of the bounding box to find the WMH voxels
+FILTER_COST = 1.0 # Relative cost of one kernel value per voxel when filtering
+NEIGHBOUR_COST = 150.0 # Relative cost of one pair of WMH voxels in the neighbour search
+SCAN_COST = 5.0 # Relative cost per voxel of finding the WMH voxels in the bounding box
+def choose_engine(image, s, axes, coords=None, tol=KERNEL_TOL, spacing=None):
+    spacing = axis_spacing(spacing, image.ndim)
+    filter_cost = FILTER_COST * image.size * sum(2 * kernel_radius(s, image.shape[a], tol, spacing[a]) + 1 for a in axes)
+    scan_cost = SCAN_COST * image.size
+    if coords is None:
+        coords = np.argwhere(image)
+    n_voxels = len(coords)
+    # Upper bound on pairs: every pair within the cutoff of each other
+    if NEIGHBOUR_COST * n_voxels * (n_voxels - 1) / 2 + scan_cost < filter_cost:
+        return 'neighbours'
+    cutoff = np.sqrt(-np.log(tol) / s)
+    positions = coords * np.array(spacing) # Cutoff is in the same units as the kernel
+    for axis in range(image.ndim):
+        if axis not in axes:
+            # Slices (2D): no pairs across slices, so slices are moved so far apart that none is within the cutoff
+            positions[:, axis] = coords[:, axis] * (2 * cutoff + 1)
+    neighbours = count_neighbours(cKDTree(positions), positions, cutoff) - 1
+    neighbour_cost = NEIGHBOUR_COST * n_voxels * neighbours / 2 + scan_cost
+    return 'neighbours' if neighbour_cost < filter_cost else 'filter'
+
+
+# Function truncation_bound returns the error bound of leaving out all pairs with kernel < tol (filter: beyond
+# kernel_radius; neighbour search: beyond the cutoff): tol * sum over all pairs a < b of v_a*v_b, one value per
+# position along the axes that are not in axes (like confluence_sums)
+def truncation_bound(image, axes, tol=KERNEL_TOL):
+    value_sum = image.sum(axis=axes, dtype=np.float64)
+    value_sq_sum = np.square(image, dtype=np.float64).sum(axis=axes)
+    return tol * 0.5 * (value_sum**2 - value_sq_sum)
+
+
+# Function confluence_auto calculates the confluence metric like confluence_sums (one value per position along
+# the axes that are not in axes), with the engine given by engine: 'filter' (Gaussian filter, see above),
+# 'neighbours' (pairs within the cutoff, see confluence_neighbours) or 'auto' (whichever is less work).
+# spacing = voxel size of every axis of image (None = distances in voxels).
+# return_error = True: returns (confluence, error_bound), error_bound = how much too low confluence can be because
+# pairs with kernel < tol are left out (see confluence_neighbours, truncation_bound)
+def confluence_auto(image, s, axes=None, engine='auto', tol=KERNEL_TOL, spacing=None, dtype=np.float64, return_error=False):
+    image = np.asarray(image)
+    if axes is None:
+        axes = range(image.ndim)
+    axes = tuple(axes)
+    image = crop_to_lesions(image, axes)
+    coords = None
+    if engine == 'auto':
+        coords = np.argwhere(image)
+        engine = choose_engine(image, s, axes, coords=coords, tol=tol, spacing=spacing)
+    if engine == 'filter':
+        result = confluence_sums(image, s, axes, tol=tol, spacing=spacing, dtype=dtype)
+        if result.ndim == 0:
+            result = float(result)
+        if return_error:
+            error_bound = truncation_bound(image, axes, tol)
+            return result, float(error_bound) if np.ndim(error_bound) == 0 else error_bound
+        return result
+    if engine == 'neighbours':
+        if coords is None:
+            coords = np.argwhere(image)
+        values = image[tuple(coords.T)]
+        other_axes = [a for a in range(image.ndim) if a not in axes]
+        if len(other_axes) > 1:
+            raise ValueError('The neighbour search engine can only keep one axis (e.g. slices)')
+        if not other_axes:
+            result = confluence_neighbours(coords, values, s, tol=tol, spacing=spacing)
+        else:
+            result = confluence_neighbours(coords, values, s, slice_axis=other_axes[0],
+                                           n_slices=image.shape[other_axes[0]], tol=tol, spacing=spacing)
+        return result if return_error else result[0]
+    raise ValueError(f"engine has to be 'auto', 'filter' or 'neighbours', not {engine!r}")
+
+
+# Function confluence_2d calculates the 2D confluence metric of all slices of a volume at once (instead of one call per
+# slice): slices along slice_axis (e.g. 0 for sagittal slices), kernel only in-plane, engine as in confluence_auto.
+# Slices without WMH voxels are left out before filtering. Returns dict with one array per quantity, one value per slice:
+# 'confluence' (NaN for slices without WMH voxels), 'error_bound' (how much too low confluence can be, see confluence_auto;
+# 0 for slices without WMH voxels), 'volume' (sum of voxel values), 'voxels' (number of WMH voxels) and 'nonzero' (slice has WMH voxels).
+# spacing = voxel size of every axis of image (None = distances in voxels); dtype: see confluence_auto
+def confluence_2d(image, s, slice_axis=2, engine='auto', tol=KERNEL_TOL, spacing=None, dtype=np.float64):
+    image = np.asarray(image)
+    axes = tuple(a for a in range(image.ndim) if a != slice_axis)
+    voxels = np.count_nonzero(image, axis=axes)
+    nonzero = voxels > 0
+    confluence = np.full(image.shape[slice_axis], np.nan)
+    error_bound = np.zeros(image.shape[slice_axis])
+    if nonzero.any():
+        confluence[nonzero], error_bound[nonzero] = confluence_auto(np.compress(nonzero, image, axis=slice_axis), s, axes=axes,
+                                                                    engine=engine, tol=tol, spacing=spacing, dtype=dtype,
+                                                                    return_error=True)
+    return {'confluence': confluence, 'error_bound': error_bound, 'volume': image.sum(axis=axes, dtype=np.float64),
+            'voxels': voxels, 'nonzero': nonzero}
+
+
+# Function confluence_slabs calculates the 3D confluence metric from the WMH voxels (coords, values, e.g. of a
+# SparseImage) without building the whole volume: the bounding box of the WMH voxels is cut into slabs of slices
+# along axis, each slab is built with a halo of kernel_radius slices on both sides and filtered like in
+# confluence_conv, and only the slices of the slab itself (not the halo) are summed. Every voxel is summed in
+# exactly one slab with all voxels it has pairs with, so the result is the same as confluence_conv.
+# Slabs are as thick as fits into memory_budget (bytes); if not even one slice with both halos fits, the halo is
+# made thinner and pairs further apart along axis than the halo are left out, which error_bound then includes
+# (like for confluence_neighbours: at most the largest kernel value left out * sum over all pairs a < b of v_a*v_b).
+# spacing = voxel size of every axis (None = distances in voxels); dtype = np.float32: compact mode (see confluence_sums),
+# twice as many slices per slab.
+# Returns (confluence, error_bound, number of slabs)
+SLAB_COPIES = 3 # Arrays of the size of a slab in memory at once while filtering (slab, filtered slab, output of one pass)
+def confluence_slabs(coords, values, s, memory_budget, axis=2, tol=KERNEL_TOL, spacing=None, dtype=np.float64):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return 0.0, 0.0, 0
+    coords = np.asarray(coords, dtype=np.int64)
+    spacing = axis_spacing(spacing, coords.shape[1])
+    # Coordinates within the bounding box of the WMH voxels, sorted along axis
+    coords = coords - coords.min(axis=0)
+    shape = coords.max(axis=0) + 1
+    order = np.argsort(coords[:, axis], kind='stable')
+    coords, values = coords[order], values[order]
+    position = coords[:, axis]
+    n = int(shape[axis])
+    slice_bytes = SLAB_COPIES * np.dtype(dtype).itemsize * float(np.prod(shape)) / n
+    n_fit = int(memory_budget // slice_bytes) # Number of slices that fit into the budget
+    if n_fit < 1:
+        raise ValueError(f'Memory budget of {memory_budget / 1024**2:.1f} MB is too small for one slice '
+                         f'({slice_bytes / 1024**2:.1f} MB)')
+    radius = kernel_radius(s, n, tol, spacing[axis])
+    halo = min(radius, (n_fit - 1) // 2)
+    thickness = n_fit - 2 * halo
+    confluence = 0.0
+    n_slabs = 0
+    for core_start in range(0, n, thickness):
+        core_stop = min(core_start + thickness, n)
+        start, stop = max(0, core_start - halo), min(n, core_stop + halo)
+        first, last = np.searchsorted(position, [start, stop])
+        if first == last:
+            continue
+        slab_coords = coords[first:last]
+        # Slab covers its own WMH voxels in-plane
+        slab_start = slab_coords.min(axis=0)
+        slab_start[axis] = start
+        slab_shape = slab_coords.max(axis=0) + 1 - slab_start
+        slab_shape[axis] = stop - start
+        slab = np.zeros(slab_shape, dtype=dtype)
+        slab[tuple((slab_coords - slab_start).T)] = values[first:last]
+        filtered = gaussian_filter(slab, s, tol=tol, spacing=spacing, dtype=dtype)
+        core = [slice(None)] * slab.ndim
+        core[axis] = slice(core_start - start, core_stop - start)
+        core = tuple(core)
+        products = slab[core] * (filtered[core] - slab[core])
+        confluence += float(np.sum(products) if slab.dtype == np.float64 else compensated_sum(products, range(slab.ndim)))
+        n_slabs += 1
+        del slab, filtered
+    # Largest kernel value of a pair that is left out: below tol (like the filter), or pairs further apart than the halo
+    left_out = tol if halo == radius else max(tol, np.exp(-s * (spacing[axis] * (halo + 1))**2))
+    error_bound = left_out * 0.5 * (values.sum()**2 - np.sum(values**2))
+    return 0.5 * confluence, float(error_bound), n_slabs
+
+
+# Function segment_pairs returns all pairs (first, second) with first < second of voxels in the same segment, for the
+# voxels start ... stop - 1 as first voxel. Voxels are sorted by segment, ends[a] = end of the segment of voxel a
+def segment_pairs(ends, start, stop):
+    index = np.arange(start, stop)
+    partners = ends[start:stop] - index - 1 # Voxels after a in the same segment
+    first = np.repeat(index, partners)
+    # Position of every pair among the pairs of its first voxel: 0, 1, ..., partners - 1
+    position = np.arange(len(first)) - np.repeat(np.cumsum(partners) - partners, partners)
+    return first, first + 1 + position
+
+
+# Function confluence_segments calculates the confluence metric separately for many small groups of voxels at once
+# (e.g. all slices of many subjects with few WMH voxels each), from all pairs of voxels within each group:
+# coords = (N, ndim) voxel coordinates, values = N voxel values, segment = N group numbers (0 ... n_segments - 1).
+# Instead of one call per group, the pairs of all groups are evaluated together, at most about MAX_PAIRS at once
+# (pairs with kernel < tol are left out). spacing = voxel size of every axis of coords (None = distances in voxels).
+# dtype = np.float32: compact mode, coordinates, values and kernel values in float32 (sums per segment stay float64).
+# Returns n_segments confluence values
+def confluence_segments(coords, values, segment, n_segments, s, tol=KERNEL_TOL, spacing=None, dtype=np.float64):
+    order = np.argsort(segment, kind='stable')
+    spacing = axis_spacing(spacing, coords.shape[1])
+    axes = [(np.asarray(coords[:, a], dtype=dtype) * spacing[a])[order] for a in range(coords.shape[1])] # One array per axis is faster to index
+    values = np.asarray(values, dtype=dtype)[order]
+    segment = np.asarray(segment, dtype=np.int64)[order]
+    ends = np.searchsorted(segment, np.arange(1, n_segments + 1))[segment]
+    n_pairs = np.cumsum(ends - np.arange(len(values)) - 1) # Number of pairs up to and including every first voxel
+    cutoff_sq = -np.log(tol) / s # Pairs further apart than this have kernel < tol and are left out, like in the filter
+    confluence = np.zeros(n_segments)
+    start = 0
+    while start < len(values):
+        done = n_pairs[start - 1] if start > 0 else 0
+        stop = max(start + 1, int(np.searchsorted(n_pairs, done + MAX_PAIRS, side='right')))
+        first, second = segment_pairs(ends, start, stop)
+        dist_sq = sum((x[first] - x[second])**2 for x in axes)
+        close = dist_sq <= cutoff_sq
+        first, second = first[close], second[close]
+        contribution = values[first] * values[second] * np.exp(-s * dist_sq[close])
+        confluence += np.bincount(segment[first], weights=contribution, minlength=n_segments)
+        start = stop
+    return confluence
+
+
+# Function confluence_many calculates the confluence metric for many subjects with few WMH voxels in one go, without
+# building images: coords_list = list with one (N, 3) coordinate array per subject, values_list = voxel values
+# (e.g. coords and values of SparseImage, see confluence_io.py). slice_axis = None: 3D, one value per subject;
+# slice_axis = 0, 1 or 2: 2D, per slice along that axis (n_slices slices, default: up to the highest slice with WMH).
+# spacing = voxel size (3 values, e.g. zooms of SparseImage) for all subjects, or one row of 3 values per subject
+# (None = distances in voxels); dtype: see confluence_segments.
+# Returns (one value per subject, None in 3D or an array subjects * slices in 2D)
+def confluence_many(coords_list, values_list, s, slice_axis=None, n_slices=None, tol=KERNEL_TOL, spacing=None, dtype=np.float64):
+    n_subjects = len(values_list)
+    subject = np.repeat(np.arange(n_subjects), [len(values) for values in values_list])
+    coords = np.concatenate([np.asarray(c, dtype=np.int64).reshape(-1, 3) for c in coords_list]) if n_subjects else np.zeros((0, 3), np.int64)
+    values = np.concatenate(values_list) if n_subjects else np.zeros(0)
+    if slice_axis is None:
+        segment, n_segments = subject, n_subjects
+    else:
+        if n_slices is None:
+            n_slices = int(coords[:, slice_axis].max()) + 1 if len(values) else 0
+        # One segment per slice of every subject
+        segment, n_segments = subject * n_slices + coords[:, slice_axis], n_subjects * n_slices
+    if spacing is not None:
+        # Coordinates in mm, with the voxel size of each voxel's subject
+        spacing = np.asarray(spacing, dtype=np.float64).reshape(-1, 3)
+        coords = coords * (spacing[subject] if len(spacing) > 1 else spacing)
+    confluence = confluence_segments(coords, values, segment, n_segments, s, tol=tol, dtype=dtype)
+    if slice_axis is None:
+        return confluence, None
+    confluence = confluence.reshape(n_subjects, n_slices)
+    return confluence.sum(axis=1), confluence
+
+
+# Function pair_sum_1d calculates sum over all index pairs (i, j) of one axis of length n (incl. i == j)
+# of exp(-s*(spacing*(i-j))^2); there are n-|d| pairs at distance d, so this is a sum over d only
+@lru_cache(maxsize=None)
+def pair_sum_1d(n, s, spacing=1.0):
+    d = np.arange(-(n - 1), n)
+    return float(np.sum((n - np.abs(d)) * np.exp(-s * (spacing * d)**2)))
+
+
+# Function max_confluence_norm calculates the maximum possible value of confluence/volume for a given
+# matrix shape, i.e. the value for an image where every voxel is a WMH (value 1). Confluence metrics
+# divided by volume and by this value are between 0 and 1.
+# For the all-ones image, sum over all ordered pairs of the kernel = product of the 1D pair sums of
+# each axis (the kernel is separable); remove the N pairs of a voxel with itself and halve.
+# For 2D (per slice) pass the shape of a slice, e.g. image.shape[:2]. Examples (s = 0.05):
+# 192*256 -> 30.20349728 (the old constant of the 2D scripts), 192*256*256 -> 240.497 (3D scripts)
+def max_confluence_norm(shape, s, spacing=None):
+    shape = tuple(int(n) for n in shape)
+    if spacing is None:
+        spacing = (1.0,) * len(shape)
+    # Cached per (shape, s, spacing), so this is only calculated once per matrix size
+    return _max_confluence_norm(shape, float(s), tuple(float(h) for h in spacing))
+
+
+@lru_cache(maxsize=None)
+def _max_confluence_norm(shape, s, spacing):
+    n_voxels = float(np.prod(shape))
+    all_pairs = np.prod([pair_sum_1d(n, s, h) for n, h in zip(shape, spacing)])
+    return 0.5 * (all_pairs - n_voxels) / n_voxels
+
+
+# Function summarise_slices calculates the per-subject metrics of the 2D scripts from the per-slice
+# confluence metrics (None/NaN for slices without WMH voxels), sums of voxel values (volume) and numbers of
+# WMH voxels (voxels): sum of confluence, sum of volume, sum of confluence/volume over slices, number of slices
+# with at least 2 WMH voxels, and the scaled metric (between 0 and 1) = confluence_norm/(max_norm*nonzero_slices).
+# Intentional change from the original scripts, which counted slices with confluence > 0: there, a slice whose WMH
+# voxels are all far apart (exp(-s*d^2) underflows to 0, d > about 122 voxels at s = 0.05) was not counted, and
+# here the engines drop pairs with kernel < tol, so confluence > 0 would depend on the engine; counting from the
+# number of WMH voxels counts every slice with at least one pair, whatever the distances
+def summarise_slices(confluence, volume, max_norm, voxels):
+    confluence = np.asarray(confluence, dtype=np.float64)
+    volume = np.asarray(volume, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        confluence_norm = np.nansum(confluence / volume)
+        nonzero_slices = np.sum(np.asarray(voxels) >= 2)
+        confluence_scaled = confluence_norm / (np.float64(max_norm) * nonzero_slices)
+    return {'confluence': np.nansum(confluence), 'volume': volume.sum(), 'confluence_norm': confluence_norm,
+            'nonzero_slices': int(nonzero_slices), 'max_confluence_norm': max_norm, 'confluence_scaled': confluence_scaled}
+
+
+# Function summarise_volume calculates the per-subject metrics of the 3D scripts: confluence/volume and
+# the scaled metric (between 0 and 1) = confluence_norm/max_norm
+def summarise_volume(confluence, volume, max_norm):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        confluence_norm = np.float64(confluence) / np.float64(volume)
+    return {'confluence': confluence, 'volume': volume, 'confluence_norm': confluence_norm,
+            'max_confluence_norm': max_norm, 'confluence_scaled': confluence_norm / max_norm}
+
+
+# Function relative_deviation measures how far a result (e.g. of compact mode, dtype=np.float32) is from the float64
+# reference: |sum of result - sum of reference| / |sum of reference|, summed over slices (NaN = slice without WMH voxels)
+def relative_deviation(result, reference):
+    result, reference = float(np.nansum(result)), float(np.nansum(reference))
+    if reference == 0:
+        return abs(result)
+    return abs(result - reference) / abs(reference)
+
+
+# Function confluence_pairwise calculates the confluence metric by evaluating every pair of nonzero
+# voxels, like the original scripts did. Needs memory for N*N pairs (N = number of WMH voxels), so
+# only use it on small images, e.g. to check the other engines
+def confluence_pairwise(image, s, spacing=None):
+    image = np.asarray(image, dtype=np.float64)
+    coord = np.argwhere(image != 0)
+    vox_values = image[tuple(coord.T)]
+    coord = coord * np.array(axis_spacing(spacing, image.ndim))
+    # Only pairs below the diagonal, i.e. every pair once and no voxel with itself
+    row, col = np.tril_indices(len(vox_values), k=-1)
+    dist_sq = ((coord[row] - coord[col])**2).sum(axis=1)
+    return float(np.sum(vox_values[row] * vox_values[col] * np.exp(-s * dist_sq)))
@@ -0,0 +1,171 @@
+#################################################################################################
+#                          Confluence quantification - image loading                            #
+#################################################################################################
+
+# This module loads WMH segmentations without keeping the whole volume in memory as float64, like
+# nib.load(sub).get_fdata() does (about 100 MB for 192*256*256). The image is read through nibabel's
+# dataobj proxy in the data type of the file (optionally a slab of slices at a time), and only the
+# nonzero voxels are kept: their coordinates (uint16) and values (data type of the file if it has
+# 4 bytes or less, otherwise float32). For the filtering engines, dense() puts the WMH voxels back
+# into an array that only covers their bounding box. compact() stores the values in 1 byte for binary masks
+# and thresholded maps with whole-number values (compact mode of the scripts).
+# Voxel maps calculated from such an array (e.g. local confluence) go back into a SparseImage with sample(),
+# and are written as NIfTI with the affine of the input image by save_sparse, or in a background thread by MapWriter.
+
+import os
+import queue
+import threading
+
+import numpy as np
+import nibabel as nib
+
+from confluence_profile import stage
+
+
+class SparseImage:
+    # coords = (N, 3) array with voxel coordinates, values = N voxel values, shape = shape of the full
+    # image, affine and zooms (voxel size) from the NIfTI header
+    def __init__(self, coords, values, shape, affine=None, zooms=None):
+        self.coords = coords
+        self.values = values
+        self.shape = tuple(shape)
+        self.affine = affine
+        self.zooms = zooms
+
+    def __len__(self):
+        return len(self.values)
+
+    # Function compact returns the image with values as uint8 if they are all whole numbers 0 ... 255
+    # (e.g. binary masks), otherwise as float32
+    def compact(self):
+        values = self.values
+        if len(values) and np.all((values >= 0) & (values <= 255) & (values == np.round(values))):
+            values = values.astype(np.uint8)
+        elif values.dtype != np.uint8:
+            values = values.astype(np.float32)
+        return SparseImage(self.coords, values, self.shape, affine=self.affine, zooms=self.zooms)
+
+    # Function volume returns the number of WMH voxels (sum of voxel values), per slice along
+    # axis if axis is given
+    def volume(self, axis=None):
+        if axis is None:
+            return self.values.sum(dtype=np.float64)
+        return np.bincount(self.coords[:, axis], weights=self.values, minlength=self.shape[axis])
+
+    # Function voxels returns the number of nonzero voxels (whatever their value), per slice along axis if axis is given
+    def voxels(self, axis=None):
+        if axis is None:
+            return len(self)
+        return np.bincount(self.coords[:, axis], minlength=self.shape[axis])
+
+    # Function crop_start returns where the array that dense(crop_axes) returns starts in the full image
+    def crop_start(self, crop_axes=None):
+        start = [0] * len(self.shape)
+        if len(self):
+            for axis in (crop_axes if crop_axes is not None else []):
+                start[axis] = int(self.coords[:, axis].min())
+        return start
+
+    # Function dense returns the WMH voxels as a normal array: cropped to the bounding box of the WMH
+    # voxels along crop_axes (e.g. (0, 1) for the 2D scripts, so that all slices along axis 2 are
+    # kept; None = no cropping, full image), in data type dtype
+    def dense(self, crop_axes=None, dtype=np.float64):
+        start = self.crop_start(crop_axes)
+        shape = list(self.shape)
+        for axis in (crop_axes if crop_axes is not None else []):
+            shape[axis] = int(self.coords[:, axis].max()) - start[axis] + 1 if len(self) else 0
+        image = np.zeros(shape, dtype=dtype)
+        if len(self):
+            image[tuple((self.coords - np.array(start, dtype=np.int64)).T)] = self.values
+        return image
+
+    # Function sample returns the values of array at the WMH voxels, as a SparseImage with the same voxels, shape
+    # and affine; array has the shape of dense(crop_axes) (e.g. a voxel map calculated from it)
+    def sample(self, array, crop_axes=None):
+        start = np.array(self.crop_start(crop_axes), dtype=np.int64)
+        values = np.asarray(array)[tuple((self.coords - start).T)]
+        return SparseImage(self.coords, values, self.shape, affine=self.affine, zooms=self.zooms)
+
+
+# Function load_sparse loads the nonzero voxels of a NIfTI image.
+# slab_size = number of slices (along the last axis) that are read at once, None = whole image at
+# once (still in the data type of the file, not float64)
+def load_sparse(path, slab_size=None):
+    with stage('load'):
+        img = nib.load(path, keep_file_open=True)
+        proxy = img.dataobj
+    shape = proxy.shape[:3]
+    coord_dtype = np.uint16 if max(shape) < 2**16 else np.uint32
+    if slab_size is None:
+        slab_size = shape[2]
+    coords = []
+    values = []
+    for z in range(0, shape[2], slab_size):
+        with stage('load'): # Reading (and decompressing) the file
+            slab = np.asarray(proxy[:, :, z:z + slab_size])
+        with stage('extract'):
+            if slab.ndim > 3: # 4D image with one volume
+                slab = slab.reshape(slab.shape[:3])
+            nonzero = np.nonzero(slab)
+            slab_values = slab[nonzero]
+            if slab_values.dtype.itemsize > 4:
+                slab_values = slab_values.astype(np.float32)
+            slab_coords = np.empty((len(slab_values), 3), dtype=coord_dtype)
+            slab_coords[:, 0] = nonzero[0]
+            slab_coords[:, 1] = nonzero[1]
+            slab_coords[:, 2] = nonzero[2] + z
+            coords.append(slab_coords)
+            values.append(slab_values)
+            del slab
+    img.uncache()
+    with stage('extract'):
+        return SparseImage(np.concatenate(coords), np.concatenate(values), shape,
+                           affine=img.affine, zooms=tuple(float(h) for h in img.header.get_zooms()[:3]))
+
+
+# Function save_sparse writes a SparseImage as NIfTI image (full matrix size, 0 outside the WMH voxels, data type dtype)
+# with its affine; written to a temporary file first, so there is never a half-written image at path
+def save_sparse(sparse, path, dtype=np.float32):
+    img = nib.Nifti1Image(sparse.dense(dtype=dtype), sparse.affine)
+    tmp = os.path.join(os.path.dirname(path), '.tmp_' + os.path.basename(path)) # Same extension, so nibabel compresses .gz
+    nib.save(img, tmp)
+    os.replace(tmp, path)
+
+
+class MapWriter:
+    # Writes voxel maps (SparseImage, e.g. local confluence of every WMH voxel) as NIfTI files to out_dir in a
+    # background thread, so collecting results from the workers doesn't wait for compression and disk.
+    # max_pending = number of maps that can wait to be written (write waits when there are more, so memory is limited);
+    # an error while writing is raised by the next call of write or close
+    def __init__(self, out_dir, max_pending=8):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # Function _run writes the maps in the queue until close puts None into it
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            if self.error is None: # After an error the remaining maps are dropped
+                try:
+                    save_sparse(*item)
+                except Exception as e:
+                    self.error = e
+
+    # Function write queues a map to be written to out_dir/filename (e.g. 'sub-01_local_confluence.nii.gz')
+    def write(self, filename, sparse):
+        if self.error is not None:
+            raise self.error
+        self.pending.put((sparse, os.path.join(self.out_dir, filename)))
+
+    # Function close waits until all queued maps are written
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,160 @@
+#################################################################################################
+#                           Confluence quantification - single lesions                          #
+#################################################################################################
+
+# This module splits a WMH segmentation into lesions (connected components) and calculates the
+# confluence metric per lesion, with the same kernel exp(-s*d^2) as calculate_confluence:
+# - self-confluence of a lesion = sum of v_a*v_b*exp(-s*d^2) over pairs of voxels within the lesion
+# - confluence between two lesions = sum over pairs with one voxel in each lesion
+# The confluence of the whole image is the sum of all self-confluences plus the confluence between
+# all pairs of lesions. Instead of running the pairwise calculation once per lesion, the image is
+# filtered once (sum over all other voxels, for every voxel), and the pairs of voxels in different
+# lesions that are closer than the kernel cutoff are found with one KD-tree over all voxels and summed
+# per pair of lesions; self-confluence is what is left. With spacing (voxel size per axis, e.g. zooms
+# from the NIfTI header), distances are in mm.
+# Results are a lesion table (one row per lesion) and a table of lesion pairs, e.g.:
+#   lesions, pairs = quantify_lesions(image, s=0.05)
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+from confluence_engine import KERNEL_TOL, MAX_PAIRS, axis_spacing, count_neighbours, gaussian_filter
+
+
+# Function label_lesions labels connected WMH voxels (nonzero voxels of image) with numbers 1, 2, ...
+# connectivity = 1: voxels are connected if they share a face, 2: face or edge, 3: face, edge or corner;
+# slice_axis = None: lesions in 3D; 0, 1 or 2: lesions within each slice along that axis (for the 2D metric).
+# Returns (labels, number of lesions)
+def label_lesions(image, slice_axis=None, connectivity=3):
+    structure = ndimage.generate_binary_structure(image.ndim, connectivity)
+    if slice_axis is not None:
+        # No connections between neighbouring slices
+        neighbours = [slice(None)] * image.ndim
+        neighbours[slice_axis] = [0, 2]
+        structure[tuple(neighbours)] = False
+    return ndimage.label(image != 0, structure=structure)
+
+
+# Function cross_confluence calculates the sum of v_a*v_b*exp(-s*d^2) over all pairs of voxels a (coords_a, values_a)
+# and b (coords_b, values_b) that are at most cutoff apart, separately for every group of the b voxels
+# (group_b = group number 0 ... n_groups - 1 of every b voxel), at most about MAX_PAIRS pairs at once.
+# tree_b = KD-tree over coords_b if there already is one (e.g. kept from an earlier calculation), None = build it
+def cross_confluence(coords_a, values_a, coords_b, values_b, group_b, n_groups, s, cutoff, tree_b=None):
+    if tree_b is None:
+        tree_b = cKDTree(coords_b)
+    neighbours = max(1.0, count_neighbours(tree_b, coords_a, cutoff))
+    chunk_size = max(1, int(MAX_PAIRS / neighbours))
+    confluence = np.zeros(n_groups)
+    for start in range(0, len(values_a), chunk_size):
+        chunk = cKDTree(coords_a[start:start + chunk_size])
+        pairs = chunk.sparse_distance_matrix(tree_b, cutoff, output_type='ndarray')
+        first = pairs['i'] + start
+        second = pairs['j']
+        dist_sq = ((coords_a[first] - coords_b[second])**2).sum(axis=1)
+        contribution = values_a[first] * values_b[second] * np.exp(-s * dist_sq)
+        confluence += np.bincount(group_b[second], weights=contribution, minlength=n_groups)
+    return confluence
+
+
+# Function lesion_pairs calculates the confluence between every pair of lesions from one KD-tree over all voxels:
+# all pairs of voxels at most cutoff apart (positions = coordinates in the units of the kernel), at most about
+# MAX_PAIRS at once, of which only pairs with voxels in different lesions (lesion = label of every voxel) are kept
+# and summed per pair of labels. Returns (label a, label b, confluence) with label a < label b, sorted by label a, b
+def lesion_pairs(positions, values, lesion, n_lesions, s, cutoff):
+    keys, sums = [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+    if len(values) > 1:
+        tree = cKDTree(positions)
+        neighbours = max(1.0, count_neighbours(tree, positions, cutoff))
+        chunk_size = max(1, int(MAX_PAIRS / neighbours))
+        for start in range(0, len(values), chunk_size):
+            chunk = cKDTree(positions[start:start + chunk_size])
+            pairs = chunk.sparse_distance_matrix(tree, cutoff, output_type='ndarray')
+            first = pairs['i'] + start
+            second = pairs['j']
+            keep = lesion[first] < lesion[second] # Every pair of voxels in different lesions once
+            first, second = first[keep], second[keep]
+            dist_sq = ((positions[first] - positions[second])**2).sum(axis=1)
+            contribution = values[first] * values[second] * np.exp(-s * dist_sq)
+            # One number per pair of labels, summed within the chunk so that only one value per pair of lesions is kept
+            key, inverse = np.unique(lesion[first] * (n_lesions + 1) + lesion[second], return_inverse=True)
+            keys.append(key)
+            sums.append(np.bincount(inverse, weights=contribution, minlength=len(key)))
+    key, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    confluence = np.bincount(inverse, weights=np.concatenate(sums), minlength=len(key)).astype(np.float64)
+    return key // (n_lesions + 1), key % (n_lesions + 1), confluence
+
+
+# Function quantify_lesions calculates per-lesion confluence metrics of an image.
+# slice_axis = None: 3D lesions, like confluence_quant_3d.py; 0, 1 or 2: lesions and kernel within slices along
+# that axis, like confluence_quant_2d.py; connectivity: see label_lesions; offset = position of image[0, 0, 0]
+# in the full image (e.g. if image is cropped to the WMH voxels), added to the lesion centres;
+# spacing = voxel size of every axis of image (None = distances in voxels, lesion centres are always in voxels).
+# Returns two dataframes:
+# lesions = one row per lesion: Lesion (label), Slice (2D only), Voxels (number of voxels), Volume (sum of voxel values),
+#   Centre_x/y/z (centre of mass in voxels), Self_confluence, Self_confluence_norm (self-confluence/volume),
+#   Neighbour_confluence (confluence with all other lesions), Strongest_neighbour (label of the lesion with the
+#   highest confluence with this one, 0 if none is within the kernel cutoff) and Strongest_neighbour_confluence;
+# pairs = one row per pair of lesions within the kernel cutoff: Lesion_a, Lesion_b, Confluence
+def quantify_lesions(image, s, slice_axis=None, connectivity=3, offset=None, tol=KERNEL_TOL, spacing=None):
+    image = np.asarray(image)
+    labels, n_lesions = label_lesions(image, slice_axis, connectivity)
+    axes = tuple(a for a in range(image.ndim) if a != slice_axis)
+    cutoff = np.sqrt(-np.log(tol) / s)
+    spacing = np.array(axis_spacing(spacing, image.ndim))
+
+    # Voxels sorted by lesion, so that the voxels of lesion l are coords[first[l - 1]:first[l]]
+    flat = np.flatnonzero(labels)
+    lesion_flat = labels.ravel()[flat]
+    order = np.argsort(lesion_flat, kind='stable')
+    flat, lesion = flat[order], lesion_flat[order]
+    coords = np.stack(np.unravel_index(flat, image.shape), axis=1)
+    values = image.ravel()[flat].astype(np.float64)
+    positions = coords * spacing # Coordinates in the units of the kernel
+    first = np.searchsorted(lesion, np.arange(1, n_lesions + 2))
+
+    # Sum over all other voxels (of all lesions) for every voxel, from one filter pass:
+    # total[l] = 2 * self-confluence of l + confluence of l with all other lesions
+    others = gaussian_filter(image.astype(np.float64), s, axes=axes, tol=tol, spacing=spacing).ravel()[flat] - values
+    # (sums are cast to float64, bincount returns integers for an image without WMH voxels)
+    total = np.bincount(lesion, weights=values * others, minlength=n_lesions + 1)[1:].astype(np.float64)
+    volume = np.bincount(lesion, weights=values, minlength=n_lesions + 1)[1:].astype(np.float64)
+    n_voxels = np.diff(first)
+
+    # Confluence between lesions from all pairs of voxels in different lesions within the cutoff; in 2D, slices are
+    # moved so far apart that no pair across slices is within the cutoff (like in confluence_neighbours)
+    if slice_axis is not None:
+        positions[:, slice_axis] = coords[:, slice_axis] * (2 * cutoff + 1)
+    lesion_a, lesion_b, confluence = lesion_pairs(positions, values, lesion, n_lesions, s, cutoff)
+    close = confluence > 0
+    pairs = pd.DataFrame({'Lesion_a': lesion_a[close].astype(np.int64), 'Lesion_b': lesion_b[close].astype(np.int64),
+                          'Confluence': confluence[close]})
+
+    # Confluence with all other lesions and strongest neighbour, from the pairs (both directions)
+    pair_lesion = np.concatenate([pairs['Lesion_a'], pairs['Lesion_b']]).astype(np.int64)
+    pair_other = np.concatenate([pairs['Lesion_b'], pairs['Lesion_a']]).astype(np.int64)
+    pair_confluence = np.concatenate([pairs['Confluence'], pairs['Confluence']]).astype(np.float64)
+    neighbour = np.bincount(pair_lesion, weights=pair_confluence, minlength=n_lesions + 1)[1:].astype(np.float64)
+    strongest = np.zeros(n_lesions + 1, dtype=np.int64)
+    strongest_confluence = np.zeros(n_lesions + 1)
+    by_strength = np.argsort(pair_confluence, kind='stable') # Strongest pair last, so it is the one that is kept
+    strongest[pair_lesion[by_strength]] = pair_other[by_strength]
+    strongest_confluence[pair_lesion[by_strength]] = pair_confluence[by_strength]
+
+    self_confluence = np.maximum(0.5 * (total - neighbour), 0) # No negative values from rounding
+    self_confluence[n_voxels == 1] = 0 # Only rounding errors left for single voxels
+    centre = np.stack([np.bincount(lesion, weights=values * coords[:, a], minlength=n_lesions + 1)[1:]
+                       for a in range(image.ndim)], axis=1) / np.maximum(volume, np.finfo(float).tiny)[:, None]
+    if offset is not None:
+        centre = centre + np.asarray(offset, dtype=np.float64)
+    lesions = {'Lesion': np.arange(1, n_lesions + 1)}
+    if slice_axis is not None:
+        lesions['Slice'] = coords[first[:-1], slice_axis] + (offset[slice_axis] if offset is not None else 0)
+    lesions.update({'Voxels': n_voxels, 'Volume': volume})
+    for a, name in enumerate('xyz'[:image.ndim]):
+        lesions[f'Centre_{name}'] = centre[:, a]
+    lesions.update({'Self_confluence': self_confluence, 'Self_confluence_norm': self_confluence / volume,
+                    'Neighbour_confluence': neighbour, 'Strongest_neighbour': strongest[1:],
+                    'Strongest_neighbour_confluence': strongest_confluence[1:]})
+    return pd.DataFrame(lesions), pairs
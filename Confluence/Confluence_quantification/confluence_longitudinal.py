@@ -0,0 +1,247 @@
+#################################################################################################
+#                        Confluence quantification - longitudinal updates                       #
+#################################################################################################
+
+# This module updates the confluence metric of a subject from one timepoint to the next from the voxels
+# that changed (added, removed or with a different value), instead of calculating it from scratch.
+# With v = values at the previous timepoint and w = v + delta (delta nonzero only for changed voxels a):
+#   C(w) - C(v) = sum over changed a of delta_a * sum over all other voxels b of v_b*exp(-s*d^2)
+#               + sum over pairs of changed voxels a < b of delta_a*delta_b*exp(-s*d^2)
+# Only pairs with at least one changed voxel within the kernel cutoff are evaluated: the state keeps the voxel positions
+# in a KD-tree, which is only searched within the cutoff of each changed voxel, so the kernel part of the work grows with
+# the size of the change, not with the lesion load. Voxels added later are kept next to the tree until there are
+# many of them (see REBUILD_FRACTION), so the tree is not rebuilt for every timepoint. The changed voxels are found by
+# looking up the voxels of the new timepoint in the sorted voxel list of the previous one. E.g.:
+#   state = baseline_state(load_sparse(baseline_path), s=0.05)
+#   state, report = update_state(state, load_sparse(followup_path))
+#   report['confluence'], report['delta'], report['added'], ...
+# or for all timepoints of a subject at once: longitudinal_table([path_t0, path_t1, path_t2], s=0.05)
+
+import copy
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from confluence_engine import KERNEL_TOL, axis_spacing, confluence_2d, confluence_auto
+from confluence_io import load_sparse
+from confluence_lesions import cross_confluence
+
+REBUILD_FRACTION = 0.1 # The KD-tree is rebuilt when the voxels added since it was built are more than this fraction of the voxels in it
+
+
+class VoxelIndex:
+    # WMH voxels for the cutoff searches of update_state: a KD-tree over the voxels at the time it was built (flat = index in
+    # the full image, sorted; positions and group from kernel_positions; values at the current timepoint, 0 for voxels that are
+    # no longer WMH), and the voxels added since then (extra_*, sorted by flat index, searched without the tree)
+    def __init__(self, flat, values, positions, group):
+        self.flat = flat
+        self.values = values
+        self.positions = positions
+        self.group = group
+        self.tree = cKDTree(positions)
+        self.extra_flat = np.zeros(0, dtype=np.int64)
+        self.extra_values = np.zeros(0)
+        self.extra_positions = np.zeros((0, positions.shape[1]))
+        self.extra_group = np.zeros(0, dtype=np.int64)
+
+    # Function n_extra returns the number of voxels that are not in the tree
+    def n_extra(self):
+        return len(self.extra_flat)
+
+    # Function cross calculates, per group, the sum of w_a*v_b*exp(-s*d^2) over the voxels a (positions, weights) and all voxels b
+    # of the index at most cutoff apart (see cross_confluence)
+    def cross(self, positions, weights, n_groups, s, cutoff):
+        confluence = cross_confluence(positions, weights, self.positions, self.values, self.group, n_groups, s, cutoff, tree_b=self.tree)
+        if self.n_extra():
+            confluence += cross_confluence(positions, weights, self.extra_positions, self.extra_values, self.extra_group, n_groups, s, cutoff)
+        return confluence
+
+    # Function with_changes returns a new index (sharing the tree) with the values of the changed voxels (flat sorted, their
+    # new values, positions and group), voxels that are neither in the tree nor in the extra voxels are added to the extra voxels
+    def with_changes(self, flat, values, positions, group):
+        index = copy.copy(self)
+        index.values = self.values.copy()
+        in_tree, where = find_sorted(self.flat, flat)
+        index.values[where[in_tree]] = values[in_tree]
+        in_extra, where = find_sorted(self.extra_flat, flat)
+        index.extra_values = self.extra_values.copy()
+        index.extra_values[where[in_extra]] = values[in_extra]
+        new = ~in_tree & ~in_extra
+        extra_flat = np.concatenate([self.extra_flat, flat[new]])
+        order = np.argsort(extra_flat, kind='stable')
+        index.extra_flat = extra_flat[order]
+        index.extra_values = np.concatenate([index.extra_values, values[new]])[order]
+        index.extra_positions = np.concatenate([self.extra_positions, positions[new]])[order]
+        index.extra_group = np.concatenate([self.extra_group, group[new]])[order]
+        return index
+
+
+class ConfluenceState:
+    # Everything needed to update the metric of one timepoint: WMH voxels (flat = index in the full image,
+    # sorted; values as float64), confluence (3D value, or one value per slice along slice_axis with 0 for
+    # empty slices), error bound of the confluence, the parameters it was calculated with, number of WMH voxels
+    # per group (voxels, see n_groups) and the VoxelIndex of the voxels
+    def __init__(self, flat, values, confluence, error_bound, shape, s, slice_axis=None, spacing=None, tol=KERNEL_TOL,
+                 voxels=None, index=None):
+        self.flat = flat
+        self.values = values
+        self.confluence = confluence
+        self.error_bound = error_bound
+        self.shape = tuple(shape)
+        self.s = s
+        self.slice_axis = slice_axis
+        self.spacing = spacing
+        self.tol = tol
+        self.cutoff = np.sqrt(-np.log(tol) / s)
+        self.voxels = voxels
+        self.index = index
+        if voxels is None or index is None: # New state (or a new KD-tree): from all voxels
+            positions, group = kernel_positions(flat, self, self.cutoff)
+            if voxels is None:
+                self.voxels = np.bincount(group, minlength=self.n_groups())
+            if index is None:
+                self.index = VoxelIndex(flat, values, positions, group)
+
+    # Function n_groups returns the number of confluence values (1 in 3D, number of slices in 2D)
+    def n_groups(self):
+        return 1 if self.slice_axis is None else self.shape[self.slice_axis]
+
+
+# Function sorted_voxels returns the WMH voxels of a SparseImage as (flat index in the full image, float64 values),
+# sorted by flat index (load_sparse without slab_size already returns them in this order)
+def sorted_voxels(sparse):
+    flat = np.ravel_multi_index(tuple(np.asarray(sparse.coords, dtype=np.int64).T), sparse.shape)
+    values = np.asarray(sparse.values, dtype=np.float64)
+    if np.all(flat[1:] > flat[:-1]):
+        return flat, values
+    order = np.argsort(flat, kind='stable')
+    return flat[order], values[order]
+
+
+# Function find_sorted looks up the values keys in the sorted array sorted_flat. Returns (found = whether each key is
+# in sorted_flat, where = its position in sorted_flat, only meaningful where found)
+def find_sorted(sorted_flat, keys):
+    where = np.searchsorted(sorted_flat, keys)
+    found = where < len(sorted_flat)
+    found[found] = sorted_flat[where[found]] == keys[found]
+    return found, where
+
+
+# Function baseline_state calculates the confluence metric of the first timepoint from scratch (like the scripts:
+# slice_axis = None for 3D, or the axis along which slices are taken for 2D; engine: see confluence_auto).
+# spacing = voxel size (None = distances in voxels). Returns a ConfluenceState
+def baseline_state(sparse, s, slice_axis=None, spacing=None, engine='auto', tol=KERNEL_TOL):
+    flat, values = sorted_voxels(sparse)
+    if len(values) == 0:
+        confluence = np.zeros(1 if slice_axis is None else sparse.shape[slice_axis])
+    elif slice_axis is None:
+        image = sparse.dense(crop_axes=(0, 1, 2))
+        confluence = np.array([confluence_auto(image, s, engine=engine, tol=tol, spacing=spacing)])
+    else:
+        in_plane = tuple(a for a in range(3) if a != slice_axis)
+        image = sparse.dense(crop_axes=in_plane)
+        confluence = np.nan_to_num(confluence_2d(image, s, slice_axis=slice_axis, engine=engine, tol=tol,
+                                                 spacing=spacing)['confluence'])
+    # The filter leaves out pairs with kernel < tol, like the neighbour search with the same cutoff
+    error_bound = tol * 0.5 * (values.sum()**2 - np.sum(values**2))
+    return ConfluenceState(flat, values, confluence, error_bound, sparse.shape, s, slice_axis, spacing, tol)
+
+
+# Function kernel_positions turns flat voxel indices into positions in the units of the kernel, with slices moved
+# so far apart that no pair across slices is within the cutoff (2D). Returns (positions, slice of every voxel)
+def kernel_positions(flat, state, cutoff):
+    coords = np.stack(np.unravel_index(flat, state.shape), axis=1)
+    positions = coords * np.array(axis_spacing(state.spacing, len(state.shape)))
+    if state.slice_axis is None:
+        return positions, np.zeros(len(flat), dtype=np.int64)
+    group = coords[:, state.slice_axis]
+    positions[:, state.slice_axis] = group * (2 * cutoff + 1)
+    return positions, group
+
+
+# Function update_state calculates the metric of the next timepoint (SparseImage with the same matrix size) from
+# the voxels that changed since the timepoint of state.
+# Returns (new state, report) with report = dict: confluence and previous confluence (3D value, or per slice with NaN
+# for slices without WMH voxels), delta (new - previous, same shape), confluence_sum/delta_sum (summed over slices),
+# volume, volume_delta, added/removed/changed (number of voxels), error_bound (of the new confluence)
+def update_state(state, sparse):
+    if tuple(sparse.shape) != state.shape:
+        raise ValueError(f'Image has shape {tuple(sparse.shape)}, the previous timepoint {state.shape}')
+    s, n_groups, cutoff = state.s, state.n_groups(), state.cutoff
+    flat, values = sorted_voxels(sparse)
+
+    # Every voxel of the new timepoint looked up in the previous one: changed = new voxels with a different value
+    # (incl. added voxels, previous value 0) and previous voxels that are not there any more (removed, new value 0)
+    found, where = find_sorted(state.flat, flat)
+    kept = np.zeros(len(state.flat), dtype=bool)
+    kept[where[found]] = True
+    previous = np.zeros(len(flat))
+    previous[found] = state.values[where[found]]
+    differs = previous != values
+    changed_flat = np.concatenate([flat[differs], state.flat[~kept]])
+    old = np.concatenate([previous[differs], state.values[~kept]])
+    new = np.concatenate([values[differs], np.zeros(np.sum(~kept))])
+    order = np.argsort(changed_flat, kind='stable')
+    changed_flat, old, new = changed_flat[order], old[order], new[order]
+    delta = new - old
+    changed_positions, changed_group = kernel_positions(changed_flat, state, cutoff)
+
+    confluence_delta = np.zeros(n_groups)
+    if len(delta):
+        # Changed voxels with all voxels of the previous timepoint within the cutoff (searched in the KD-tree of the state),
+        # minus each changed voxel with itself (distance 0)
+        confluence_delta += state.index.cross(changed_positions, delta, n_groups, s, cutoff)
+        confluence_delta -= np.bincount(changed_group, weights=delta * old, minlength=n_groups)
+        # Pairs of changed voxels: all ordered pairs incl. each voxel with itself, so remove those and halve
+        changed_pairs = cross_confluence(changed_positions, delta, changed_positions, delta, changed_group, n_groups, s, cutoff)
+        confluence_delta += 0.5 * (changed_pairs - np.bincount(changed_group, weights=delta**2, minlength=n_groups))
+
+    confluence = state.confluence + confluence_delta
+    # Pairs beyond the cutoff that the update leaves out: kernel < exp(-s*cutoff^2)
+    error_bound = state.error_bound + np.exp(-s * cutoff**2) * np.sum(np.abs(delta)) * (np.sum(np.abs(state.values)) + np.sum(np.abs(delta)))
+    added, removed = old == 0, new == 0
+    voxels = (state.voxels + np.bincount(changed_group[added], minlength=n_groups)
+              - np.bincount(changed_group[removed], minlength=n_groups))
+    # Same tree with the new values, or a new tree if many voxels were added since it was built
+    index = state.index.with_changes(changed_flat, new, changed_positions, changed_group)
+    if index.n_extra() > REBUILD_FRACTION * len(index.flat):
+        index = None
+    new_state = ConfluenceState(flat, values, confluence, error_bound, state.shape, s, state.slice_axis, state.spacing, state.tol,
+                                voxels=voxels, index=index)
+
+    report = {'added': int(np.sum(added)), 'removed': int(np.sum(removed)), 'changed': int(np.sum(~added & ~removed)),
+              'volume': float(values.sum()), 'volume_delta': float(values.sum() - state.values.sum()),
+              'confluence_sum': float(confluence.sum()), 'delta_sum': float(confluence_delta.sum()),
+              'error_bound': float(error_bound)}
+    if state.slice_axis is None:
+        report.update({'confluence': float(confluence[0]), 'previous': float(state.confluence[0]), 'delta': float(confluence_delta[0])})
+    else:
+        # Slices without WMH voxels are NaN, like in the 2D scripts
+        report.update({'confluence': np.where(voxels > 0, confluence, np.nan),
+                       'previous': np.where(state.voxels > 0, state.confluence, np.nan), 'delta': confluence_delta})
+    return new_state, report
+
+
+# Function longitudinal_table calculates the metric for all timepoints of one subject (paths in order of time):
+# the first from scratch (see baseline_state), every further one from the change to the one before.
+# Returns a dataframe with one row per timepoint: Timepoint, Path, Confluence (summed over slices in 2D), Delta,
+# Volume, Volume_delta, Added, Removed, Changed, Error_bound
+def longitudinal_table(paths, s, slice_axis=None, physical_units=False, engine='auto', slab_size=None, tol=KERNEL_TOL):
+    rows = []
+    state = None
+    for timepoint, path in enumerate(paths):
+        sparse = load_sparse(path, slab_size=slab_size)
+        if state is None:
+            spacing = sparse.zooms if physical_units else None
+            state = baseline_state(sparse, s, slice_axis=slice_axis, spacing=spacing, engine=engine, tol=tol)
+            volume = float(state.values.sum())
+            rows.append({'Timepoint': timepoint, 'Path': path, 'Confluence': float(state.confluence.sum()), 'Delta': np.nan,
+                         'Volume': volume, 'Volume_delta': np.nan, 'Added': len(state.values), 'Removed': 0, 'Changed': 0,
+                         'Error_bound': float(state.error_bound)})
+            continue
+        state, report = update_state(state, sparse)
+        rows.append({'Timepoint': timepoint, 'Path': path, 'Confluence': report['confluence_sum'], 'Delta': report['delta_sum'],
+                     'Volume': report['volume'], 'Volume_delta': report['volume_delta'], 'Added': report['added'],
+                     'Removed': report['removed'], 'Changed': report['changed'], 'Error_bound': report['error_bound']})
+    return pd.DataFrame(rows)
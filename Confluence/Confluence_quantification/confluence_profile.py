@@ -0,0 +1,173 @@
+#################################################################################################
+#                          Confluence quantification - profiling                                #
+#################################################################################################
+
+# This module measures where the time (and memory) of a batch goes, per subject and per stage of the
+# quantification: load (reading the NIfTI file, incl. gzip decoding), extract (finding the WMH voxels,
+# building the array), kernel (confluence metric), volume, and aggregate (summaries and writing results).
+# The code of a stage is wrapped in  with stage('kernel'):  which does nothing unless the subject is run
+# with profiling on (one check per call), so it can stay in the scripts. To profile a batch:
+#   profile = CohortProfile()
+#   for sub, result in run_batch(quantify_subject, subjects, profile=profile):
+#       with profile.stage(sub, 'aggregate'):
+#           ... summarise and write the result ...
+#   profile.write('profile.json') # One record per subject and a summary of the cohort
+# Stages can't be nested. Time is wall time and CPU time; memory is the peak resident memory of the
+# (worker) process so far, and with trace_memory = True also the peak of memory allocated by Python
+# and numpy within each stage (tracemalloc, makes the calculation noticeably slower).
+
+import time
+import json
+import contextlib
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError: # Not available on Windows, resident memory is then not recorded
+    resource = None
+
+MB = 1024**2
+_current = None # SubjectProfile of the subject that is processed in this process (None = profiling off)
+_no_stage = contextlib.nullcontext()
+
+
+# Function max_rss returns the peak resident memory of this process so far in MB (None if unknown)
+def max_rss():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 / MB # ru_maxrss is in kB on Linux
+
+
+# Function stage returns a context manager that adds the time spent in it to stage name of the subject
+# that is being profiled, or that does nothing if profiling is off
+def stage(name):
+    if _current is None:
+        return _no_stage
+    return _current.stage(name)
+
+
+class SubjectProfile:
+    # Times (and memory) of the stages of one subject; a stage that is entered several times
+    # (e.g. load and extract for every slab of an image) is added up
+    def __init__(self, sub, trace_memory=False):
+        self.sub = sub
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            traced = tracemalloc.get_traced_memory()[0]
+        start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            entry = self.stages.setdefault(name, {'time': 0.0, 'cpu_time': 0.0, 'calls': 0})
+            entry['time'] += time.perf_counter() - start
+            entry['cpu_time'] += time.process_time() - cpu_start
+            entry['calls'] += 1
+            if self.trace_memory:
+                peak = (tracemalloc.get_traced_memory()[1] - traced) / MB
+                entry['peak_memory_mb'] = max(entry.get('peak_memory_mb', 0.0), peak)
+
+    # Function record returns the record of this subject (dict, can be sent between processes and written as JSON)
+    def record(self):
+        return {'sub': self.sub, 'total_time': time.perf_counter() - self.start, 'max_rss_mb': max_rss(),
+                'stages': self.stages}
+
+
+class profiled:
+    # Wraps a per-subject function (e.g. quantify_subject) so that it runs with profiling on and returns
+    # (result, record); used by run_batch in the worker processes
+    def __init__(self, func, trace_memory=False):
+        self.func = func
+        self.trace_memory = trace_memory
+
+    def __call__(self, sub, **kwargs):
+        global _current
+        _current = SubjectProfile(sub, self.trace_memory)
+        if self.trace_memory:
+            tracemalloc.start()
+        try:
+            result = self.func(sub, **kwargs)
+            return result, _current.record()
+        finally:
+            if self.trace_memory:
+                tracemalloc.stop()
+            _current = None
+
+
+class CohortProfile:
+    # Collects the records of all subjects of a batch (see run_batch in confluence_batch.py).
+    # enabled = False: nothing is measured or collected, so scripts can always create one
+    def __init__(self, enabled=True, trace_memory=False):
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.records = {}
+
+    # Function add stores the record of a subject (from a worker process)
+    def add(self, record):
+        self.records[record['sub']] = record
+
+    # Function stage times a stage of a subject that runs in this process (e.g. aggregate in the main loop)
+    # and adds it to the record of that subject
+    @contextlib.contextmanager
+    def stage(self, sub, name):
+        if not self.enabled:
+            yield
+            return
+        start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record = self.records.setdefault(sub, {'sub': sub, 'total_time': 0.0, 'max_rss_mb': None, 'stages': {}})
+            entry = record['stages'].setdefault(name, {'time': 0.0, 'cpu_time': 0.0, 'calls': 0})
+            entry['time'] += time.perf_counter() - start
+            entry['cpu_time'] += time.process_time() - cpu_start
+            entry['calls'] += 1
+            record['total_time'] += time.perf_counter() - start
+
+    # Function table returns one row per subject: sub, total_time, max_rss_mb and time (and peak memory) of every stage
+    def table(self):
+        rows = []
+        for record in self.records.values():
+            row = {'sub': record['sub'], 'total_time': record['total_time'], 'max_rss_mb': record['max_rss_mb']}
+            for name, entry in record['stages'].items():
+                row[f'{name}_time'] = entry['time']
+                if 'peak_memory_mb' in entry:
+                    row[f'{name}_peak_memory_mb'] = entry['peak_memory_mb']
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    # Function summary returns the cohort summary: per column of table() the number of subjects, sum, mean,
+    # median, 90th/99th percentile and maximum, and the n_slowest subjects (total time) and the
+    # n_slowest subjects with the highest peak memory
+    def summary(self, n_slowest=5):
+        table = self.table()
+        if table.empty:
+            return {'n_subjects': 0, 'columns': {}, 'slowest': [], 'largest_memory': []}
+        columns = {}
+        for column in table.columns.drop('sub'):
+            values = table[column].dropna().to_numpy(dtype=np.float64)
+            if len(values):
+                columns[column] = {'n': len(values), 'sum': float(values.sum()), 'mean': float(values.mean()),
+                                   'p50': float(np.percentile(values, 50)), 'p90': float(np.percentile(values, 90)),
+                                   'p99': float(np.percentile(values, 99)), 'max': float(values.max())}
+        stage_columns = [c for c in table.columns if c.endswith('_time') and c != 'total_time']
+        slowest = table.nlargest(n_slowest, 'total_time')[['sub', 'total_time'] + stage_columns]
+        summary = {'n_subjects': len(table), 'columns': columns, 'slowest': slowest.to_dict('records'), 'largest_memory': []}
+        if table['max_rss_mb'].notna().any():
+            summary['largest_memory'] = table.nlargest(n_slowest, 'max_rss_mb')[['sub', 'max_rss_mb']].to_dict('records')
+        return summary
+
+    # Function write writes all records and the summary to a JSON file
+    def write(self, path, n_slowest=5):
+        if not self.enabled:
+            return
+        with open(path, 'w') as f:
+            json.dump({'summary': self.summary(n_slowest), 'subjects': list(self.records.values())}, f, indent=1, default=str)
@@ -6,91 +6,157 @@
 # This script takes WMH segmentations (binarized or non-binarized) and calculates a 
 # confluence metric for each subject
 
-# Changes you'll need to make so that script works with your paths/filenames: lines 59, 62 and 67
+# Changes you'll need to make so that script works with your paths/filenames: lines 108, 109, 110 and 112
 import numpy as np
-import pandas as pd
-import nibabel as nib
 import glob
-from functools import reduce
+from confluence_engine import confluence_2d, confluence_many, confluence_map, max_confluence_norm, relative_deviation, summarise_slices
+from confluence_batch import SubjectFailed
+from confluence_cache import run_cached_batch
+from confluence_writer import ResultWriter
+from confluence_io import MapWriter, load_sparse
+from confluence_lesions import quantify_lesions
+from confluence_profile import CohortProfile, stage
 
-# Function calculate_confluence calculates the metric for one slice
+# Function calculate_slices calculates the metric for all slices
 s = 0.05 # Defines width of Gaussian kernel, this was the optimal value in my tests
+# (to compare several values of s in one run, use sweep_cohort in confluence_sweep.py)
+slice_axis = 2 # Axis along which images are sliced (2 for axial slices in most images, e.g. 0 for sagittal acquisitions)
+engine = 'auto' # 'filter' (Gaussian filter), 'neighbours' (KD-tree search for very sparse WMH maps) or 'auto' (whichever is less work)
+physical_units = False # Kernel distances in mm from the voxel size in the image header, for anisotropic voxels (e.g. 1x1x3 mm; s is then per mm^2), False = in voxels
+compact = False # Values in 1 byte (binary masks, thresholded maps) and calculation in float32 instead of float64: half the memory, results differ by about 1e-7 (relative)
+compact_check = False # With compact = True, also calculate in float64 and write the relative deviation of the compact result (Compact_deviation column)
+small_load = 2000 # Subjects with at most this many WMH voxels are calculated from all pairs of WMH voxels at once, without building the image
+n_workers = None # Number of subjects processed in parallel (None = number of CPUs)
+memory_per_worker = None # Memory limit per parallel process in GB (None = no limit)
+slab_size = None # Number of slices read from an image file at once (None = whole image; smaller = less memory)
+cache_dir = None # Directory for cached results, so reruns only process new or changed images (None = no cache)
+cache_size = None # Size limit of the cache in GB, least recently used results are deleted (None = no limit)
+write_parquet = True # Also write result tables as Parquet files (needs pyarrow, otherwise only CSV with a warning)
+profile_path = None # JSON file for the time (and memory) of every stage (load, extract, kernel, volume, aggregate) per subject and a summary of all subjects (None = no profiling)
+lesion_table = False # Also calculate confluence per lesion (connected WMH voxels, per slice), written to confluence_2d_lesions.csv
+voxel_map = False # Also write the local confluence of every WMH voxel (its share of Confluence of its slice) as NIfTI with the affine of the input image to confluence_2d_maps/<Sub>_local_confluence.nii.gz (always uses the filter engine)
 
-def calculate_confluence(image,slice,s):
-    # Pick one 2D slice from 3D numpy array, convert into pandas dataframe:
-    slice_data = pd.DataFrame(image[:,:,slice]) 
-    # Use only slices with non-zero voxels, no need to process slices with no WMH voxels:
-    if slice_data.any(axis=None): 
-        # Create df with voxel coordinates and voxel values
-        coord = slice_data.stack().reset_index()
-        coord.columns =['x', 'y', 'vox_value'] 
-        # Delete all 0 voxels
-        coord = coord[coord['vox_value']!=0].reset_index() 
-        # Create df with products of elementwise multiplication (multiply every voxel with every voxel)
-        coord_vox_value = coord['vox_value'].to_numpy()
-        products = pd.DataFrame(coord_vox_value * coord_vox_value[:,None])
-        # Elementwise multiplication yields redundant values (a*b = b*a, a*a) -> set those to 0
-        products[:] = np.tril(products.values, k=-1)
-        equ_input = products.stack().reset_index()
-        equ_input.columns = ['row', 'col', 'product']
-        # Get rid of values that were set to 0
-        equ_input = equ_input[equ_input['product']!=0]
-        # Identify i, j, m and n coordinates that need to enter equation in next step
-        equ_input['i'] = coord.loc[equ_input['row'],'x'].to_numpy()
-        equ_input['j'] = coord.loc[equ_input['row'],'y'].to_numpy()
-        equ_input['m'] = coord.loc[equ_input['col'],'x'].to_numpy()
-        equ_input['n'] = coord.loc[equ_input['col'],'y'].to_numpy()
-        # Calculate all elements of confluence metric
-        equ_input['result'] = equ_input['product'] * np.exp(-s*(abs(equ_input['i']-equ_input['m'])**2 + abs(equ_input['j']-equ_input['n'])**2))
-        # Sum all elements to calculate confluence metric for the slice
-        confluence = equ_input['result'].sum()
-        return(confluence)
+def calculate_slices(image, s, spacing=None, dtype=np.float64):
+    # Sum of v_a*v_b*exp(-s*d^2) over all pairs of WMH voxels in each slice, computed by filtering all slices in-plane with
+    # the Gaussian kernel in one go, or only from pairs within the kernel cutoff (see confluence_engine.py); slices
+    # without WMH voxels are skipped (NaN); spacing = voxel size (None = distances in voxels); dtype = np.float32 in compact mode
+    slices = confluence_2d(image, s, slice_axis=slice_axis, engine=engine, spacing=spacing, dtype=dtype)
+    # Number of WMH voxels in each slice (sum of voxel values, and number of nonzero voxels), and how much too low confluence
+    # of each slice can be because pairs beyond the kernel cutoff are left out
+    return slices['confluence'], slices['volume'], slices['voxels'], slices['error_bound']
 
 
-# Function calculate_volume calculates the number of WMH voxels in a slice
-def calculate_volume(image,slice):
-    slice_data = pd.DataFrame(image[:,:,slice])
-    volume = slice_data.sum().sum()
-    return volume
-
-
-# Load images, run function calculate_confluence while looping through subjects and slices:
-base_dir = '/home/tanja/' # Change to your directory that contains images
-confluence_df = pd.DataFrame()
-volume_df = pd.DataFrame()
-for sub in glob.glob(base_dir + '*thr06.nii.gz'): # Change '*thr06*' to string that all image filenames contain
+# Function quantify_subject loads one image and calculates confluence metric and number of WMH voxels for all slices
+def quantify_subject(sub):
     print(sub)
-    # Load voxel values into 3D numpy array
-    image = nib.load(sub).get_fdata() 
-    # Get subject ID from filename -> adapt this so it works with your file names, replace '9_' and '_thr' with strings left and right of subject ID
-    sub_id = sub.split('9_', 1)[1].split('_thr',1)[0] 
-    # Loop through all slices in image, calculate confluence metric for each
-    confluence_list = [calculate_confluence(image, slice, s) for slice in range(image.shape[2])]
-    # Loop through all slices in image, calculate number of WMH voxels for each
-    volume_list = [calculate_volume(image, slice) for slice in range(image.shape[2])]
-    # Put confluence metric for all slices into dataframe with one column per subject, one row per slice
-    confluence_df[f'sub-{sub_id}'] = pd.DataFrame(confluence_list)
-    # Put number of WMH voxels for all slices into dataframe with one column per subject, one row per slice
-    volume_df[f'sub-{sub_id}'] = pd.DataFrame(volume_list)
+    # Load only the WMH voxels (in the data type of the file instead of float64) and put them into a 3D numpy array
+    # that covers the bounding box of the WMH voxels in-plane, with all slices
+    sparse = load_sparse(sub, slab_size=slab_size)
+    in_plane = tuple(a for a in range(3) if a != slice_axis)
+    spacing = sparse.zooms if physical_units else None
+    dtype = np.float32 if compact else np.float64
+    if compact:
+        sparse = sparse.compact()
+    local_map = None
+    if len(sparse) <= small_load and not voxel_map:
+        # Few WMH voxels: all slices from all pairs of WMH voxels in one vectorised step without building the image (see confluence_many),
+        # same values; NaN for slices without WMH voxels
+        with stage('kernel'):
+            confluence_slices = confluence_many([sparse.coords], [sparse.values], s, slice_axis=slice_axis, n_slices=sparse.shape[slice_axis],
+                                                 spacing=spacing, dtype=dtype)[1][0]
+            voxel_list = sparse.voxels(axis=slice_axis)
+            confluence_list = np.where(voxel_list > 0, confluence_slices, np.nan)
+        with stage('volume'):
+            volume_list = sparse.volume(axis=slice_axis)
+    else:
+        with stage('extract'):
+            image = sparse.dense(crop_axes=in_plane, dtype=dtype)
+        # Confluence metric and number of WMH voxels for all slices in image at once (number of WMH voxels comes with it)
+        with stage('kernel'):
+            if voxel_map:
+                # Local confluence of every voxel from the filtered slices, Confluence of a slice = sum over its voxels
+                local, confluence_slices = confluence_map(image, s, axes=in_plane, spacing=spacing, dtype=dtype)
+                voxel_list = np.count_nonzero(image, axis=in_plane)
+                confluence_list = np.where(voxel_list > 0, confluence_slices, np.nan)
+                volume_list = image.sum(axis=in_plane, dtype=np.float64)
+                local_map = sparse.sample(local, crop_axes=in_plane)
+            else:
+                confluence_list, volume_list, voxel_list, error_bound = calculate_slices(image, s, spacing, dtype)
+                if np.sum(error_bound) > 1e-6 * np.nansum(confluence_list):
+                    print(f'Subject {sub}: pairs of WMH voxels beyond the kernel cutoff were left out, confluence could be up to {np.sum(error_bound):.4g} too low')
+    # How far the compact result is from the calculation in float64 (calculates everything a second time)
+    deviation = None
+    if compact and compact_check:
+        deviation = relative_deviation(confluence_list, calculate_slices(sparse.dense(crop_axes=in_plane), s, spacing)[0])
+    # Maximum possible confluence/volume for a slice of this matrix size (value for a slice where every voxel is a WMH)
+    max_norm = max_confluence_norm(tuple(sparse.shape[a] for a in in_plane), s,
+                                   tuple(spacing[a] for a in in_plane) if spacing else None)
+    # Self-confluence of every lesion in every slice and confluence with neighbouring lesions (see confluence_lesions.py)
+    lesions = None
+    if lesion_table:
+        offset = None
+        if len(sparse): # Position of the bounding box in the full image
+            offset = [int(sparse.coords[:, a].min()) if a != slice_axis else 0 for a in range(3)]
+        with stage('lesions'):
+            lesions = quantify_lesions(sparse.dense(crop_axes=in_plane), s, slice_axis=slice_axis, offset=offset,
+                                       spacing=spacing)[0].to_dict('list')
+    return confluence_list, volume_list, voxel_list, max_norm, lesions, deviation, local_map
 
-# Output so far: confluence_df and volume_df = dataframes with one column per subject and one row per slice,
-# containing the confluence metric for that slice and the number of WMH voxels
 
-# For each slice, normalize confluece metric by dividing it by number of WMH voxels in that slice
-conf_norm = confluence_df/volume_df
+if __name__ == '__main__':
+    # Load images, run function calculate_confluence while looping through subjects and slices:
+    base_dir = '/home/tanja/' # Change to your directory that contains images
+    out_dir = '/home/tanja/confluence_results/' # Change to your directory where result tables are written
+    subjects = glob.glob(base_dir + '*thr06.nii.gz') # Change '*thr06*' to string that all image filenames contain
+    # Get subject ID from filename -> adapt this so it works with your file names, replace '9_' and '_thr' with strings left and right of subject ID
+    sub_ids = {sub: 'sub-' + sub.split('9_', 1)[1].split('_thr',1)[0] for sub in subjects}
 
-# Calculate sums across all slices for each subject, create dataframe
-conf_sum = pd.DataFrame({'Sub': confluence_df.sum().index, 'Confluence_sum': confluence_df.sum().values})
-vol_sum = pd.DataFrame({'Sub': volume_df.sum().index, 'Volume_sum': volume_df.sum().values})
-conf_norm_sum = pd.DataFrame({'Sub': conf_norm.sum().index, 'Confluence_norm_sum': conf_norm.sum().values})
-slice_count = confluence_df.apply(lambda x: (x > 0).sum())
-slice_count_df = pd.DataFrame({'Sub': confluence_df.columns, 'Nonzero_slices': slice_count}).reset_index(drop=True)
+    # Results are written to out_dir as soon as a subject is finished: confluence_2d.csv (one row per subject)
+    # and confluence_2d_slices.csv (one row per slice), and confluence_2d_lesions.csv (one row per lesion, if lesion_table = True);
+    # if the script was stopped, subjects already in there are skipped
+    writer = ResultWriter(out_dir, 'confluence_2d', 'Sub', parquet=write_parquet)
+    # Local confluence maps are written in a background thread while the next results come in
+    maps = MapWriter(out_dir + 'confluence_2d_maps/') if voxel_map else None
+    # Time (and memory) of every stage of every subject, if profile_path is set
+    profile = CohortProfile(enabled=profile_path is not None)
+    todo = [sub for sub in subjects if sub_ids[sub] not in writer.done]
+    # Process subjects in parallel, results come back in the order in which subjects finish
+    for sub, result in run_cached_batch(quantify_subject, todo, cache_dir,
+                                        {'s': s, 'mode': '2d', 'slice_axis': slice_axis, 'physical_units': physical_units, 'lesions': lesion_table,
+                                         'compact': compact, 'compact_check': compact_check, 'voxel_map': voxel_map},
+                                        max_cache_size=cache_size, n_workers=n_workers, memory_per_worker=memory_per_worker,
+                                        profile=profile):
+        if isinstance(result, SubjectFailed): # Error in this subject (e.g. a corrupt image), recorded in the _failed table
+            writer.fail(sub_ids[sub], result.error)
+            continue
+        confluence_list, volume_list, voxel_list, max_norm_val, lesions, deviation, local_map = result
+        with profile.stage(sub, 'aggregate'):
+            # Sums across all slices: confluence, number of WMH voxels, confluence normalized by number of WMH voxels in each slice,
+            # number of slices with at least 2 WMH voxels (not confluence > 0 like the original script, see summarise_slices); normalized with maximum possible confluence value per slice (30.20349728 for matrix size 192*256 and s = 0.05)
+            summary = summarise_slices(confluence_list, volume_list, max_norm_val, voxel_list)
+            row = {'Sub': sub_ids[sub], 'Confluence_sum': summary['confluence'], 'Volume_sum': summary['volume'],
+                   'Confluence_norm_sum': summary['confluence_norm'], 'Nonzero_slices': summary['nonzero_slices'],
+                   'Max_confluence_norm': summary['max_confluence_norm'], 'Confluence_norm_scaled': summary['confluence_scaled']}
+            if compact and compact_check:
+                row['Compact_deviation'] = deviation # Relative deviation of Confluence_sum from the float64 calculation
+            writer.write(row,
+                         {'Slice': list(range(len(confluence_list))), 'Confluence': confluence_list, 'Volume': volume_list},
+                         lesion_rows=lesions)
+            if voxel_map:
+                maps.write(f'{sub_ids[sub]}_local_confluence.nii.gz', local_map)
+    writer.close()
+    if voxel_map:
+        maps.close()
+    # Per-subject records and summary (percentiles, slowest subjects) of all stages
+    profile.write(profile_path)
 
-dfs = [conf_sum, vol_sum, conf_norm_sum, slice_count_df]
-confluence_final = reduce(lambda left,right: pd.merge(left,right,on=['Sub'],
-                                                how='inner'), dfs)
-confluence_final['Confluence_norm_scaled'] = confluence_final['Confluence_norm_sum']/(30.20349728*confluence_final['Nonzero_slices'])
+    # Read back table with all subjects, in the same order as a serial run
+    confluence_final = writer.read(order=[sub_ids[sub] for sub in subjects])
+    # lesions_final = dataframe with one row per lesion in every slice (Sub, Lesion, Slice, size, self-confluence,
+    # confluence with neighbouring lesions, see confluence_lesions.py)
+    if lesion_table:
+        lesions_final = writer.read_lesions()
 
 
-# confluence_final = dataframe with one row per subject, contains all metrics (I left everything in for sanity checks),
-# the relevant one is in the last column: Confluence_norm_scaled, this will be a value between 0 and 1
+    # confluence_final = dataframe with one row per subject, contains all metrics (I left everything in for sanity checks),
+    # the relevant one is in the last column: Confluence_norm_scaled, this will be a value between 0 and 1
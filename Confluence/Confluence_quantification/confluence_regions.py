@@ -0,0 +1,88 @@
+#################################################################################################
+#                          Confluence quantification - region masks                             #
+#################################################################################################
+
+# This module calculates confluence metrics of one whole-brain WMH segmentation separately within
+# several regions (e.g. deep and periventricular WM), by applying region masks in memory.
+# The segmentation is loaded once and all regions are filtered together in one pass (the masked
+# images, cut down to the bounding box of the WMH voxels, are stacked and filtered along the spatial
+# axes in one go), instead of writing one masked segmentation per region with fslmaths -mas and
+# loading each of them again.
+# More regions (e.g. lobar masks) are just more entries in the dict of masks.
+# split_regions instead splits the WMH voxels of a SparseImage into one SparseImage per region, for the 3D script,
+# which then calculates every region like a separate image (e.g. in slabs with memory_budget).
+
+import glob
+
+import numpy as np
+import nibabel as nib
+
+from confluence_engine import axis_spacing, confluence_sums, lesion_box, max_confluence_norm
+from confluence_io import SparseImage
+
+
+# Function find_region_masks finds the mask file of every region for a subject.
+# mask_patterns = dict region name -> glob pattern of the mask file, '{sub_id}' in the pattern is
+# replaced by the subject ID, e.g. {'d': '/data/sub-{sub_id}/ses-*/anat/*anat/*vent_d.nii.gz'}.
+# Returns dict region name -> path (None if no file matches)
+def find_region_masks(mask_patterns, sub_id):
+    masks = {}
+    for region, pattern in mask_patterns.items():
+        candidate = sorted(glob.glob(pattern.format(sub_id=sub_id)))
+        masks[region] = candidate[0] if candidate else None
+    return masks
+
+
+# Function load_region_masks loads one binary mask per region for a subject (see find_region_masks).
+# Raises FileNotFoundError if a mask is missing for this subject (in a batch, the subject is then recorded as failed, see run_batch)
+def load_region_masks(mask_patterns, sub_id):
+    masks = {}
+    for region, path in find_region_masks(mask_patterns, sub_id).items():
+        if path is None:
+            raise FileNotFoundError(f'No {region} mask found for subject {sub_id} ({mask_patterns[region]})')
+        masks[region] = np.asarray(nib.load(path).dataobj) > 0
+    return masks
+
+
+# Function split_regions returns dict region name -> SparseImage with the WMH voxels of sparse (see confluence_io.py)
+# that are inside the mask of that region (same shape as the image), without building the image
+def split_regions(sparse, masks):
+    regions = {}
+    for region, mask in masks.items():
+        if mask.shape != sparse.shape:
+            raise ValueError(f'Mask {region} has shape {mask.shape}, image has shape {sparse.shape}')
+        inside = mask[tuple(sparse.coords.T)]
+        regions[region] = SparseImage(sparse.coords[inside], sparse.values[inside], sparse.shape, affine=sparse.affine, zooms=sparse.zooms)
+    return regions
+
+
+# Function quantify_regions calculates confluence metric, number of WMH voxels and maximum possible
+# confluence/volume for every region, from one image and a dict region name -> mask (same shape as image).
+# slice_axis = None: 3D, one confluence value and one volume per region;
+# slice_axis = 0, 1 or 2: 2D, one value per slice along that axis (NaN for slices without WMH voxels,
+# like the 2D scripts which skip those slices). spacing = voxel size of every axis of image (None = distances in voxels).
+# Returns dict region name -> (confluence, volume, max_confluence_norm, number of WMH voxels)
+def quantify_regions(image, masks, s, slice_axis=None, spacing=None):
+    regions = list(masks)
+    for region in regions:
+        if masks[region].shape != image.shape:
+            raise ValueError(f'Mask {region} has shape {masks[region].shape}, image has shape {image.shape}')
+    spacing = axis_spacing(spacing, image.ndim)
+    if slice_axis is None:
+        axes = (1, 2, 3)
+        shape = image.shape
+    else:
+        axes = tuple(a + 1 for a in range(3) if a != slice_axis)
+        shape = tuple(n for a, n in enumerate(image.shape) if a != slice_axis)
+    # Image and masks cut down to the bounding box of the WMH voxels (in-plane in 2D, so there is still one value per
+    # slice), then one masked copy of the image per region, stacked along a new first axis: only the box is copied
+    box = lesion_box(image, [a - 1 for a in axes])
+    image = image[box]
+    stack = np.stack([np.where(masks[region][box], image, 0) for region in regions])
+    confluence = confluence_sums(stack, s, axes, spacing=(1.0,) + spacing)
+    volume = stack.sum(axis=axes, dtype=np.float64)
+    voxels = np.count_nonzero(stack, axis=axes)
+    if slice_axis is not None:
+        confluence = np.where(voxels > 0, confluence, np.nan)
+    max_norm = max_confluence_norm(shape, s, tuple(spacing[a - 1] for a in axes))
+    return {region: (confluence[r], volume[r], max_norm, voxels[r]) for r, region in enumerate(regions)}
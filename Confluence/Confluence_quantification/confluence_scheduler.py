@@ -0,0 +1,160 @@
+#################################################################################################
+#                          Confluence quantification - task scheduler                           #
+#################################################################################################
+
+# This module runs the steps of a preprocessing pipeline (e.g. fsl_anat -> make_bianca_mask -> flirt
+# -> pv/d split in WMH_segmentation_split.py) as a graph of tasks instead of one pass over all subjects
+# per step: a task starts as soon as the tasks it depends on are finished, up to n_workers at once, so
+# one slow fsl_anat doesn't hold up the other subjects. In addition:
+# - tasks whose outputs all exist and are newer than their inputs are skipped (rerun = only what's missing)
+# - a command that fails (return code != 0, exception, or outputs missing afterwards) is retried,
+#   and if it still fails, all tasks that depend on it are not run (status 'upstream_failed')
+# - every task is written to a JSON run log (status, attempts, return codes, wall times, error message)
+# Commands are lists of strings and are run without a shell, so FSL tools can be replaced by stub
+# executables for testing (see fsl_dir in WMH_segmentation_split.py).
+
+import os
+import json
+import time
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Task:
+    # name = unique name (e.g. 'sub-01/ses-1/fsl_anat'), action = command (list of strings, run as a separate
+    # process) or Python function (called without arguments), inputs/outputs = files the task reads/writes,
+    # deps = names of tasks that have to be finished first, retries = number of times a failed task is run again
+    def __init__(self, name, action, inputs=(), outputs=(), deps=(), retries=0):
+        self.name = name
+        self.action = action
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.retries = retries
+
+    # Function command returns the action as text (for printing and the run log)
+    def command(self):
+        if callable(self.action):
+            return getattr(self.action, 'func', self.action).__name__ # func = function of a functools.partial
+        return ' '.join(self.action)
+
+
+# Function up_to_date checks if all outputs exist and are newer than all inputs (that exist)
+def up_to_date(inputs, outputs):
+    if not outputs or not all(os.path.exists(path) for path in outputs):
+        return False
+    input_times = [os.path.getmtime(path) for path in inputs if os.path.exists(path)]
+    return not input_times or min(os.path.getmtime(path) for path in outputs) >= max(input_times)
+
+
+# Function run_task runs one task (with retries), returns its record for the run log
+def run_task(task, force=False):
+    record = {'task': task.name, 'command': task.command(), 'start': time.time(), 'attempts': []}
+    if not force and up_to_date(task.inputs, task.outputs):
+        record.update({'status': 'skipped', 'wall_time': 0.0, 'end': time.time()})
+        return record
+    for attempt in range(task.retries + 1):
+        start = time.perf_counter()
+        message = ''
+        try:
+            if callable(task.action):
+                task.action()
+                returncode = 0
+            else:
+                process = subprocess.run(task.action, capture_output=True, text=True)
+                returncode = process.returncode
+                message = process.stderr[-2000:] # Last part of the error output is usually the relevant one
+        except Exception as e: # Also e.g. executable not found
+            returncode = None
+            message = f'{type(e).__name__}: {e}'
+        missing = [path for path in task.outputs if not os.path.exists(path)]
+        if returncode == 0 and missing:
+            message = f'Outputs missing after the command finished: {missing}'
+        record['attempts'].append({'returncode': returncode, 'wall_time': time.perf_counter() - start, 'message': message})
+        if returncode == 0 and not missing:
+            break
+    success = returncode == 0 and not missing
+    record.update({'status': 'done' if success else 'failed', 'end': time.time(),
+                   'wall_time': sum(a['wall_time'] for a in record['attempts'])})
+    return record
+
+
+# Function check_graph checks that all dependencies exist and that there are no cycles
+def check_graph(tasks):
+    for task in tasks.values():
+        for dep in task.deps:
+            if dep not in tasks:
+                raise ValueError(f'Task {task.name} depends on unknown task {dep}')
+    # Remove tasks without (remaining) dependencies until none are left; if that gets stuck, there is a cycle
+    remaining = {name: set(task.deps) for name, task in tasks.items()}
+    while remaining:
+        free = [name for name, deps in remaining.items() if not deps]
+        if not free:
+            raise ValueError(f'Tasks depend on each other in a cycle: {sorted(remaining)}')
+        for name in free:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(free)
+
+
+# Function write_log writes the run log (JSON) in one go, so it is always complete
+def write_log(log_path, log):
+    tmp = f'{log_path}.tmp{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(log, f, indent=1)
+    os.replace(tmp, log_path)
+
+
+# Function run_tasks runs a list of tasks in order of their dependencies, up to n_workers at once
+# (None = number of CPUs). force = run tasks even if their outputs are up to date.
+# log_path = JSON file for the run log (None = no log), updated whenever a task finishes.
+# Returns dict task name -> record (status 'done', 'skipped', 'failed' or 'upstream_failed')
+def run_tasks(tasks, n_workers=None, log_path=None, force=False):
+    tasks = {task.name: task for task in tasks}
+    if len(tasks) == 0:
+        return {}
+    check_graph(tasks)
+    dependents = defaultdict(list)
+    for task in tasks.values():
+        for dep in task.deps:
+            dependents[dep].append(task.name)
+    waiting = {name: set(task.deps) for name, task in tasks.items()}
+    records = {}
+    log = {'start': time.time(), 'n_workers': n_workers, 'tasks': []}
+
+    def add_record(record):
+        records[record['task']] = record
+        log['tasks'].append(record)
+        print(f"{record['task']}: {record['status']} ({record['wall_time']:.1f} s)")
+
+    # Function cancel_dependents marks everything that depends (directly or not) on a failed task
+    def cancel_dependents(name):
+        for dependent in dependents[name]:
+            if dependent in waiting:
+                del waiting[dependent]
+                now = time.time()
+                add_record({'task': dependent, 'command': tasks[dependent].command(), 'start': now, 'end': now,
+                            'attempts': [], 'status': 'upstream_failed', 'failed_dependency': name, 'wall_time': 0.0})
+                cancel_dependents(dependent)
+
+    with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count()) as pool:
+        running = {}
+        while waiting or running:
+            for name in [name for name, deps in waiting.items() if not deps]:
+                del waiting[name]
+                running[pool.submit(run_task, tasks[name], force)] = name
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                add_record(future.result())
+                if records[name]['status'] in ('done', 'skipped'):
+                    for dependent in dependents[name]:
+                        if dependent in waiting:
+                            waiting[dependent].discard(name)
+                else:
+                    cancel_dependents(name)
+            if log_path is not None:
+                log['wall_time'] = time.time() - log['start']
+                write_log(log_path, log)
+    return records
@@ -0,0 +1,75 @@
+#################################################################################################
+#                       Confluence quantification - kernel width sweep                          #
+#################################################################################################
+
+# This module calculates the confluence metrics for a list of kernel widths s at once, e.g. to tune s.
+# Each image is loaded only once and cropped/transformed to the frequency domain only once, all
+# values of s share that (see confluence_sweep in confluence_engine.py).
+# Output is a tidy table with one row per subject and s, e.g.:
+#   s_values = [0.01, 0.02, 0.05, 0.1, 0.2]
+#   sweep_df = sweep_cohort(glob.glob(base_dir + '*thr06.nii.gz'), s_values, mode='2d')
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from confluence_engine import confluence_sweep, max_confluence_norm, summarise_slices, summarise_volume
+from confluence_batch import SubjectFailed, run_batch
+from confluence_io import load_sparse
+
+
+# Function sweep_subject loads one image and calculates the metrics for every s in s_values.
+# mode = '3d': one value per volume, like confluence_quant_3d.py;
+# mode = '2d': per slice along slice_axis and summed over slices, like confluence_quant_2d.py.
+# physical_units = True: distances in mm, from the voxel size in the image header (s per mm^2).
+# Returns a list of dicts (one per s) with the same metrics as the scripts
+def sweep_subject(sub, s_values, mode='3d', slice_axis=2, physical_units=False):
+    sparse = load_sparse(sub)
+    spacing = tuple(sparse.zooms) if physical_units else (1.0, 1.0, 1.0)
+    if mode == '3d':
+        image = sparse.dense(crop_axes=(0, 1, 2))
+        confluence = confluence_sweep(image, s_values, spacing=spacing)
+        volume = image.sum()
+        rows = []
+        for s, confluence_val in zip(s_values, confluence):
+            summary = summarise_volume(confluence_val, volume, max_confluence_norm(sparse.shape, s, spacing))
+            rows.append({'s': s, 'confluence': summary['confluence'], 'volume': summary['volume'],
+                         'confluence_norm': summary['confluence_norm'], 'confluence_norm_scaled': summary['confluence_scaled']})
+        return rows
+    if mode == '2d':
+        axes = tuple(a for a in range(3) if a != slice_axis)
+        shape = tuple(sparse.shape[a] for a in axes)
+        in_plane = tuple(spacing[a] for a in axes)
+        image = sparse.dense(crop_axes=axes)
+        confluence = confluence_sweep(image, s_values, axes=axes, spacing=spacing) # One row per s, one column per slice
+        volume = image.sum(axis=axes)
+        voxels = np.count_nonzero(image, axis=axes)
+        rows = []
+        for s, confluence_slices in zip(s_values, confluence):
+            # Slices without WMH voxels are left out of the sums, like in confluence_quant_2d.py
+            summary = summarise_slices(np.where(voxels > 0, confluence_slices, np.nan), volume, max_confluence_norm(shape, s, in_plane), voxels)
+            rows.append({'s': s, 'confluence': summary['confluence'], 'volume': summary['volume'],
+                         'confluence_norm': summary['confluence_norm'], 'nonzero_slices': summary['nonzero_slices'],
+                         'confluence_norm_scaled': summary['confluence_scaled']})
+        return rows
+    raise ValueError(f"mode has to be '2d' or '3d', not {mode!r}")
+
+
+# Function sweep_cohort runs sweep_subject for all subjects (in parallel, see confluence_batch.py) and
+# returns one tidy dataframe with columns sub, s and the metrics, one row per subject and s.
+# sub_id = function that gets the subject ID from the filename (default: filename without .nii.gz)
+def sweep_cohort(subjects, s_values, mode='3d', slice_axis=2, physical_units=False, sub_id=None, n_workers=None, memory_per_worker=None):
+    if sub_id is None:
+        sub_id = lambda sub: os.path.basename(sub).split('.nii', 1)[0]
+    subjects = list(subjects)
+    results = dict(run_batch(sweep_subject, subjects, n_workers=n_workers, memory_per_worker=memory_per_worker,
+                             s_values=list(s_values), mode=mode, slice_axis=slice_axis,
+                             physical_units=physical_units))
+    # Subjects that failed (see SubjectFailed in confluence_batch.py) have no rows
+    for sub in subjects:
+        if isinstance(results[sub], SubjectFailed):
+            print(f'Subject {sub} failed, left out: {results[sub].error}')
+    # Same order as subjects, independent of which subject finished first
+    rows = [{'sub': sub_id(sub), **row} for sub in subjects if not isinstance(results[sub], SubjectFailed) for row in results[sub]]
+    return pd.DataFrame(rows)
@@ -0,0 +1,156 @@
+#################################################################################################
+#                          Confluence quantification - result writer                            #
+#################################################################################################
+
+# This module writes results to disk while subjects finish, instead of collecting them in dataframes
+# and merging everything at the end: one table with one row per subject (<name>.csv) and one with one
+# row per slice (<name>_slices.csv, for the 2D scripts), optionally one with one row per lesion
+# (<name>_lesions.csv, see confluence_lesions.py). Rows are appended and flushed per subject,
+# so memory use doesn't grow with the number of subjects, and a run that is killed can be restarted:
+# subjects that are already in <name>.csv are in writer.done and can be skipped.
+# Subjects that failed or were skipped go to <name>_failed.csv with the reason (rewritten by every run, these
+# subjects are not done, so the next run tries them again), and their number is printed when the writer is closed.
+# When the writer is closed, all tables are also written as Parquet (<name>.parquet) if pyarrow is installed,
+# otherwise only the CSV tables are written.
+
+import os
+import csv
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # Only needed for Parquet output
+    pa = None
+
+
+# Function repair_csv prepares a table from an earlier (possibly killed) run for appending: removes a
+# half-written last line, and removes trailing rows whose ID is not in keep_ids (if given), i.e. slice
+# rows of a subject whose subject row was never written. Returns the IDs (first column) of all rows
+def repair_csv(path, keep_ids=None):
+    ids = []
+    with open(path, 'rb+') as f:
+        header = f.readline()
+        if not header.endswith(b'\n'): # Not even the header was written completely
+            f.truncate(0)
+            return ids
+        end = f.tell()
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            row_id = next(csv.reader([line.decode()]))[0]
+            if keep_ids is not None and row_id not in keep_ids:
+                break
+            ids.append(row_id)
+            end += len(line)
+        f.truncate(end)
+    return ids
+
+
+# Function csv_to_parquet converts a CSV table to Parquet in chunks, so it never has to be in memory at once
+def csv_to_parquet(csv_path, parquet_path, id_column, chunksize=100000):
+    writer = None
+    tmp = parquet_path + '.tmp'
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize, dtype={id_column: str}):
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(tmp, table.schema)
+        writer.write_table(table.cast(writer.schema))
+    if writer is not None:
+        writer.close()
+        os.replace(tmp, parquet_path)
+
+
+class ResultWriter:
+    # out_dir = directory for the tables, name = filename of the tables (without extension),
+    # id_column = name of the subject ID column (first column of both tables),
+    # parquet = also write the tables as Parquet when the writer is closed (ignored, with a warning, if pyarrow is not installed)
+    def __init__(self, out_dir, name, id_column, parquet=True):
+        if parquet and pa is None:
+            print(f'Warning: pyarrow is not installed (pip install pyarrow), {name} is only written as CSV, not as Parquet')
+            parquet = False
+        os.makedirs(out_dir, exist_ok=True)
+        self.id_column = id_column
+        self.parquet = parquet
+        self.subjects_path = os.path.join(out_dir, f'{name}.csv')
+        self.slices_path = os.path.join(out_dir, f'{name}_slices.csv')
+        self.lesions_path = os.path.join(out_dir, f'{name}_lesions.csv')
+        self.failed_path = os.path.join(out_dir, f'{name}_failed.csv')
+        # Continue where an earlier run stopped: subjects with a row in the subject table are done
+        self.done = set()
+        if os.path.exists(self.subjects_path):
+            self.done = set(repair_csv(self.subjects_path))
+        for path in [self.slices_path, self.lesions_path]:
+            if os.path.exists(path):
+                repair_csv(path, keep_ids=self.done)
+        if os.path.exists(self.failed_path):
+            os.remove(self.failed_path) # Failures of the earlier run, those subjects are tried again
+        self.failed = []
+        self.files = {}
+        self.writers = {}
+
+    # Function append writes rows (dict column -> list of values) to one of the tables
+    def append(self, path, rows):
+        if path not in self.files:
+            new = not os.path.exists(path) or os.path.getsize(path) == 0
+            self.files[path] = open(path, 'a', newline='')
+            self.writers[path] = csv.writer(self.files[path], lineterminator='\n')
+            if new:
+                self.writers[path].writerow(rows.keys())
+        columns = list(rows.values())
+        self.writers[path].writerows(zip(*columns))
+
+    # Function write writes the results of one subject: subject_row = dict column -> value (has to
+    # contain id_column), slice_rows = dict column -> list with one value per slice (optional),
+    # lesion_rows = dict column -> list with one value per lesion (optional).
+    # Slice and lesion rows are written before the subject row, so a subject counts as done only when all are written
+    def write(self, subject_row, slice_rows=None, lesion_rows=None):
+        sub_id = str(subject_row[self.id_column])
+        for path, rows in [(self.slices_path, slice_rows), (self.lesions_path, lesion_rows)]:
+            if rows is not None:
+                n_rows = len(next(iter(rows.values())))
+                self.append(path, {self.id_column: [sub_id] * n_rows, **rows})
+                self.files[path].flush()
+        self.append(self.subjects_path, {column: [value] for column, value in subject_row.items()})
+        self.files[self.subjects_path].flush()
+        self.done.add(sub_id)
+
+    # Function fail records a subject that has no results (e.g. the calculation raised an exception, see
+    # SubjectFailed in confluence_batch.py, or an input file is missing), reason = short description
+    def fail(self, sub_id, reason):
+        self.append(self.failed_path, {self.id_column: [str(sub_id)], 'Reason': [reason]})
+        self.files[self.failed_path].flush()
+        self.failed.append(str(sub_id))
+
+    def close(self):
+        if self.failed:
+            print(f'{len(self.failed)} subjects have no results, see {self.failed_path}')
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self.writers = {}
+        if self.parquet:
+            for path in [self.subjects_path, self.slices_path, self.lesions_path]:
+                if os.path.exists(path):
+                    csv_to_parquet(path, path[:-len('.csv')] + '.parquet', self.id_column)
+
+    # Function read returns the subject table (all subjects written so far, also by earlier runs).
+    # order = list of subject IDs: only these subjects, in this order (e.g. the order of a serial run)
+    def read(self, order=None):
+        if not os.path.exists(self.subjects_path):
+            return pd.DataFrame(columns=[self.id_column])
+        table = pd.read_csv(self.subjects_path, dtype={self.id_column: str})
+        if order is not None:
+            position = {sub_id: i for i, sub_id in enumerate(order)}
+            table = table[table[self.id_column].isin(position)]
+            table = table.sort_values(self.id_column, key=lambda ids: ids.map(position)).reset_index(drop=True)
+        return table
+
+    # Function read_slices returns the slice table
+    def read_slices(self):
+        return pd.read_csv(self.slices_path, dtype={self.id_column: str})
+
+    # Function read_lesions returns the lesion table
+    def read_lesions(self):
+        return pd.read_csv(self.lesions_path, dtype={self.id_column: str})
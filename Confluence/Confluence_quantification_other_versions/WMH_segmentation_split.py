@@ -32,119 +32,142 @@
 #################################################################################################################################################
 
 
+# All steps run as one graph of tasks per subject (see confluence_scheduler.py): fsl_anat -> make_bianca_mask ->
+# flirt T1 to FLAIR -> flirt ventricle mask to FLAIR -> pv/d split. Steps of different subjects run in parallel, a
+# step starts as soon as the steps it needs are finished, steps whose outputs are newer than their inputs are skipped,
+# failed steps are retried and the steps after them are not run. Status and wall time of every step are written
+# to log_path.
+
 import os
+import sys
 import glob
+from functools import partial
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+# Shared confluence functions live next to the main script in Confluence_quantification
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Confluence_quantification'))
+from confluence_scheduler import Task, run_tasks
 
 base_dir = '/home/ts887/rds/hpc-work/BIANCA/BIANCA_images/CUH_BIDS/' # Change to path containing your subject directories
-
-
-# Run fsl_anat on T1 images to create input necessary for make_bianca_mask
-for sub in glob.glob(base_dir + 'sub-*/ses-*/anat/'):
-    t1 = glob.glob(sub + '*rec-norm_T1w.nii.gz')[0].split('.nii.gz', 1)[0] # Change to string that identifies T1 images
-    com = 'fsl_anat --nosubcortseg -i ' + t1 # Create command
-    print(com) # Check command
-    res = os.system(com) # Run command in subshell
-
-
-# Create ventmask with make_bianca_mask and input from fsl_anat
-for anat in glob.glob(base_dir + 'sub-*/ses-*/anat/*T1w.anat/'):
-    t1_biascorr = glob.glob(anat + '*biascorr.nii.gz')[0].split('.nii.gz', 1)[0] # Change to string that identifies bias-corrected T1 images
-    pve = glob.glob(anat + '*pve_0.nii.gz')[0].split('.nii.gz', 1)[0] # Change to string that identifies CSF partial volume estimation
-    mni_to_t1_field = glob.glob(anat + '*MNI_to_T1_nonlin_field.nii.gz')[0].split('.nii.gz', 1)[0] # Change to string that identifies warp file
-    com = 'make_bianca_mask ' + t1_biascorr + ' ' + pve + ' ' + mni_to_t1_field + ' 0'
-    print(com)
-    res = os.system(com)
-
-
-# Register ventmask to FLAIR
-for sub in glob.glob(base_dir + 'sub-*/ses-*/anat/'):
-    flair_candidate = glob.glob(sub + '*rec-norm_FLAIR.nii.gz') # Change to string that identifies FLAIR image or whichever image was used for WMH segmentation
-    t1_candidate = glob.glob(sub + '*anat/T1.nii.gz') # Change to string that identifies T1 images
-    if flair_candidate and t1_candidate: # Check if all necessary files exist
-        flair = flair_candidate[0].split('.nii.gz', 1)[0]
-        t1 = t1_candidate[0].split('.nii.gz', 1)[0]
-        com = 'flirt -in ' + t1 + ' -ref ' + flair + ' -out ' + t1 + '_to_FLAIR -omat ' + t1 + '_to_FLAIR.mat -bins 256 -cost corratio -searchrx -90 90 -searchry -90 90 -searchrz -90 90 -dof 6  -interp nearestneighbour'
-        print(com)
-        res = os.system(com)
-    else:
-        print(f'No matching file found in {sub}')
-
-
-for sub in glob.glob(base_dir + 'sub-*/ses-*/anat/'):
-    flair_candidate = glob.glob(sub + '*rec-norm_FLAIR.nii.gz') # Change to string that identifies FLAIR image or whichever image was used for WMH segmentation
-    ventmask_candidate = glob.glob(sub + '*anat/*ventmask.nii.gz') # Change to string that identifies ventricle mask created by make_bianca_mask
-    mat_candidate = glob.glob(sub + '*anat/T1_to_FLAIR.mat') # Change to string that identifies transformation matrix from T1 to FLAIR space created in previous step
-    print(mat_candidate)
-    if flair_candidate and ventmask_candidate and mat_candidate:
-        flair = flair_candidate[0].split('.nii.gz', 1)[0]
-        ventmask = ventmask_candidate[0].split('.nii.gz', 1)[0]
-        mat = mat_candidate[0]
-        com = 'flirt -in ' + ventmask + '-applyxfm -init ' + mat + ' -out ' + ventmask + '_to_FLAIR ' + '-paddingsize 0.0 -interp nearestneighbour -ref ' + flair
-        print(com)
-        res = os.system(com)
-    else:
-        print(f'No matching file found in {sub}')
-
-
-# Run distancemap on post-registration ventricle masks, output: *dist_to_vent.nii.gz where intensity of each voxel represent its distance in mm from ventricles mask
-for sub in glob.glob(base_dir + 'sub-*/ses-*/anat/*T1w.anat/'):
-    ventmask_candidate = glob.glob(sub + '*ventmask_to_FLAIR.nii.gz') # Change to string that identifies post-registration ventricle mask
-    if ventmask_candidate:
-        ventmask = ventmask_candidate[0].split('.nii.gz', 1)[0]
-        com = 'distancemap -i ' + ventmask + ' -o ' + ventmask + '_dist_to_vent'
-        print(com)
-        res = os.system(com)
-    else:
-        print(f'No matching file found in {sub}')
-
-
-# Threshold distance map to create two separate maps (periventricular WM = within 5 voxels around ventricles, deep WM = outside of that)
-for sub in glob.glob(base_dir + 'sub-*/ses-*/anat/*T1w.anat/'):
-    distmap_candidate = glob.glob(sub + '*dist_to_vent.nii.gz') # Change to string that identifies distance map created in previous step
-    if distmap_candidate:
-        distmap = distmap_candidate[0].split('.nii.gz', 1)[0]
-        com = 'fslmaths ' + distmap + ' -uthr 5 -bin ' + distmap + '_pv'
-        print(com)
-        res = os.system(com)
-        com = 'fslmaths ' + distmap + ' -thr 5 -bin ' + distmap + '_d'
-        print(com)
-        res = os.system(com)
-    else:
-        print(f'No matching file found in {sub}')
-
-
-# Add periventricular WM mask to ventricle mask to create new pv WM mask (to make sure no WMH voxels at the very edge of ventricles are left out)
-for sub in glob.glob(base_dir + 'sub-*/ses-*/anat/*T1w.anat/'):
-    pv_candidate = glob.glob(sub + '*_vent_pv.nii.gz') # Change to string that identifies periventricular WM mask created in previous step
-    ventmask_candidate = glob.glob(sub + '*ventmask_to_FLAIR.nii.gz') # Change to string that identifies post-registration ventricle mask
-    if pv_candidate and ventmask_candidate:
-        pv = pv_candidate[0].split('.nii.gz', 1)[0]
-        ventmask = ventmask_candidate[0].split('.nii.gz',1)[0]
-        com = 'fslmaths ' + pv + ' -add ' + ventmask + ' ' + pv + '_full'
-        print(com)
-        res = os.system(com)
-    else:
-        print(f'No matching file found in {sub}')
-
-
-# Apply deep WM mask (d) and periventricular WM masks (pv) to BIANCA segmentation, or to the WMH segmentation that you have
-for sub in glob.glob(base_dir + 'sub-*/ses-*/anat/'):
+bianca_dir = '/home/ts887/rds/hpc-work/BIANCA/BIANCA_CUH_output/' # Change to path that contains whole-brain WMH segmentations
+t1_pattern = '*rec-norm_T1w.nii.gz' # Change to string that identifies T1 images
+flair_pattern = '*rec-norm_FLAIR.nii.gz' # Change to string that identifies FLAIR image or whichever image was used for WMH segmentation
+bianca_pattern = '*{id}_thr06.nii.gz' # Change to string that identifies whole-brain WMH segmentations ({id} = subject ID)
+pv_distance = 5 # Periventricular WM = up to this distance from the ventricles (in mm, like distancemap; = voxels for 1 mm voxels), deep WM = further
+write_masks = True # Also write masks for pv WM + ventricles (*vent_pv_full.nii.gz) and deep WM (*vent_d.nii.gz), needed for single_pass in the pvd scripts
+n_workers = 4 # Number of steps run at the same time (fsl_anat needs about 1 h and a few GB of memory per subject)
+retries = 1 # Number of times a failed step is run again
+force = False # Run all steps again, even if their outputs are newer than their inputs
+fsl_dir = None # Directory with the FSL executables (None = found via PATH, like in the shell); e.g. stub executables for testing
+log_path = base_dir + 'WMH_segmentation_split_log.json' # Run log with status and wall time of every step
+
+
+# Function fsl returns the command for an FSL tool
+def fsl(tool):
+    return os.path.join(fsl_dir, tool) if fsl_dir is not None else tool
+
+
+# Function split_masks creates the periventricular and deep WM masks from a ventricle mask: distance of every voxel from the
+# ventricles in mm (Euclidean, zooms = voxel size, like distancemap), pv = distance <= pv_distance (incl. the ventricles,
+# like fslmaths -uthr and -add with the ventricle mask), d = distance >= pv_distance (like fslmaths -thr)
+def split_masks(vent, zooms, pv_distance=5):
+    dist_to_vent = ndimage.distance_transform_edt(~vent, sampling=zooms)
+    return dist_to_vent <= pv_distance, dist_to_vent >= pv_distance
+
+
+# Function save_like writes an array as NIfTI image with affine and header (incl. data type) of img
+def save_like(data, img, path):
+    out = nib.Nifti1Image(data, img.affine, img.header)
+    out.set_data_dtype(data.dtype if data.dtype == np.uint8 else img.get_data_dtype())
+    nib.save(out, path)
+
+
+# Function split_segmentation splits WM into periventricular and deep and applies the masks to the BIANCA segmentation
+# (or to the WMH segmentation that you have). Same as distancemap on the post-registration ventricle mask, fslmaths
+# -uthr/-thr -bin on the distance map, fslmaths -add with the ventricle mask and fslmaths -mas on the segmentation,
+# but all steps are done in memory, only the results are written
+def split_segmentation(ventmask, bianca):
+    ventmask_img = nib.load(ventmask + '.nii.gz')
+    vent = np.asanyarray(ventmask_img.dataobj) > 0
+    if not vent.any():
+        raise ValueError(f'Empty ventricle mask {ventmask}')
+    bianca_img = nib.load(bianca + '.nii.gz')
+    wmh = bianca_img.get_fdata(dtype=np.float32)
+    if wmh.shape != vent.shape:
+        raise ValueError(f'Segmentation {bianca} has shape {wmh.shape}, ventricle mask has shape {vent.shape}')
+    pv, d = split_masks(vent, ventmask_img.header.get_zooms()[:3], pv_distance)
+    if write_masks:
+        save_like(pv.astype(np.uint8), ventmask_img, ventmask + '_dist_to_vent_pv_full.nii.gz')
+        save_like(d.astype(np.uint8), ventmask_img, ventmask + '_dist_to_vent_d.nii.gz')
+    save_like(np.where(pv, wmh, 0), bianca_img, bianca + '_pv.nii.gz')
+    save_like(np.where(d, wmh, 0), bianca_img, bianca + '_d.nii.gz')
+
+
+# Function subject_tasks creates the tasks for one subject directory (sub = .../sub-*/ses-*/anat/)
+def subject_tasks(sub):
+    name = sub[len(base_dir):].strip('/')
     id = sub.split('sub-')[-1].split('/ses')[0]
-    bianca_candidate = glob.glob(f'/home/ts887/rds/hpc-work/BIANCA/BIANCA_CUH_output/*{id}_thr06.nii.gz') # # Change to path that contains whole-brain WMH segmentations and to string that identifies them
-    pv_candidate = glob.glob(sub + '*anat/*vent_pv_full.nii.gz') # Change to string that identifies mask for periventricular WM + ventricles created in previous step
-    d_candidate = glob.glob(sub + '*anat/*vent_d.nii.gz') # Change to string that identifies mask for deep WM
-    if bianca_candidate and pv_candidate and d_candidate:
-        bianca = bianca_candidate[0].split('.nii.gz', 1)[0]
-        pv = pv_candidate[0].split('.nii.gz', 1)[0]
-        d = d_candidate.[0].split('.nii.gz', 1)[0]
-        com = 'fslmaths ' + bianca + ' -mas ' + pv + ' ' + bianca + '_pv'
-        print(com)
-        res = os.system(com)
-        com = 'fslmaths ' + bianca + ' -mas ' + d + ' ' + bianca + '_d'
-        print(com)
-        res = os.system(com)
-    else:
+    t1_candidate = glob.glob(sub + t1_pattern)
+    if not t1_candidate:
         print(f'No matching file found in {sub}')
+        return []
+    t1 = t1_candidate[0].split('.nii.gz', 1)[0]
+    # Files created by fsl_anat (in <T1 image>.anat/) and make_bianca_mask
+    anat = t1 + '.anat/'
+    t1_anat = anat + 'T1' # Cropped and reoriented T1
+    t1_biascorr = anat + 'T1_biascorr' # Bias-corrected T1
+    pve = anat + 'T1_fast_pve_0' # CSF partial volume estimation
+    mni_to_t1_field = anat + 'MNI_to_T1_nonlin_field' # Warp file MNI2structural
+    ventmask = t1_biascorr + '_ventmask'
+    tasks = [
+        # Run fsl_anat on T1 images to create input necessary for make_bianca_mask (--clobber: replace output of earlier failed runs)
+        Task(f'{name}/fsl_anat', [fsl('fsl_anat'), '--nosubcortseg', '--clobber', '-i', t1],
+             inputs=[t1 + '.nii.gz'], outputs=[t1_anat + '.nii.gz', t1_biascorr + '.nii.gz', pve + '.nii.gz', mni_to_t1_field + '.nii.gz'],
+             retries=retries),
+        # Create ventmask with make_bianca_mask and input from fsl_anat
+        Task(f'{name}/make_bianca_mask', [fsl('make_bianca_mask'), t1_biascorr, pve, mni_to_t1_field, '0'],
+             inputs=[t1_biascorr + '.nii.gz', pve + '.nii.gz', mni_to_t1_field + '.nii.gz'], outputs=[ventmask + '.nii.gz'],
+             deps=[f'{name}/fsl_anat'], retries=retries),
+    ]
+    flair_candidate = glob.glob(sub + flair_pattern)
+    if not flair_candidate:
+        print(f'No FLAIR image found in {sub}')
+        return tasks
+    flair = flair_candidate[0].split('.nii.gz', 1)[0]
+    tasks += [
+        # Register T1 to FLAIR
+        Task(f'{name}/flirt_t1_to_flair', [fsl('flirt'), '-in', t1_anat, '-ref', flair, '-out', t1_anat + '_to_FLAIR', '-omat', t1_anat + '_to_FLAIR.mat',
+                                           '-bins', '256', '-cost', 'corratio', '-searchrx', '-90', '90', '-searchry', '-90', '90',
+                                           '-searchrz', '-90', '90', '-dof', '6', '-interp', 'nearestneighbour'],
+             inputs=[t1_anat + '.nii.gz', flair + '.nii.gz'], outputs=[t1_anat + '_to_FLAIR.nii.gz', t1_anat + '_to_FLAIR.mat'],
+             deps=[f'{name}/fsl_anat'], retries=retries),
+        # Apply transformation matrix from T1 to FLAIR space to ventmask
+        Task(f'{name}/flirt_ventmask_to_flair', [fsl('flirt'), '-in', ventmask, '-applyxfm', '-init', t1_anat + '_to_FLAIR.mat', '-out', ventmask + '_to_FLAIR',
+                                                 '-paddingsize', '0.0', '-interp', 'nearestneighbour', '-ref', flair],
+             inputs=[ventmask + '.nii.gz', t1_anat + '_to_FLAIR.mat', flair + '.nii.gz'], outputs=[ventmask + '_to_FLAIR.nii.gz'],
+             deps=[f'{name}/make_bianca_mask', f'{name}/flirt_t1_to_flair'], retries=retries),
+    ]
+    bianca_candidate = glob.glob(bianca_dir + bianca_pattern.format(id=id))
+    if not bianca_candidate:
+        print(f'No WMH segmentation found for {sub}')
+        return tasks
+    bianca = bianca_candidate[0].split('.nii.gz', 1)[0]
+    outputs = [bianca + '_pv.nii.gz', bianca + '_d.nii.gz']
+    if write_masks:
+        outputs += [ventmask + '_to_FLAIR_dist_to_vent_pv_full.nii.gz', ventmask + '_to_FLAIR_dist_to_vent_d.nii.gz']
+    # Split WM into pv and d and apply the masks to the WMH segmentation
+    tasks.append(Task(f'{name}/split', partial(split_segmentation, ventmask + '_to_FLAIR', bianca),
+                      inputs=[ventmask + '_to_FLAIR.nii.gz', bianca + '.nii.gz'], outputs=outputs,
+                      deps=[f'{name}/flirt_ventmask_to_flair'], retries=retries))
+    return tasks
+
+
+if __name__ == '__main__':
+    tasks = [task for sub in sorted(glob.glob(base_dir + 'sub-*/ses-*/anat/')) for task in subject_tasks(sub)]
+    records = run_tasks(tasks, n_workers=n_workers, log_path=log_path, force=force)
+    failed = [name for name, record in records.items() if record['status'] == 'failed']
+    print(f'{len(records)} steps, {len(failed)} failed' + (f': {failed}' if failed else '') + f', log in {log_path}')
 
 
 # Images ending in *_pv.nii.gz and *_d.nii.gz are input on which we'll calculate confluence metric separately for periventricular and deep WM
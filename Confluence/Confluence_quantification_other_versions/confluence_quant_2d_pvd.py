@@ -6,95 +6,185 @@
 # This script takes WMH segmentations (binarized or non-binarized) and calculates a 
 # confluence metric for each subject, separately for deep and periventricular WM
 
-# Changes you'll need to make so that script works with your paths/filenames: lines 58, 66 and 70
+# Changes you'll need to make so that script works with your paths/filenames: lines 44, 45, 96, 105, 111, 112, 141, 143, 159 and 162
 
 import numpy as np
 import pandas as pd
-import nibabel as nib
 import glob
+import sys
+import os
+# Shared confluence functions live next to the main script in Confluence_quantification
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Confluence_quantification'))
+from confluence_engine import confluence_2d, confluence_many, max_confluence_norm, summarise_slices
+from confluence_batch import SubjectFailed
+from confluence_cache import run_cached_batch
+from confluence_writer import ResultWriter
+from confluence_io import load_sparse
+from confluence_regions import find_region_masks, load_region_masks, quantify_regions
+from confluence_profile import CohortProfile, stage
 from functools import reduce
 
-# Function calculate_confluence calculates the metric for one slice
+# Function calculate_slices calculates the metric for all slices
 s = 0.05 # Defines width of Gaussian kernel, this was the optimal value in my tests
-
-def calculate_confluence(image,slice,s):
-    # Pick one 2D slice from 3D numpy array, convert into pandas dataframe:
-    slice_data = pd.DataFrame(image[:,:,slice]) 
-    # Use only slices with non-zero voxels, no need to process slices with no WMH voxels:
-    if slice_data.any(axis=None): 
-        # Create df with voxel coordinates and voxel values
-        coord = slice_data.stack().reset_index()
-        coord.columns =['x', 'y', 'vox_value'] 
-        # Delete all 0 voxels
-        coord = coord[coord['vox_value']!=0].reset_index() 
-        # Create df with products of elementwise multiplication (multiply every voxel with every voxel)
-        coord_vox_value = coord['vox_value'].to_numpy()
-        products = pd.DataFrame(coord_vox_value * coord_vox_value[:,None])
-        # Elementwise multiplication yields redundant values (a*b = b*a, a*a) -> set those to 0
-        products[:] = np.tril(products.values, k=-1)
-        equ_input = products.stack().reset_index()
-        equ_input.columns = ['row', 'col', 'product']
-        # Get rid of values that were set to 0
-        equ_input = equ_input[equ_input['product']!=0]
-        # Identify i, j, m and n coordinates that need to enter equation in next step
-        equ_input['i'] = coord.loc[equ_input['row'],'x'].to_numpy()
-        equ_input['j'] = coord.loc[equ_input['row'],'y'].to_numpy()
-        equ_input['m'] = coord.loc[equ_input['col'],'x'].to_numpy()
-        equ_input['n'] = coord.loc[equ_input['col'],'y'].to_numpy()
-        # Calculate all elements of confluence metric
-        equ_input['result'] = equ_input['product'] * np.exp(-s*(abs(equ_input['i']-equ_input['m'])**2 + abs(equ_input['j']-equ_input['n'])**2))
-        # Sum all elements to calculate confluence metric for the slice
-        confluence = equ_input['result'].sum()
-        return(confluence)
-
-# Function calculate_volume calculates the number of WMH voxels in a slice
-def calculate_volume(image,slice):
-    slice_data = pd.DataFrame(image[:,:,slice])
-    volume = slice_data.sum().sum()
-    return volume
-
-
-# Load images, run function calculate_confluence while looping through subjects and slices:
-base_dir = '/home/ts887/rds/hpc-work/BIANCA/BIANCA_output/' # Change to your directory that contains images
-
-WM = ['d','pv'] # Deep and periventricular white matter; 
-# this assumes you have two sets of WMH segmentations, one ending in *_d.nii.gz for hyperintensities in deep WM 
-# and one ending in *_pv.nii.gz for periventricular WM; the script WMH_segmentation_split.py generates these
-# two sets of segmentations from normal whole-brain WMH segmentations
-
-input_dict = {}
-
-for wm in WM:
-    confluence_df = pd.DataFrame()
-    volume_df = pd.DataFrame()
-    for sub in glob.glob(base_dir + f'*thr06_{wm}.nii.gz'): # Change '*thr06*' to string that all image filenames contain
-        print(f'Processing subject {sub}')
-        image = nib.load(sub).get_fdata() 
+# (to compare several values of s in one run, use sweep_cohort in confluence_sweep.py)
+slice_axis = 2 # Axis along which images are sliced (2 for axial slices in most images, e.g. 0 for sagittal acquisitions)
+engine = 'auto' # 'filter' (Gaussian filter), 'neighbours' (KD-tree search for very sparse WMH maps) or 'auto' (whichever is less work)
+physical_units = False # Kernel distances in mm from the voxel size in the image header, for anisotropic voxels (e.g. 1x1x3 mm; s is then per mm^2), False = in voxels
+small_load = 2000 # Subjects with at most this many WMH voxels are calculated from all pairs of WMH voxels at once, without building the image
+n_workers = None # Number of subjects processed in parallel (None = number of CPUs)
+memory_per_worker = None # Memory limit per parallel process in GB (None = no limit)
+slab_size = None # Number of slices read from an image file at once (None = whole image; smaller = less memory)
+cache_dir = None # Directory for cached results, so reruns only process new or changed images (None = no cache)
+cache_size = None # Size limit of the cache in GB, least recently used results are deleted (None = no limit)
+write_parquet = True # Also write result tables as Parquet files (needs pyarrow, otherwise only CSV with a warning)
+profile_path = None # JSON file for the time (and memory) of every stage (load, extract, kernel, volume, aggregate) per subject and a summary of all subjects (None = no profiling)
+single_pass = False # True = load whole-brain segmentation once and apply the masks in mask_patterns in memory (False = use *_d/*_pv segmentations from WMH_segmentation_split.py)
+# Masks for single-pass mode, {sub_id} is replaced by the subject ID -> change to where WMH_segmentation_split.py wrote the masks;
+# add more entries (e.g. lobar masks) to calculate the metric for more regions in the same pass
+mask_patterns = {'d': '/home/ts887/rds/hpc-work/BIANCA/BIANCA_images/CUH_BIDS/sub-{sub_id}/ses-*/anat/*anat/*vent_d.nii.gz',
+                 'pv': '/home/ts887/rds/hpc-work/BIANCA/BIANCA_images/CUH_BIDS/sub-{sub_id}/ses-*/anat/*anat/*vent_pv_full.nii.gz'}
+
+def calculate_slices(image, s, spacing=None):
+    # Sum of v_a*v_b*exp(-s*d^2) over all pairs of WMH voxels in each slice, computed by filtering all slices in-plane with
+    # the Gaussian kernel in one go, or only from pairs within the kernel cutoff (see confluence_engine.py); slices
+    # without WMH voxels are skipped (NaN); spacing = voxel size (None = distances in voxels)
+    slices = confluence_2d(image, s, slice_axis=slice_axis, engine=engine, spacing=spacing)
+    # Number of WMH voxels in each slice (sum of voxel values, and number of nonzero voxels), and how much too low confluence
+    # of each slice can be because pairs beyond the kernel cutoff are left out
+    return slices['confluence'], slices['volume'], slices['voxels'], slices['error_bound']
+
+
+# Function quantify_subject loads one image and calculates confluence metric and number of WMH voxels for all slices
+def quantify_subject(sub):
+    print(f'Processing subject {sub}')
+    # Load only the WMH voxels (in the data type of the file instead of float64) and put them into a 3D numpy array
+    # that covers the bounding box of the WMH voxels in-plane, with all slices
+    sparse = load_sparse(sub, slab_size=slab_size)
+    in_plane = tuple(a for a in range(3) if a != slice_axis)
+    spacing = sparse.zooms if physical_units else None
+    if len(sparse) <= small_load:
+        # Few WMH voxels: all slices from all pairs of WMH voxels in one vectorised step without building the image (see confluence_many),
+        # same values; NaN for slices without WMH voxels
+        with stage('kernel'):
+            confluence_slices = confluence_many([sparse.coords], [sparse.values], s, slice_axis=slice_axis, n_slices=sparse.shape[slice_axis],
+                                                 spacing=spacing)[1][0]
+            voxel_list = sparse.voxels(axis=slice_axis)
+            confluence_list = np.where(voxel_list > 0, confluence_slices, np.nan)
+        with stage('volume'):
+            volume_list = sparse.volume(axis=slice_axis)
+    else:
+        with stage('extract'):
+            image = sparse.dense(crop_axes=in_plane)
+        # Confluence metric and number of WMH voxels for all slices in image at once (number of WMH voxels comes with it)
+        with stage('kernel'):
+            confluence_list, volume_list, voxel_list, error_bound = calculate_slices(image, s, spacing)
+        if np.sum(error_bound) > 1e-6 * np.nansum(confluence_list):
+            print(f'Subject {sub}: pairs of WMH voxels beyond the kernel cutoff were left out, confluence could be up to {np.sum(error_bound):.4g} too low')
+    max_norm = max_confluence_norm(tuple(sparse.shape[a] for a in in_plane), s,
+                                   tuple(spacing[a] for a in in_plane) if spacing else None)
+    return confluence_list, volume_list, max_norm, voxel_list
+
+
+# Function quantify_subject_regions loads one whole-brain segmentation and calculates the metric for every region in mask_patterns
+def quantify_subject_regions(sub):
+    print(f'Processing subject {sub}')
+    # Whole image (masks are applied to all voxels), but in float32 instead of float64
+    sparse = load_sparse(sub, slab_size=slab_size)
+    with stage('extract'):
+        image = sparse.dense(dtype=np.float32)
+    # Get subject ID from filename -> adapt this so it works with your file names, replace '9_' and '_thr' with strings left and right of subject ID
+    sub_id = sub.split('9_', 1)[1].split('_thr',1)[0]
+    with stage('load'):
+        masks = load_region_masks(mask_patterns, sub_id)
+    with stage('kernel'):
+        return quantify_regions(image, masks, s, slice_axis=slice_axis, spacing=sparse.zooms if physical_units else None)
+
+
+# Function mask_files returns the mask files of one subject (cached results are recomputed when they change)
+def mask_files(sub):
+    sub_id = sub.split('9_', 1)[1].split('_thr',1)[0]
+    return [path for path in find_region_masks(mask_patterns, sub_id).values() if path is not None]
+
+
+if __name__ == '__main__':
+    # Load images, run function calculate_confluence while looping through subjects and slices:
+    base_dir = '/home/ts887/rds/hpc-work/BIANCA/BIANCA_output/' # Change to your directory that contains images
+    out_dir = '/home/ts887/rds/hpc-work/BIANCA/confluence_results/' # Change to your directory where result tables are written
+
+    WM = ['d','pv'] # Deep and periventricular white matter; 
+    # this assumes you have two sets of WMH segmentations, one ending in *_d.nii.gz for hyperintensities in deep WM 
+    # and one ending in *_pv.nii.gz for periventricular WM; the script WMH_segmentation_split.py generates these
+    # two sets of segmentations from normal whole-brain WMH segmentations
+    # (with single_pass = True, the masks in mask_patterns are applied to the whole-brain segmentations instead,
+    # and there is one region, with its own tables, per entry of mask_patterns, e.g. also lobar masks)
+    if single_pass:
+        WM = list(mask_patterns)
+
+    # Results are written to out_dir as soon as a subject is finished, one table per region with one row per subject (confluence_2d_d.csv,
+    # confluence_2d_pv.csv) and one with one row per slice (*_slices.csv); if the script was stopped, subjects already in there are skipped
+    writers = {wm: ResultWriter(out_dir, f'confluence_2d_{wm}', 'WBIC_ID', parquet=write_parquet) for wm in WM}
+    # Time (and memory) of every stage of every subject, if profile_path is set
+    profile = CohortProfile(enabled=profile_path is not None)
+
+    # Function write_region calculates the sums across all slices for one subject in one region and writes them to the tables of that region
+    def write_region(wm, sub_id, confluence_list, volume_list, max_norm_val, voxel_list):
+        # Sums of confluence, number of WMH voxels and confluence normalized by number of WMH voxels in each slice, number of slices
+        # with at least 2 WMH voxels (not confluence > 0 like the original script, see summarise_slices); normalized with maximum possible confluence value per slice (30.20349728 for matrix size 192*256 and s = 0.05)
+        summary = summarise_slices(confluence_list, volume_list, max_norm_val, voxel_list)
+        writers[wm].write({'WBIC_ID': sub_id, f'confluence_{wm}': summary['confluence'], f'volume_{wm}': summary['volume'],
+                           f'confluence_norm_{wm}': summary['confluence_norm'], f'nonzero_slices_{wm}': summary['nonzero_slices'],
+                           f'max_confluence_norm_{wm}': summary['max_confluence_norm'], f'confluence_scaled_{wm}': summary['confluence_scaled']},
+                          {'slice': list(range(len(confluence_list))), f'confluence_{wm}': list(confluence_list), f'volume_{wm}': list(volume_list)})
+
+    if single_pass:
+        # Whole-brain segmentations, each one is loaded once and split into regions in memory
+        subjects = glob.glob(base_dir + '*thr06.nii.gz') # Change '*thr06*' to string that all image filenames contain
+        # Get subject ID from filename -> adapt this so it works with your file names, replace '9_' and '_thr' with strings left and right of subject ID
+        sub_ids = {sub: sub.split('9_', 1)[1].split('_thr',1)[0] for sub in subjects}
+        todo = [sub for sub in subjects if any(sub_ids[sub] not in writers[wm].done for wm in WM)]
+        for sub, regions in run_cached_batch(quantify_subject_regions, todo, cache_dir, {'s': s, 'mode': '2d', 'slice_axis': slice_axis, 'physical_units': physical_units, 'regions': mask_patterns},
+                                             max_cache_size=cache_size, extra_inputs=mask_files,
+                                             n_workers=n_workers, memory_per_worker=memory_per_worker, profile=profile):
+            if isinstance(regions, SubjectFailed): # Error in this subject (e.g. a corrupt image or a missing mask), recorded in the _failed table of every region
+                for wm in WM:
+                    if sub_ids[sub] not in writers[wm].done:
+                        writers[wm].fail(sub_ids[sub], regions.error)
+                continue
+            with profile.stage(sub, 'aggregate'):
+                for wm in WM:
+                    if sub_ids[sub] not in writers[wm].done:
+                        write_region(wm, sub_ids[sub], *regions[wm])
+        order = {wm: [sub_ids[sub] for sub in subjects] for wm in WM}
+    else:
+        subjects = {wm: glob.glob(base_dir + f'*thr06_{wm}.nii.gz') for wm in WM} # Change '*thr06*' to string that all image filenames contain
+        region_of = {sub: wm for wm in WM for sub in subjects[wm]}
         # Get subject ID from filename -> adapt this so it works with your file names, replace '9_' and '_thr' with strings left and right of subject ID
-        sub_id = sub.split('9_', 1)[1].split('_thr',1)[0]
-        confluence_list = [calculate_confluence(image, slice, s) for slice in range(image.shape[2])]
-        volume_list = [calculate_volume(image, slice) for slice in range(image.shape[2])]
-        confluence_df[f'{sub_id}'] = pd.DataFrame(confluence_list)
-        volume_df[f'{sub_id}'] = pd.DataFrame(volume_list)
-
-    # For each slice, normalize confluece metric by dividing it by number of WMH voxels in that slice
-    conf_norm = confluence_df/volume_df
-
-    # Calculate sums across all slices for each subject, create dataframe
-    conf_sum = pd.DataFrame({'WBIC_ID': confluence_df.sum().index, f'confluence_{wm}': confluence_df.sum().values})
-    vol_sum = pd.DataFrame({'WBIC_ID': volume_df.sum().index, f'volume_{wm}': volume_df.sum().values})
-    conf_norm_sum = pd.DataFrame({'WBIC_ID': conf_norm.sum().index, f'confluence_norm_{wm}': conf_norm.sum().values})
-    slice_count = confluence_df.apply(lambda x: (x > 0).sum())
-    nonzero_slices = pd.DataFrame({'WBIC_ID': confluence_df.columns, f'nonzero_slices_{wm}': slice_count}).reset_index(drop=True)
-
-    dfs = [conf_sum, vol_sum, conf_norm_sum, nonzero_slices]
-    confluence_final = reduce(lambda left,right: pd.merge(left,right,on=['WBIC_ID'],
-                                                how='inner'), dfs)
-    confluence_final[f'confluence_scaled_{wm}'] = confluence_final[f'confluence_norm_{wm}']/(30.20349728*confluence_final[f'nonzero_slices_{wm}'])
-    confluence_final['WBIC_ID'] = confluence_final['WBIC_ID'].astype(int)
-
-    input_dict[wm] = confluence_final
-
-result = pd.merge(input_dict['d'],input_dict['pv'],on=['WBIC_ID'])
-# result = dataframe with one row per subject, contains all metrics (I left everything in for sanity checks),
-# the relevant one is in the last column: Confluence_norm_scaled, this will be a value between 0 and 1
+        sub_ids = {sub: sub.split('9_', 1)[1].split('_thr',1)[0] for sub in region_of}
+        todo = [sub for sub in region_of if sub_ids[sub] not in writers[region_of[sub]].done]
+        # Process deep and periventricular images of all subjects in one parallel batch
+        for sub, result in run_cached_batch(quantify_subject, todo, cache_dir, {'s': s, 'mode': '2d', 'slice_axis': slice_axis, 'physical_units': physical_units},
+                                            max_cache_size=cache_size, n_workers=n_workers, memory_per_worker=memory_per_worker,
+                                            profile=profile):
+            if isinstance(result, SubjectFailed): # Error in this subject (e.g. a corrupt image), recorded in the _failed table
+                writers[region_of[sub]].fail(sub_ids[sub], result.error)
+                continue
+            confluence_list, volume_list, max_norm_val, voxel_list = result
+            with profile.stage(sub, 'aggregate'):
+                write_region(region_of[sub], sub_ids[sub], confluence_list, volume_list, max_norm_val, voxel_list)
+        order = {wm: [sub_ids[sub] for sub in subjects[wm]] for wm in WM}
+
+    for writer in writers.values():
+        writer.close()
+    # Per-subject records and summary (percentiles, slowest subjects) of all stages
+    profile.write(profile_path)
+
+    # Read back tables with all subjects (same order as a serial run) and merge regions
+    input_dict = {}
+    for wm in WM:
+        confluence_final = writers[wm].read(order=order[wm])
+        confluence_final['WBIC_ID'] = confluence_final['WBIC_ID'].astype(int)
+        input_dict[wm] = confluence_final
+
+    result = reduce(lambda left,right: pd.merge(left,right,on=['WBIC_ID']), [input_dict[wm] for wm in WM])
+    # result = dataframe with one row per subject, contains all metrics (I left everything in for sanity checks),
+    # the relevant one is in the last column: Confluence_norm_scaled, this will be a value between 0 and 1
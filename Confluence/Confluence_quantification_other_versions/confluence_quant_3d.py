@@ -6,83 +6,162 @@
 # This script takes WMH segmentations (binarized or non-binarized) and calculates a 
 # confluence metric for each subject, in 3D
 
-# Changes you'll need to make so that script works with your paths/filenames: lines 63, 66, 70
+# Changes you'll need to make so that script works with your paths/filenames: lines 117, 118, 119 and 121
 
 import numpy as np
-import pandas as pd
-import nibabel as nib
 import glob
+import sys
+import os
+# Shared confluence functions live next to the main script in Confluence_quantification
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Confluence_quantification'))
+from confluence_engine import confluence_auto, confluence_many, confluence_map, confluence_slabs, max_confluence_norm, relative_deviation, summarise_volume
+from confluence_batch import GB, SubjectFailed
+from confluence_cache import run_cached_batch
+from confluence_writer import ResultWriter
+from confluence_io import MapWriter, load_sparse
+from confluence_lesions import quantify_lesions
+from confluence_profile import CohortProfile, stage
 
 # Function calculate_confluence calculates the metric for one slice
 s = 0.05 # Defines width of Gaussian kernel, this was the optimal value in my tests
+# (to compare several values of s in one run, use sweep_cohort in confluence_sweep.py)
+engine = 'auto' # 'filter' (Gaussian filter), 'neighbours' (KD-tree search for very sparse WMH maps) or 'auto' (whichever is less work)
+physical_units = False # Kernel distances in mm from the voxel size in the image header, for anisotropic voxels (e.g. 1x1x3 mm; s is then per mm^2), False = in voxels
+memory_budget = None # Memory in GB for the confluence calculation of one subject: the volume is processed in overlapping slabs of slices that fit (None = whole volume at once)
+compact = False # Values in 1 byte (binary masks, thresholded maps) and calculation in float32 instead of float64: half the memory, results differ by about 1e-7 (relative)
+compact_check = False # With compact = True, also calculate in float64 and write the relative deviation of the compact result (compact_deviation column)
+small_load = 2000 # Subjects with at most this many WMH voxels are calculated from all pairs of WMH voxels at once, without building the image
+n_workers = None # Number of subjects processed in parallel (None = number of CPUs)
+memory_per_worker = None # Memory limit per parallel process in GB (None = no limit)
+slab_size = None # Number of slices read from an image file at once (None = whole image; smaller = less memory)
+cache_dir = None # Directory for cached results, so reruns only process new or changed images (None = no cache)
+cache_size = None # Size limit of the cache in GB, least recently used results are deleted (None = no limit)
+write_parquet = True # Also write result table as Parquet file (needs pyarrow, otherwise only CSV with a warning)
+profile_path = None # JSON file for the time (and memory) of every stage (load, extract, kernel, volume, aggregate) per subject and a summary of all subjects (None = no profiling)
+lesion_table = False # Also calculate confluence per lesion (connected WMH voxels, in 3D), written to confluence_3d_lesions.csv
+voxel_map = False # Also write the local confluence of every WMH voxel (its share of confluence) as NIfTI with the affine of the input image to confluence_3d_maps/<WBIC_ID>_local_confluence.nii.gz (always uses the filter engine on the whole volume, memory_budget is not used)
 
-def calculate_confluence(image,s):
-    # Get the x, y and z coordinates of each voxel in the image
-    x, y, z = np.indices(image.shape)
-    x_coord = x.flatten()
-    y_coord = y.flatten()
-    z_coord = z.flatten()
-    vox_values = image.flatten()
-    coord = pd.DataFrame({
-        'vox_value': vox_values,
-        'x': x_coord,
-        'y': y_coord,
-        'z': z_coord
-    })
-    # Delete all 0 voxels
-    coord = coord[coord['vox_value']!=0].reset_index()
-    # Create df with products of elementwise multiplication (multiply every voxel with every voxel)
-    products = np.outer(coord['vox_value'],coord['vox_value'])
-    products = pd.DataFrame(products)
-    # Elementwise multiplication yields redundant values (a*b = b*a, a*a) -> set those to 0
-    products[:] = np.tril(products.values, k=-1)
-    equ_input = products.stack().reset_index()
-    equ_input.columns = ['row', 'col', 'product']
-    # Get rid of values that were set to 0
-    equ_input = equ_input[equ_input['product']!=0]
-    # Identify i, j, m and n coordinates that need to enter equation in next step
-    equ_input['i'] = coord.loc[equ_input['row'],'x'].to_numpy()
-    equ_input['j'] = coord.loc[equ_input['row'],'y'].to_numpy()
-    equ_input['k'] = coord.loc[equ_input['row'],'z'].to_numpy()
-    equ_input['m'] = coord.loc[equ_input['col'],'x'].to_numpy()
-    equ_input['n'] = coord.loc[equ_input['col'],'y'].to_numpy()
-    equ_input['o'] = coord.loc[equ_input['col'],'z'].to_numpy()
-    # Calculate all elements of confluence metric
-    equ_input['result'] = equ_input['product'] * np.exp(-s*(abs(equ_input['i']-equ_input['m'])**2 + abs(equ_input['j']-equ_input['n'])**2 + abs(equ_input['k']-equ_input['o'])**2))
-    # Sum all elements to calculate confluence metric for the volume
-    confluence = equ_input['result'].sum()
-    return(confluence)
+def calculate_confluence(image,s, spacing=None, dtype=np.float64):
+    # Sum of v_a*v_b*exp(-s*d^2) over all pairs of WMH voxels in the volume, computed by filtering
+    # the volume with the Gaussian kernel, or only from pairs within the kernel cutoff (see confluence_engine.py);
+    # spacing = voxel size (None = distances in voxels); dtype = np.float32 in compact mode.
+    # Also returns how much too low confluence can be because pairs beyond the kernel cutoff are left out
+    confluence, error_bound = confluence_auto(image, s, engine=engine, spacing=spacing, dtype=dtype, return_error=True)
+    return confluence, error_bound
 
 # Function calculate_volume calculates the number of WMH voxels in a volume
 def calculate_volume(image):
-    volume = image.sum().sum()
+    volume = image.sum(dtype=np.float64)
     return volume
 
 
-# Load images, run function calculate_confluence while looping through subjects and slices:
-base_dir = '/home/ts887/rds/hpc-work/BIANCA/BIANCA_output/' # Change to your directory that contains images
-confluence_df = pd.DataFrame()
-volume_df = pd.DataFrame()
-for sub in glob.glob(base_dir + '*thr06.nii.gz'): # Change '*thr06*' to string that all image filenames contain
+# Function quantify_subject loads one image and calculates confluence metric and number of WMH voxels
+def quantify_subject(sub):
     print(f'Processing subject {sub}')
-    image = nib.load(sub).get_fdata()
-    # Get subject ID from filename -> adapt this so it works with your file names, replace '9_' and '_thr' with strings left and right of subject ID
-    sub_id = sub.split('9_', 1)[1].split('_thr',1)[0]
-    confluence_val = calculate_confluence(image, s)
-    volume_val = calculate_volume(image)
-    confluence_df = pd.concat([confluence_df, pd.DataFrame({'WBIC_ID': [f'{sub_id}'], 'confluence': [confluence_val]})], ignore_index=True)
-    volume_df = pd.concat([volume_df, pd.DataFrame({'WBIC_ID': [f'{sub_id}'], 'volume': [volume_val]})], ignore_index=True)
+    # Load only the WMH voxels (in the data type of the file instead of float64) and put them into a 3D numpy array
+    # that only covers their bounding box
+    sparse = load_sparse(sub, slab_size=slab_size)
+    spacing = sparse.zooms if physical_units else None
+    dtype = np.float32 if compact else np.float64
+    if compact:
+        sparse = sparse.compact()
+    local_map = None
+    if len(sparse) <= small_load and not voxel_map:
+        # Few WMH voxels: all pairs at once without building the image (see confluence_many), same value as calculate_confluence
+        with stage('kernel'):
+            confluence_val = confluence_many([sparse.coords], [sparse.values], s, spacing=spacing, dtype=dtype)[0][0]
+        with stage('volume'):
+            volume_val = sparse.volume()
+    elif memory_budget is not None and not voxel_map:
+        # Slabs of slices with overlapping edges, each one small enough for memory_budget, instead of the whole bounding box
+        # (see confluence_slabs); same value as calculate_confluence, unless not even one slice with its edges fits
+        with stage('kernel'):
+            confluence_val, error_bound, _ = confluence_slabs(sparse.coords, sparse.values, s, memory_budget * GB, spacing=spacing,
+                                                              dtype=dtype)
+        if error_bound > 1e-6 * confluence_val:
+            print(f'Subject {sub}: memory_budget is too small for exact results, confluence could be up to {error_bound:.4g} too low')
+        with stage('volume'):
+            volume_val = sparse.volume()
+    else:
+        with stage('extract'):
+            image = sparse.dense(crop_axes=(0, 1, 2), dtype=dtype)
+        with stage('kernel'):
+            if voxel_map:
+                # Local confluence of every voxel from the filtered volume, confluence = sum over all voxels
+                local, confluence_val = confluence_map(image, s, spacing=spacing, dtype=dtype)
+                confluence_val = float(confluence_val)
+                local_map = sparse.sample(local, crop_axes=(0, 1, 2))
+            else:
+                confluence_val, error_bound = calculate_confluence(image, s, spacing, dtype)
+                if error_bound > 1e-6 * confluence_val:
+                    print(f'Subject {sub}: pairs of WMH voxels beyond the kernel cutoff were left out, confluence could be up to {error_bound:.4g} too low')
+        with stage('volume'):
+            volume_val = calculate_volume(image)
+    # How far the compact result is from the calculation in float64 (calculates everything a second time)
+    deviation = None
+    if compact and compact_check:
+        deviation = relative_deviation(confluence_val, calculate_confluence(sparse.dense(crop_axes=(0, 1, 2)), s, spacing)[0])
+    # Maximum possible confluence/volume for this matrix size (value for an image where every voxel is a WMH)
+    max_norm_val = max_confluence_norm(sparse.shape, s, spacing)
+    # Self-confluence of every lesion and confluence with neighbouring lesions (see confluence_lesions.py)
+    lesions = None
+    if lesion_table:
+        offset = sparse.coords.min(axis=0) if len(sparse) else None # Position of the bounding box in the full image
+        with stage('lesions'):
+            lesions = quantify_lesions(sparse.dense(crop_axes=(0, 1, 2)), s, offset=offset, spacing=spacing)[0].to_dict('list')
+    return confluence_val, volume_val, max_norm_val, lesions, deviation, local_map
+
 
+if __name__ == '__main__':
+    # Load images, run function calculate_confluence while looping through subjects and slices:
+    base_dir = '/home/ts887/rds/hpc-work/BIANCA/BIANCA_output/' # Change to your directory that contains images
+    out_dir = '/home/ts887/rds/hpc-work/BIANCA/confluence_results/' # Change to your directory where result tables are written
+    subjects = glob.glob(base_dir + '*thr06.nii.gz') # Change '*thr06*' to string that all image filenames contain
+    # Get subject ID from filename -> adapt this so it works with your file names, replace '9_' and '_thr' with strings left and right of subject ID
+    sub_ids = {sub: sub.split('9_', 1)[1].split('_thr',1)[0] for sub in subjects}
 
-# Output so far: confluence_df and volume_df = dataframes with one row per subject,
-# containing the confluence metric and the number of WMH voxels
+    # Results are written to out_dir/confluence_3d.csv (and confluence_3d_lesions.csv, one row per lesion, if lesion_table = True)
+    # as soon as a subject is finished; if the script was stopped, subjects already in there are skipped
+    writer = ResultWriter(out_dir, 'confluence_3d', 'WBIC_ID', parquet=write_parquet)
+    # Local confluence maps are written in a background thread while the next results come in
+    maps = MapWriter(out_dir + 'confluence_3d_maps/') if voxel_map else None
+    # Time (and memory) of every stage of every subject, if profile_path is set
+    profile = CohortProfile(enabled=profile_path is not None)
+    todo = [sub for sub in subjects if sub_ids[sub] not in writer.done]
+    # Process subjects in parallel, results come back in the order in which subjects finish
+    for sub, result in run_cached_batch(quantify_subject, todo, cache_dir,
+                                        {'s': s, 'mode': '3d', 'physical_units': physical_units, 'memory_budget': memory_budget, 'lesions': lesion_table,
+                                         'compact': compact, 'compact_check': compact_check, 'voxel_map': voxel_map},
+                                        max_cache_size=cache_size, n_workers=n_workers, memory_per_worker=memory_per_worker,
+                                        profile=profile):
+        if isinstance(result, SubjectFailed): # Error in this subject (e.g. a corrupt image), recorded in the _failed table
+            writer.fail(sub_ids[sub], result.error)
+            continue
+        confluence_val, volume_val, max_norm_val, lesions, deviation, local_map = result
+        with profile.stage(sub, 'aggregate'):
+            # Normalize confluence metric with WMH volume, and with maximum possible confluence value, i.e. value for an image
+            # where every voxel is a WMH (240.5 for matrix size 192*256*256 and s = 0.05)
+            summary = summarise_volume(confluence_val, volume_val, max_norm_val)
+            row = {'WBIC_ID': sub_ids[sub], 'confluence': summary['confluence'], 'max_confluence_norm': summary['max_confluence_norm'],
+                   'volume': summary['volume'], 'confluence_norm': summary['confluence_norm'], 'confluence_norm_scaled': summary['confluence_scaled']}
+            if compact and compact_check:
+                row['compact_deviation'] = deviation # Relative deviation of confluence from the float64 calculation
+            writer.write(row, lesion_rows=lesions)
+            if voxel_map:
+                maps.write(f'{sub_ids[sub]}_local_confluence.nii.gz', local_map)
+    writer.close()
+    if voxel_map:
+        maps.close()
+    # Per-subject records and summary (percentiles, slowest subjects) of all stages
+    profile.write(profile_path)
 
-confluence_final = pd.merge(confluence_df, volume_df, on='WBIC_ID', how='inner')
-# Normalize confluence metric with WMH volume
-confluence_final['confluence_norm'] = confluence_final['confluence']/confluence_final['volume']
-# Normalize with maximum possible confluence value, i.e. value for an image where every voxel is a WMH (240.5 is the value for matrix size 192*256*256)
-confluence_final['confluence_norm_scaled'] = confluence_final['confluence_norm']/240.5 
+    # Read back table with all subjects, in the same order as a serial run
+    confluence_final = writer.read(order=[sub_ids[sub] for sub in subjects])
+    # lesions_final = dataframe with one row per lesion (WBIC_ID, Lesion, size, self-confluence, confluence with
+    # neighbouring lesions, see confluence_lesions.py)
+    if lesion_table:
+        lesions_final = writer.read_lesions()
 
 
-# confluence_final = dataframe with one row per subject, contains all metrics (I left everything in for sanity checks),
-# the relevant one is in the last column: confluence_norm_scaled, this will be a value between 0 and 1
+    # confluence_final = dataframe with one row per subject, contains all metrics (I left everything in for sanity checks),
+    # the relevant one is in the last column: confluence_norm_scaled, this will be a value between 0 and 1
@@ -6,52 +6,50 @@
 # This script takes WMH segmentations (binarized or non-binarized) and calculates a 
 # confluence metric for each subject, in 3D, separately for periventricular WM and deep WM
 
-# Changes you'll need to make so that script works with your paths/filenames: lines 63, 69 and 73
+# Changes you'll need to make so that script works with your paths/filenames: lines 43, 44, 106, 118, 124, 125, 152, 154, 170 and 173
 
-import numpy as np
 import pandas as pd
-import nibabel as nib
 import glob
+from functools import reduce
+import sys
+import os
+# Shared confluence functions live next to the main script in Confluence_quantification
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Confluence_quantification'))
+from confluence_engine import confluence_auto, confluence_many, confluence_slabs, max_confluence_norm, summarise_volume
+from confluence_batch import GB, SubjectFailed
+from confluence_cache import run_cached_batch
+from confluence_writer import ResultWriter
+from confluence_io import load_sparse
+from confluence_regions import find_region_masks, load_region_masks, split_regions
+from confluence_profile import CohortProfile, stage
 
 # Function calculate_confluence calculates the metric for one slice
 s = 0.05 # Defines width of Gaussian kernel, this was the optimal value in my tests
+# (to compare several values of s in one run, use sweep_cohort in confluence_sweep.py)
+engine = 'auto' # 'filter' (Gaussian filter), 'neighbours' (KD-tree search for very sparse WMH maps) or 'auto' (whichever is less work)
+physical_units = False # Kernel distances in mm from the voxel size in the image header, for anisotropic voxels (e.g. 1x1x3 mm; s is then per mm^2), False = in voxels
+memory_budget = None # Memory in GB for the confluence calculation of one subject: the volume is processed in overlapping slabs of slices that fit (None = whole volume at once)
+small_load = 2000 # Subjects with at most this many WMH voxels are calculated from all pairs of WMH voxels at once, without building the image
+n_workers = None # Number of subjects processed in parallel (None = number of CPUs)
+memory_per_worker = None # Memory limit per parallel process in GB (None = no limit)
+slab_size = None # Number of slices read from an image file at once (None = whole image; smaller = less memory)
+cache_dir = None # Directory for cached results, so reruns only process new or changed images (None = no cache)
+cache_size = None # Size limit of the cache in GB, least recently used results are deleted (None = no limit)
+write_parquet = True # Also write result tables as Parquet files (needs pyarrow, otherwise only CSV with a warning)
+profile_path = None # JSON file for the time (and memory) of every stage (load, extract, kernel, volume, aggregate) per subject and a summary of all subjects (None = no profiling)
+single_pass = False # True = load whole-brain segmentation once and apply the masks in mask_patterns in memory (False = use *_d/*_pv segmentations from WMH_segmentation_split.py)
+# Masks for single-pass mode, {sub_id} is replaced by the subject ID -> change to where WMH_segmentation_split.py wrote the masks;
+# add more entries (e.g. lobar masks) to calculate the metric for more regions in the same pass
+mask_patterns = {'d': '/home/ts887/rds/hpc-work/BIANCA/BIANCA_images/CUH_BIDS/sub-{sub_id}/ses-*/anat/*anat/*vent_d.nii.gz',
+                 'pv': '/home/ts887/rds/hpc-work/BIANCA/BIANCA_images/CUH_BIDS/sub-{sub_id}/ses-*/anat/*anat/*vent_pv_full.nii.gz'}
 
-def calculate_confluence(image,s):
-    # Get the x, y and z coordinates of each voxel in the image
-    x, y, z = np.indices(image.shape)
-    x_coord = x.flatten()
-    y_coord = y.flatten()
-    z_coord = z.flatten()
-    vox_values = image.flatten()
-    coord = pd.DataFrame({
-        'vox_value': vox_values,
-        'x': x_coord,
-        'y': y_coord,
-        'z': z_coord
-    })
-    # Delete all 0 voxels
-    coord = coord[coord['vox_value']!=0].reset_index()
-    # Create df with products of elementwise multiplication (multiply every voxel with every voxel)
-    products = np.outer(coord['vox_value'],coord['vox_value'])
-    products = pd.DataFrame(products)
-    # Elementwise multiplication yields redundant values (a*b = b*a, a*a) -> set those to 0
-    products[:] = np.tril(products.values, k=-1)
-    equ_input = products.stack().reset_index()
-    equ_input.columns = ['row', 'col', 'product']
-    # Get rid of values that were set to 0
-    equ_input = equ_input[equ_input['product']!=0]
-    # Identify i, j, m and n coordinates that need to enter equation in next step
-    equ_input['i'] = coord.loc[equ_input['row'],'x'].to_numpy()
-    equ_input['j'] = coord.loc[equ_input['row'],'y'].to_numpy()
-    equ_input['k'] = coord.loc[equ_input['row'],'z'].to_numpy()
-    equ_input['m'] = coord.loc[equ_input['col'],'x'].to_numpy()
-    equ_input['n'] = coord.loc[equ_input['col'],'y'].to_numpy()
-    equ_input['o'] = coord.loc[equ_input['col'],'z'].to_numpy()
-    # Calculate all elements of confluence metric
-    equ_input['result'] = equ_input['product'] * np.exp(-s*(abs(equ_input['i']-equ_input['m'])**2 + abs(equ_input['j']-equ_input['n'])**2 + abs(equ_input['k']-equ_input['o'])**2))
-    # Sum all elements to calculate confluence metric for the volume
-    confluence = equ_input['result'].sum()
-    return(confluence)
+def calculate_confluence(image,s, spacing=None):
+    # Sum of v_a*v_b*exp(-s*d^2) over all pairs of WMH voxels in the volume, computed by filtering
+    # the volume with the Gaussian kernel, or only from pairs within the kernel cutoff (see confluence_engine.py);
+    # spacing = voxel size (None = distances in voxels).
+    # Also returns how much too low confluence can be because pairs beyond the kernel cutoff are left out
+    confluence, error_bound = confluence_auto(image, s, engine=engine, spacing=spacing, return_error=True)
+    return confluence, error_bound
 
 # Function calculate_volume calculates the number of WMH voxels in a volume
 def calculate_volume(image):
@@ -59,40 +57,141 @@ def calculate_volume(image):
     return volume
 
 
-# Load images, run function calculate_confluence while looping through subjects:
-base_dir = '/home/ts887/rds/hpc-work/BIANCA/BIANCA_output/' # Change to your directory that contains images
+# Function quantify_subject loads one image and calculates confluence metric and number of WMH voxels
+def quantify_subject(sub):
+    print(f'Processing subject {sub}')
+    # Load only the WMH voxels (in the data type of the file instead of float64) and put them into a 3D numpy array
+    # that only covers their bounding box
+    sparse = load_sparse(sub, slab_size=slab_size)
+    return quantify_sparse(sparse, sub)
 
-WM = ['d','pv'] # Deep and periventricular white matter;
-# this assumes you have two sets of WMH segmentations, one ending in *_d.nii.gz for hyperintensities in deep WM 
-# and one ending in *_pv.nii.gz for periventricular WM; the script WMH_segmentation_split.py generates these
-# two sets of segmentations from normal whole-brain WMH segmentations
 
-input_dict = {}
+# Function quantify_sparse calculates confluence metric, number of WMH voxels and maximum possible confluence/volume
+# from the WMH voxels of one image (SparseImage, see confluence_io.py); name = subject (and region) for messages
+def quantify_sparse(sparse, name):
+    spacing = sparse.zooms if physical_units else None
+    if len(sparse) <= small_load:
+        # Few WMH voxels: all pairs at once without building the image (see confluence_many), same value as calculate_confluence
+        with stage('kernel'):
+            confluence_val = confluence_many([sparse.coords], [sparse.values], s, spacing=spacing)[0][0]
+        with stage('volume'):
+            volume_val = sparse.volume()
+    elif memory_budget is not None:
+        # Slabs of slices with overlapping edges, each one small enough for memory_budget, instead of the whole bounding box
+        # (see confluence_slabs); same value as calculate_confluence, unless not even one slice with its edges fits
+        with stage('kernel'):
+            confluence_val, error_bound, _ = confluence_slabs(sparse.coords, sparse.values, s, memory_budget * GB, spacing=spacing)
+        if error_bound > 1e-6 * confluence_val:
+            print(f'Subject {name}: memory_budget is too small for exact results, confluence could be up to {error_bound:.4g} too low')
+        with stage('volume'):
+            volume_val = sparse.volume()
+    else:
+        with stage('extract'):
+            image = sparse.dense(crop_axes=(0, 1, 2))
+        with stage('kernel'):
+            confluence_val, error_bound = calculate_confluence(image, s, spacing)
+        if error_bound > 1e-6 * confluence_val:
+            print(f'Subject {name}: pairs of WMH voxels beyond the kernel cutoff were left out, confluence could be up to {error_bound:.4g} too low')
+        with stage('volume'):
+            volume_val = calculate_volume(image)
+    max_norm_val = max_confluence_norm(sparse.shape, s, spacing)
+    return confluence_val, volume_val, max_norm_val
 
-for wm in WM:
-    confluence_df = pd.DataFrame()
-    volume_df = pd.DataFrame()
-    for sub in glob.glob(base_dir + f'*thr06_{wm}.nii.gz'): # Change '*thr06*' to string that all image filenames contain
-        print(f'Processing subject {sub}')
-        image = nib.load(sub).get_fdata()
+
+# Function quantify_subject_regions loads one whole-brain segmentation and calculates the metric for every region in mask_patterns
+def quantify_subject_regions(sub):
+    print(f'Processing subject {sub}')
+    sparse = load_sparse(sub, slab_size=slab_size)
+    # Get subject ID from filename -> adapt this so it works with your file names, replace '9_' and '_thr' with strings left and right of subject ID
+    sub_id = sub.split('9_', 1)[1].split('_thr',1)[0]
+    with stage('load'):
+        masks = load_region_masks(mask_patterns, sub_id)
+    # WMH voxels of every region, each one then goes through quantify_sparse like a separate image (all pairs for few voxels,
+    # slabs with memory_budget, otherwise the bounding box of that region's voxels), so the whole volume is never built
+    with stage('extract'):
+        regions = split_regions(sparse, masks)
+    return {region: quantify_sparse(regions[region], f'{sub} ({region})') for region in regions}
+
+
+# Function mask_files returns the mask files of one subject (cached results are recomputed when they change)
+def mask_files(sub):
+    sub_id = sub.split('9_', 1)[1].split('_thr',1)[0]
+    return [path for path in find_region_masks(mask_patterns, sub_id).values() if path is not None]
+
+
+if __name__ == '__main__':
+    # Load images, run function calculate_confluence while looping through subjects:
+    base_dir = '/home/ts887/rds/hpc-work/BIANCA/BIANCA_output/' # Change to your directory that contains images
+    out_dir = '/home/ts887/rds/hpc-work/BIANCA/confluence_results/' # Change to your directory where result tables are written
+
+    WM = ['d','pv'] # Deep and periventricular white matter;
+    # this assumes you have two sets of WMH segmentations, one ending in *_d.nii.gz for hyperintensities in deep WM 
+    # and one ending in *_pv.nii.gz for periventricular WM; the script WMH_segmentation_split.py generates these
+    # two sets of segmentations from normal whole-brain WMH segmentations
+    # (with single_pass = True, the masks in mask_patterns are applied to the whole-brain segmentations instead,
+    # and there is one region, with its own tables, per entry of mask_patterns, e.g. also lobar masks)
+    if single_pass:
+        WM = list(mask_patterns)
+
+    # Results are written to out_dir as soon as a subject is finished, one table per region (confluence_3d_d.csv, confluence_3d_pv.csv);
+    # if the script was stopped, subjects already in there are skipped
+    writers = {wm: ResultWriter(out_dir, f'confluence_3d_{wm}', 'WBIC_ID', parquet=write_parquet) for wm in WM}
+    # Time (and memory) of every stage of every subject, if profile_path is set
+    profile = CohortProfile(enabled=profile_path is not None)
+
+    # Function write_region normalizes the metrics of one subject in one region and writes them to the table of that region
+    def write_region(wm, sub_id, confluence_val, volume_val, max_norm_val):
+        # Normalize confluence metric with WMH volume, and with maximum possible confluence value, i.e. value for an image
+        # where every voxel is a WMH (240.5 for matrix size 192*256*256 and s = 0.05)
+        summary = summarise_volume(confluence_val, volume_val, max_norm_val)
+        writers[wm].write({'WBIC_ID': sub_id, f'confluence_{wm}': summary['confluence'], f'max_confluence_norm_{wm}': summary['max_confluence_norm'],
+                           f'volume_{wm}': summary['volume'], f'confluence_norm_{wm}': summary['confluence_norm'], f'confluence_scaled_{wm}': summary['confluence_scaled']})
+
+    if single_pass:
+        # Whole-brain segmentations, each one is loaded once and split into regions in memory
+        subjects = glob.glob(base_dir + '*thr06.nii.gz') # Change '*thr06*' to string that all image filenames contain
+        # Get subject ID from filename -> adapt this so it works with your file names, replace '9_' and '_thr' with strings left and right of subject ID
+        sub_ids = {sub: sub.split('9_', 1)[1].split('_thr',1)[0] for sub in subjects}
+        todo = [sub for sub in subjects if any(sub_ids[sub] not in writers[wm].done for wm in WM)]
+        for sub, regions in run_cached_batch(quantify_subject_regions, todo, cache_dir, {'s': s, 'mode': '3d', 'physical_units': physical_units, 'memory_budget': memory_budget, 'regions': mask_patterns},
+                                             max_cache_size=cache_size, extra_inputs=mask_files,
+                                             n_workers=n_workers, memory_per_worker=memory_per_worker, profile=profile):
+            if isinstance(regions, SubjectFailed): # Error in this subject (e.g. a corrupt image or a missing mask), recorded in the _failed table of every region
+                for wm in WM:
+                    if sub_ids[sub] not in writers[wm].done:
+                        writers[wm].fail(sub_ids[sub], regions.error)
+                continue
+            with profile.stage(sub, 'aggregate'):
+                for wm in WM:
+                    if sub_ids[sub] not in writers[wm].done:
+                        write_region(wm, sub_ids[sub], *regions[wm])
+        order = {wm: [sub_ids[sub] for sub in subjects] for wm in WM}
+    else:
+        subjects = {wm: glob.glob(base_dir + f'*thr06_{wm}.nii.gz') for wm in WM} # Change '*thr06*' to string that all image filenames contain
+        region_of = {sub: wm for wm in WM for sub in subjects[wm]}
         # Get subject ID from filename -> adapt this so it works with your file names, replace '9_' and '_thr' with strings left and right of subject ID
-        sub_id = sub.split('9_', 1)[1].split('_thr',1)[0]
-        confluence_val = calculate_confluence(image, s)
-        volume_val = calculate_volume(image)
-        confluence_df = pd.concat([confluence_df, pd.DataFrame({'WBIC_ID': [f'{sub_id}'], f'confluence_{wm}': [confluence_val]})], ignore_index=True)
-        volume_df = pd.concat([volume_df, pd.DataFrame({'WBIC_ID': [f'{sub_id}'], f'volume_{wm}': [volume_val]})], ignore_index=True)
-  
-    # Output so far: confluence_df and volume_df = dataframes with one row per subject,
-    # containing the confluence metric for that slice and the number of WMH voxels
-    confluence_final = pd.merge(confluence_df, volume_df, on='WBIC_ID', how='inner')
-    # Normalize confluence metric with WMH volume
-    confluence_final[f'confluence_norm_{wm}'] = confluence_final[f'confluence_{wm}']/confluence_final[f'volume_{wm}']
-    # Normalize with maximum possible confluence value, i.e. value for an image where every voxel is a WMH (240.5 is the value for matrix size 192*256*256)
-    confluence_final[f'confluence_scaled_{wm}'] = confluence_final[f'confluence_norm_{wm}']/240.5
-    input_dict[wm] = confluence_final
-
-result = pd.merge(input_dict['d'],input_dict['pv'],on=['WBIC_ID'])
-
-# result = dataframe with one row per subject, contains all metrics (I left everything in for sanity checks),
-# periventricular WM and deep WM in one dataframe,
-# the relevant one is in the last column: confluence_norm_scaled, this will be a value between 0 and 1
+        sub_ids = {sub: sub.split('9_', 1)[1].split('_thr',1)[0] for sub in region_of}
+        todo = [sub for sub in region_of if sub_ids[sub] not in writers[region_of[sub]].done]
+        # Process deep and periventricular images of all subjects in one parallel batch
+        for sub, result in run_cached_batch(quantify_subject, todo, cache_dir, {'s': s, 'mode': '3d', 'physical_units': physical_units, 'memory_budget': memory_budget},
+                                            max_cache_size=cache_size, n_workers=n_workers, memory_per_worker=memory_per_worker,
+                                            profile=profile):
+            if isinstance(result, SubjectFailed): # Error in this subject (e.g. a corrupt image), recorded in the _failed table
+                writers[region_of[sub]].fail(sub_ids[sub], result.error)
+                continue
+            confluence_val, volume_val, max_norm_val = result
+            with profile.stage(sub, 'aggregate'):
+                write_region(region_of[sub], sub_ids[sub], confluence_val, volume_val, max_norm_val)
+        order = {wm: [sub_ids[sub] for sub in subjects[wm]] for wm in WM}
+
+    for writer in writers.values():
+        writer.close()
+    # Per-subject records and summary (percentiles, slowest subjects) of all stages
+    profile.write(profile_path)
+
+    # Read back tables with all subjects (same order as a serial run) and merge regions
+    result = reduce(lambda left,right: pd.merge(left,right,on=['WBIC_ID']), [writers[wm].read(order=order[wm]) for wm in WM])
+
+    # result = dataframe with one row per subject, contains all metrics (I left everything in for sanity checks),
+    # periventricular WM and deep WM in one dataframe,
+    # the relevant one is in the last column: confluence_norm_scaled, this will be a value between 0 and 1
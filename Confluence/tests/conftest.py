@@ -0,0 +1,7 @@
+# The modules are imported like in the scripts, from the two script directories
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ('Confluence_quantification', 'Confluence_quantification_other_versions'):
+    sys.path.insert(0, os.path.join(root, directory))
@@ -0,0 +1,58 @@
+# Checks the confluence engines against the pairwise calculation of the original scripts on small phantoms
+import numpy as np
+import pytest
+
+from confluence_benchmark import make_phantom
+from confluence_engine import KERNEL_TOL, confluence_2d, confluence_auto, confluence_pairwise
+
+S = 0.05
+
+
+@pytest.mark.parametrize('engine', ['filter', 'neighbours', 'auto'])
+@pytest.mark.parametrize('spacing', [None, (1.0, 1.2, 3.0)])
+@pytest.mark.parametrize('probabilistic', [False, True])
+def test_confluence_auto_3d(engine, spacing, probabilistic):
+    image = make_phantom((24, 20, 12), 300, probabilistic=probabilistic, seed=1)
+    result = confluence_auto(image, S, engine=engine, spacing=spacing)
+    assert result == pytest.approx(confluence_pairwise(image, S, spacing=spacing), rel=1e-9)
+
+
+@pytest.mark.parametrize('engine', ['filter', 'neighbours', 'auto'])
+@pytest.mark.parametrize('slice_axis', [0, 2])
+@pytest.mark.parametrize('spacing', [None, (1.0, 1.2, 3.0)])
+def test_confluence_2d(engine, slice_axis, spacing):
+    image = make_phantom((16, 18, 10), 250, probabilistic=True, seed=2)
+    image[(slice(None),) * slice_axis + (3,)] = 0 # One slice without WMH voxels
+    result = confluence_2d(image, S, slice_axis=slice_axis, engine=engine, spacing=spacing)
+    in_plane = None if spacing is None else tuple(h for a, h in enumerate(spacing) if a != slice_axis)
+    for k in range(image.shape[slice_axis]):
+        image_slice = np.take(image, k, axis=slice_axis)
+        if not image_slice.any():
+            assert np.isnan(result['confluence'][k]) and not result['nonzero'][k]
+            continue
+        assert result['confluence'][k] == pytest.approx(confluence_pairwise(image_slice, S, spacing=in_plane), rel=1e-9, abs=1e-12)
+        assert result['voxels'][k] == np.count_nonzero(image_slice)
+        assert result['volume'][k] == pytest.approx(image_slice.sum())
+
+
+# A single voxel has no pairs; a pair further apart than the kernel cutoff is left out (kernel < KERNEL_TOL)
+@pytest.mark.parametrize('engine', ['filter', 'neighbours'])
+def test_no_pairs(engine):
+    image = np.zeros((40, 10, 10))
+    image[0, 5, 5] = 1
+    assert confluence_auto(image, S, engine=engine) == 0
+    image[39, 5, 5] = 1
+    assert confluence_auto(image, S, engine=engine) == pytest.approx(confluence_pairwise(image, S), abs=KERNEL_TOL)
+
+
+# With a large tol, pairs are left out; the error bound covers them (same bound for both engines)
+@pytest.mark.parametrize('engine', ['filter', 'neighbours'])
+def test_error_bound(engine):
+    image = make_phantom((24, 20, 12), 300, probabilistic=True, seed=3)
+    reference = confluence_pairwise(image, S)
+    confluence, error_bound = confluence_auto(image, S, engine=engine, tol=1e-3, return_error=True)
+    assert 0 < reference - confluence <= error_bound
+    slices = confluence_2d(image, S, engine=engine, tol=1e-3)
+    for k in np.flatnonzero(slices['nonzero']):
+        reference = confluence_pairwise(image[:, :, k], S)
+        assert -1e-9 <= reference - slices['confluence'][k] <= slices['error_bound'][k] + 1e-9
@@ -0,0 +1,141 @@
+# Runs the task graph of WMH_segmentation_split.py (see confluence_scheduler.py) with stub FSL executables:
+# every stub writes the files the real tool would write (copies of its input, a block of ventricles for
+# make_bianca_mask) and can be made to fail the first n times (environment variable STUB_FAIL_<TOOL> = n)
+import json
+import os
+import stat
+import sys
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+import WMH_segmentation_split as split
+from confluence_scheduler import Task, run_tasks
+
+STUB = '''#!{python}
+import os, shutil, sys
+import numpy as np
+import nibabel as nib
+tool, args = os.path.basename(sys.argv[0]), sys.argv[1:]
+calls = os.path.join(os.path.dirname(sys.argv[0]), 'calls.txt')
+n_calls = open(calls).read().split().count(tool) if os.path.exists(calls) else 0
+with open(calls, 'a') as f:
+    f.write(tool + '\\n')
+if n_calls < int(os.environ.get('STUB_FAIL_' + tool.upper(), 0)):
+    sys.exit(f'{{tool}} failed')
+def value(flag):
+    return args[args.index(flag) + 1]
+if tool == 'fsl_anat':
+    t1 = value('-i')
+    os.makedirs(t1 + '.anat', exist_ok=True)
+    for name in ['T1', 'T1_biascorr', 'T1_fast_pve_0', 'MNI_to_T1_nonlin_field']:
+        shutil.copy(t1 + '.nii.gz', os.path.join(t1 + '.anat', name + '.nii.gz'))
+elif tool == 'make_bianca_mask':
+    img = nib.load(args[0] + '.nii.gz')
+    vent = np.zeros(img.shape, dtype=np.uint8)
+    vent[8:12, 8:12, 4:6] = 1
+    nib.save(nib.Nifti1Image(vent, img.affine), args[0] + '_ventmask.nii.gz')
+elif tool == 'flirt':
+    shutil.copy(value('-in') + '.nii.gz', value('-out') + '.nii.gz')
+    if '-omat' in args:
+        np.savetxt(value('-omat'), np.eye(4))
+'''
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    fsl_dir = tmp_path / 'fsl'
+    fsl_dir.mkdir()
+    for tool in ['fsl_anat', 'make_bianca_mask', 'flirt']:
+        path = fsl_dir / tool
+        path.write_text(STUB.format(python=sys.executable))
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    anat = tmp_path / 'bids' / 'sub-01' / 'ses-1' / 'anat'
+    anat.mkdir(parents=True)
+    bianca_dir = tmp_path / 'bianca'
+    bianca_dir.mkdir()
+    affine = np.eye(4)
+    t1 = np.random.default_rng(0).uniform(size=(20, 20, 10)).astype(np.float32)
+    nib.save(nib.Nifti1Image(t1, affine), str(anat / 'sub-01_rec-norm_T1w.nii.gz'))
+    nib.save(nib.Nifti1Image(t1, affine), str(anat / 'sub-01_rec-norm_FLAIR.nii.gz'))
+    wmh = np.zeros(t1.shape, dtype=np.float32)
+    wmh[:, 10, 5] = 1 # Line through the ventricles (x = 8 ... 11), ends 8 voxels away from them
+    nib.save(nib.Nifti1Image(wmh, affine), str(bianca_dir / 'BIANCA_01_thr06.nii.gz'))
+    monkeypatch.setattr(split, 'base_dir', str(tmp_path / 'bids') + '/')
+    monkeypatch.setattr(split, 'bianca_dir', str(bianca_dir) + '/')
+    monkeypatch.setattr(split, 'fsl_dir', str(fsl_dir))
+    monkeypatch.setattr(split, 'retries', 1)
+    for tool in ['FSL_ANAT', 'MAKE_BIANCA_MASK', 'FLIRT']:
+        monkeypatch.delenv('STUB_FAIL_' + tool, raising=False)
+
+    # Function run runs all tasks of the subject, returns (records, tools called by this run)
+    def run():
+        calls = fsl_dir / 'calls.txt'
+        before = calls.read_text().split() if calls.exists() else []
+        tasks = split.subject_tasks(str(anat) + '/')
+        records = run_tasks(tasks, n_workers=2, log_path=str(tmp_path / 'log.json'))
+        after = calls.read_text().split() if calls.exists() else []
+        return {name.split('/')[-1]: record for name, record in records.items()}, after[len(before):]
+    run.wmh = wmh
+    run.bianca = str(bianca_dir / 'BIANCA_01_thr06')
+    run.log_path = str(tmp_path / 'log.json')
+    return run
+
+
+def test_pipeline_and_rerun(pipeline):
+    records, calls = pipeline()
+    assert {step: record['status'] for step, record in records.items()} == {
+        'fsl_anat': 'done', 'make_bianca_mask': 'done', 'flirt_t1_to_flair': 'done', 'flirt_ventmask_to_flair': 'done', 'split': 'done'}
+    assert sorted(calls) == ['flirt', 'flirt', 'fsl_anat', 'make_bianca_mask']
+    pv = np.asanyarray(nib.load(pipeline.bianca + '_pv.nii.gz').dataobj)
+    d = np.asanyarray(nib.load(pipeline.bianca + '_d.nii.gz').dataobj)
+    # Distance from the ventricles along the line: pv up to 5 mm (x = 3 ... 16), d from 5 mm on (both at exactly 5 mm)
+    x = np.arange(20)
+    distance = np.maximum(np.maximum(8 - x, x - 11), 0)
+    assert np.array_equal(pv[:, 10, 5] > 0, distance <= 5)
+    assert np.array_equal(d[:, 10, 5] > 0, distance >= 5)
+    assert np.count_nonzero(pv) + np.count_nonzero(d) == np.count_nonzero(pipeline.wmh) + 2
+    # Outputs are newer than inputs: nothing is run again
+    records, calls = pipeline()
+    assert {record['status'] for record in records.values()} == {'skipped'}
+    assert calls == []
+
+
+def test_retry(pipeline, monkeypatch):
+    monkeypatch.setenv('STUB_FAIL_FSL_ANAT', '1')
+    records, calls = pipeline()
+    assert records['fsl_anat']['status'] == 'done'
+    assert [attempt['returncode'] for attempt in records['fsl_anat']['attempts']] == [1, 0]
+    assert 'fsl_anat failed' in records['fsl_anat']['attempts'][0]['message']
+    assert records['split']['status'] == 'done'
+
+
+def test_failure_stops_dependent_steps(pipeline, monkeypatch):
+    monkeypatch.setenv('STUB_FAIL_MAKE_BIANCA_MASK', '5')
+    records, calls = pipeline()
+    assert records['make_bianca_mask']['status'] == 'failed'
+    assert len(records['make_bianca_mask']['attempts']) == 2 # retries = 1
+    assert records['flirt_t1_to_flair']['status'] == 'done' # Doesn't need the ventricle mask
+    for step in ['flirt_ventmask_to_flair', 'split']:
+        assert records[step]['status'] == 'upstream_failed'
+    assert records['split']['failed_dependency'].endswith('flirt_ventmask_to_flair')
+    with open(pipeline.log_path) as f:
+        assert {record['status'] for record in json.load(f)['tasks']} == {'done', 'failed', 'upstream_failed'}
+    # Once the tool works, only the failed step and the ones after it are run
+    monkeypatch.delenv('STUB_FAIL_MAKE_BIANCA_MASK')
+    records, calls = pipeline()
+    assert sorted(calls) == ['flirt', 'make_bianca_mask']
+    assert records['fsl_anat']['status'] == 'skipped' and records['split']['status'] == 'done'
+
+
+def test_missing_outputs_fail(tmp_path):
+    # Return code 0 without writing the outputs counts as failed
+    records = run_tasks([Task('touch_nothing', [sys.executable, '-c', 'pass'], outputs=[str(tmp_path / 'out.txt')])], n_workers=1)
+    assert records['touch_nothing']['status'] == 'failed'
+    assert 'Outputs missing' in records['touch_nothing']['attempts'][0]['message']
+
+
+def test_cycle():
+    with pytest.raises(ValueError, match='cycle'):
+        run_tasks([Task('a', lambda: None, deps=['b']), Task('b', lambda: None, deps=['a'])])